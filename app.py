@@ -1,16 +1,20 @@
-from dash import Dash, dcc, html, callback_context
+from dash import Dash, dcc, html, callback_context, no_update
 from dash.dependencies import Input, Output, State
-from mod_dataworld import get_ourfish_data, get_geo_data
+from mod_dataworld import get_ourfish_data, get_geo_data, OURFISH_COLUMNS, GEO_COLUMNS
 from utils_filters import sync_select_all
 from mod_filters import start_filters
 from utils_plot import (
     get_catch_data, make_catch_fig,
     get_cpue_value_data, make_cpue_value_fig,
     get_length_data, make_length_fig,
-    get_composition_data, make_composition_fig
+    get_composition_data, make_composition_fig, get_fig_template
 )
 from mod_plot import start_plot
-from utils_map import get_map_data, make_map, mapbox_url
+from utils_map import (
+    make_map, mapbox_url,
+    build_spatial_index, get_cluster_data, get_cluster_level, get_map_view,
+    get_viewport, get_bounds, pad_bounds, contains_bounds, get_map_layout, EXPAND_ZOOM
+)
 from mod_map import start_map
 from utils_highlights import (
     create_card, get_total_weight, get_total_value, get_total_trips,
@@ -18,9 +22,31 @@ from utils_highlights import (
 )
 from mod_highlights import start_highlights
 from mod_download import start_download_button
+from utils_download import (
+    get_export_key, get_export_path, new_tmp_path, save_artifact, send_artifact, tee_to_artifact,
+    write_workbook, get_export_metadata, stream_records_csv, stream_records_parquet,
+    remove_old_artifacts, RECORD_FORMATS, XLSX_MIMETYPE, EXPORT_MAX_AGE, EXPORT_DIR, SHEET_NAMES
+)
+from utils_jobs import JobQueue, progress_steps, step, JOBS_DIR
+from utils_dataset import Dataset, DatasetStore, live_datasets, DATASET_MAX_AGE
+from utils_cache import single_flight, normalized, VersionKeys
+from utils_metrics import timed_callback, timed_stage, CacheTracker, render_metrics, is_allowed
+from utils_profile import profiled
+from utils_memory import get_memory_report
+from utils_warm import CacheWarmer, ViewStats, WARM_ON_LOAD
+from utils_query import compute_output_data, compute_map_data, get_maa_countries, OUTPUT_COLUMNS
+from utils_api import (
+    parse_filters, to_json, to_arrow_stream, ApiError, API_OUTPUTS, API_FORMATS, API_MAX_AGE
+)
+from utils_snapshot import (
+    write_snapshot, query_snapshot_table, iter_snapshot_batches, get_snapshot_schema, get_snapshot_dataset,
+    get_snapshot_version, read_snapshot_distinct, get_snapshot_date_range, open_snapshot, SNAPSHOT_DIR
+)
 import datetime
-import io
+import hashlib
+import os
 import pandas as pd
+from flask import Response, abort, request
 from flask_caching import Cache
 import uuid
 
@@ -44,7 +70,9 @@ external_scripts = [
     }
 ]
 
-app = Dash(__name__, external_stylesheets = external_stylesheets)
+# compress: gzip/brotli the callback responses (Flask-Compress); figures are mostly
+# repetitive JSON and a lot of our users are on slow connections
+app = Dash(__name__, external_stylesheets = external_stylesheets, compress = True)
 app.index_string = """
 <!DOCTYPE html>
 <html>
@@ -82,49 +110,252 @@ cache = Cache(app.server, config={
     'CACHE_TYPE': 'redis',
     'CACHE_TYPE': 'filesystem',
     'CACHE_DIR': 'cache-directory',
-    'CACHE_THRESHOLD': 200 # subject to change
+    'CACHE_THRESHOLD': 200, # subject to change
+    # Memoized results are keyed by the data's version (see normalize_view), so they don't need
+    # to expire to pick up new data; an old version's are deleted once a new one loads (see
+    # collect_old_versions)
+    'CACHE_DEFAULT_TIMEOUT': DATASET_MAX_AGE
 })
 
-# User opens app and initial query to data.world is performed
-# The query output is memoized using the session id, so each user
-# will have their initial data cached.
-@cache.memoize()
-def query_ourfish_data(session_id):
-    all_data = get_ourfish_data()
-    return all_data
+# Per-session state (the fingerprints of what each session was last sent, record download
+# tokens) is kept apart from the memoized results, so that many sessions don't evict the results
+# and each tier can be measured on its own (see report_memory)
+session_cache = Cache(app.server, config={
+    'CACHE_TYPE': 'filesystem',
+    'CACHE_DIR': 'session-directory',
+    'CACHE_THRESHOLD': 1000
+})
 
-@cache.memoize()
-def query_geo_data(session_id):
-    all_data = query_ourfish_data(session_id) # from cache
+# Where the data comes from: 'dataworld', or 'snapshot' to serve the current snapshot as it is
+# (e.g. one made by synth_ourfish.py) without pulling anything
+OURFISH_SOURCE = os.environ.get('OURFISH_SOURCE', 'dataworld')
+
+def load_dataset():
+    """
+    Pull the OurFish data from data.world, save it to the partitioned snapshot that queries read
+    from, and derive the tables every session uses. The records aren't kept in memory.
+    """
+    if OURFISH_SOURCE == 'snapshot':
+        return load_snapshot_dataset()
+
+    all_data = get_ourfish_data()
+    version = write_snapshot(all_data)
     geo = get_geo_data(all_data)
-    return geo
+    spatial_index = build_spatial_index(geo["comm"])
+    return Dataset(geo, spatial_index, all_data['date'].min(), all_data['date'].max(), version)
+
+def load_snapshot_dataset():
+    """
+    Same as load_dataset, from the current snapshot. It's read a batch at a time, so this works
+    for snapshots far bigger than memory.
+    """
+    version = get_snapshot_version()
+    if version is None:
+        raise RuntimeError("OURFISH_SOURCE is 'snapshot' but there is no snapshot")
+    geo = get_geo_data(read_snapshot_distinct(GEO_COLUMNS, version))
+    spatial_index = build_spatial_index(geo["comm"])
+    min_date, max_date = get_snapshot_date_range(version)
+    return Dataset(geo, spatial_index, min_date, max_date, version)
+
+# The data is the same for every user, so it's loaded once per process (or once per gunicorn
+# master, see gunicorn_config.py) and kept in memory, not pulled and cached per session. Each
+# load is followed by warming the cache (see warmer below).
+# The keys of the memoized results, by the version of the data they were computed from
+version_keys = VersionKeys(f"{cache.config['CACHE_DIR']}.keys")
+
+def collect_old_versions(loaded):
+    """
+    Once a new version of the data is current, delete what was computed from the other ones:
+    their memoized results (their keys have the old version, so nothing would read them again)
+    and their exports. Results of the current version, and anything else in the cache, are
+    kept, so a reload that found the same data keeps everything, and so does a restart.
+    Results of an old version written after this (by a worker or job still on it) are
+    deleted on the next load.
+    """
+    for version in version_keys.versions():
+        if version != loaded.version:
+            cache.delete_many(*version_keys.pop(version))
+    remove_old_artifacts(loaded.version)
+
+def on_dataset_load(loaded):
+    collect_old_versions(loaded)
+    if WARM_ON_LOAD:
+        warmer.start(loaded)
 
+dataset = DatasetStore(load_dataset, on_load = on_dataset_load)
+
+def query_geo_data():
+    return dataset.get().geo
+
+def query_spatial_index():
+    return dataset.get().spatial_index
+
+def filter_ourfish_data(sel_maa, start_date, end_date, version):
+    """
+    Read the records for the selected MAA's and dates from the snapshot of `version`, as an
+    arrow table. Only the files of the MAA's countries and the selected months are read, and
+    only the columns the outputs use.
+    """
+    current = dataset.get()
+    with timed_stage('read-snapshot'):
+        return query_snapshot_table(
+            sel_maa, start_date, end_date,
+            columns = OUTPUT_COLUMNS,
+            countries = get_maa_countries(current.geo["maa"], sel_maa),
+            version = version
+        )
+
+def normalize_view(sel_maa, start_date, end_date, version = None):
+    """
+    The selected MAA's as a sorted list of ints, whatever order and type they come in (a
+    dropdown's list, a Series from the geo tables), so a view has one cache entry; and the
+    version of the data (default: the current one), so a new version never gets results
+    computed from an old one
+    """
+    return sorted(set(int(m) for m in sel_maa)), start_date, end_date, version or dataset.get().version
+
+apply_filters_cache = CacheTracker('apply_filters')
+query_map_data_cache = CacheTracker('query_map_data')
+
+@normalized(normalize_view)
+@apply_filters_cache.calls
+@version_keys.tracked
+@single_flight
 @cache.memoize()
-def apply_filters(session_id, sel_maa, start_date, end_date):
+@apply_filters_cache.misses
+@profiled('apply_filters')
+def apply_filters(sel_maa, start_date, end_date, version = None):
     """
-    Pull full cached DW dataset then filter it. Compute and return data for plots, highlights, and map.
-    The output is memoized according to the unique user and filters.
+    Read the filtered records from the snapshot. Compute and return data for plots, highlights, and map.
+    The output is memoized according to the filters and the data's version, and shared by every user.
     Notice we don't return the filtered data -- ultimately what we care about pulling from cache
     is not the filtered data but the numbers we get from processing that filtered data. That is
     what actually goes on the plots, map, highlights, and download file.
     """
-    all_data = query_ourfish_data(session_id) # from cache
-    filtered_data = all_data.query(
-        "ma_id.isin(list(@sel_maa)) & \
-        @start_date <= date & \
-        date <= @end_date"
-    )
-    geo = query_geo_data(session_id) # from cache
+    filtered_data = filter_ourfish_data(sel_maa, start_date, end_date, version)
+    step("Read the records")
+    geo = query_geo_data()
 
-    output_data = {}
-    output_data["map"] = get_map_data(filtered_data, geo["comm"])
-    output_data["catch"] = get_catch_data(filtered_data)
-    output_data["cpue-value"] = get_cpue_value_data(filtered_data)
-    output_data["length"] = get_length_data(filtered_data)
-    output_data["composition"] = get_composition_data(filtered_data)
-    output_data["highlights"] = get_highlights_data(filtered_data)
+    return compute_output_data(filtered_data, geo["comm"])
 
-    return output_data
+@normalized(normalize_view)
+@query_map_data_cache.calls
+@version_keys.tracked
+@single_flight
+@cache.memoize()
+@query_map_data_cache.misses
+@profiled('query_map_data')
+def query_map_data(sel_maa, start_date, end_date, version = None):
+    """
+    Per-community totals for the map. This is memoized apart from apply_filters so that
+    moving around the map only pulls this small table, never the plot aggregates.
+    """
+    filtered_data = filter_ourfish_data(sel_maa, start_date, end_date, version)
+    geo = query_geo_data()
+    return compute_map_data(filtered_data, geo["comm"])
+
+def get_default_view(current):
+    """
+    The view every session opens on: all MAA's over the last 6 months of data
+    """
+    end_date = current.max_date
+    if end_date.month >= 6:
+        start_date = datetime.date(end_date.year, end_date.month - 5, 1)
+    else:
+        start_date = datetime.date(end_date.year - 1, end_date.month + 7, 1)
+    return list(current.geo["maa"]["ma_id"]), start_date, end_date
+
+def get_warm_views(current):
+    """
+    Views to precompute after a load, highest priority first: the default view, each country's
+    MAA's over the default dates, then the views most requested lately (see view_stats)
+    """
+    maa = current.geo["maa"]
+    sel_maa, start_date, end_date = get_default_view(current)
+    views = [('default', sel_maa, start_date, end_date)]
+    for country_id, country_name in zip(current.geo["country"]["country_id"], current.geo["country"]["country_name"]):
+        views.append((f'country {country_name}', list(maa.loc[maa['country_id'] == country_id, 'ma_id']), start_date, end_date))
+    for sel_maa, start_date, end_date in view_stats.top():
+        views.append(('requested', sel_maa, datetime.date.fromisoformat(start_date), datetime.date.fromisoformat(end_date)))
+
+    # The same view can come up twice, e.g. a country that's most of the data
+    seen = set()
+    unique_views = []
+    for name, sel_maa, start_date, end_date in views:
+        key = str(normalize_view(sel_maa, start_date, end_date))
+        if key not in seen:
+            seen.add(key)
+            unique_views.append((name, sel_maa, start_date, end_date))
+    return unique_views
+
+def warm_view(view):
+    """
+    Compute and cache the plots' and the map's data for a view, unless they already are
+    """
+    _, sel_maa, start_date, end_date = view
+    computed = False
+    for memoized in (apply_filters, query_map_data):
+        if not cache.has(memoized.make_cache_key(memoized.uncached, sel_maa, start_date, end_date)):
+            memoized(sel_maa, start_date, end_date)
+            computed = True
+    return computed
+
+# Which views users ask for, for warming the most requested ones
+view_stats = ViewStats()
+warmer = CacheWarmer(get_warm_views, warm_view)
+
+# Background jobs for work too slow to do inside a callback. Workers are hosted by
+# jobs_worker.py; with none running, callbacks do the work inline as before.
+jobs = JobQueue()
+# Selections spanning more days than this are computed by a job, if they aren't cached
+JOBS_HEAVY_DAYS = int(os.environ.get('JOBS_HEAVY_DAYS', 365))
+
+def is_heavy_selection(start_date, end_date):
+    return (end_date - start_date).days > JOBS_HEAVY_DAYS
+
+@jobs.task("apply-filters")
+def apply_filters_task(params, progress):
+    """
+    Compute (and cache) apply_filters for a selection, for update_plots to pick up
+    """
+    # Reading the records, then each of the outputs (see get_output_data)
+    with progress_steps(progress, 1 + len(SHEET_NAMES)):
+        apply_filters(
+            params['sel_maa'],
+            datetime.date.fromisoformat(params['start_date']),
+            datetime.date.fromisoformat(params['end_date']),
+            params.get('version')
+        )
+
+@jobs.task("export")
+def export_task(params, progress):
+    """
+    Write an Excel export for trigger_download. Returns the export key.
+    """
+    path = get_export_path(params['key'], 'xlsx')
+    if not os.path.exists(path):
+        # As apply_filters_task, then a sheet per output (see write_workbook)
+        with progress_steps(progress, 1 + 2 * len(SHEET_NAMES)):
+            write_export(
+                params['sel_country'], params['sel_snu'], params['sel_lgu'], params['sel_maa'],
+                datetime.date.fromisoformat(params['start_date']),
+                datetime.date.fromisoformat(params['end_date']),
+                path,
+                params.get('version')
+            )
+    return {'key': params['key']}
+
+def get_fingerprints(output_data):
+    """
+    Hash each of the plot/highlight tables in `output_data`. The fingerprints of what was last
+    sent to a session are cached, so update_plots can skip outputs that haven't changed.
+    """
+    fingerprints = {}
+    for k in ["catch", "cpue-value", "length", "composition", "highlights"]:
+        hashed = pd.util.hash_pandas_object(output_data[k], index = False)
+        fingerprints[k] = hashlib.sha1(hashed.values.tobytes()).hexdigest()
+
+    return fingerprints
 
 server = app.server
 def serve_layout():
@@ -144,8 +375,8 @@ def serve_layout():
     """
     session_id = str(uuid.uuid4())
 
-    all_data = query_ourfish_data(session_id)
-    geo = query_geo_data(session_id)
+    current = dataset.get()
+    geo = current.geo
     countries = geo["country"]
     snu = geo["snu"]
     lgu = geo["lgu"]
@@ -153,20 +384,19 @@ def serve_layout():
     comm = geo["comm"]
     
     # choose start and end dates to initially show the past 6 months of data
-    end_date = all_data['date'].max()
-    if end_date.month >= 6:
-        start_date = datetime.date(end_date.year, end_date.month - 5, 1)
-    else:
-        start_date = datetime.date(end_date.year - 1, end_date.month + 7, 1)
+    sel_maa, start_date, end_date = get_default_view(current)
     
-    output_data = apply_filters(session_id, maa["ma_id"], start_date, end_date)
+    output_data = apply_filters(sel_maa, start_date, end_date)
     plot_data = {k: output_data[k] for k in ["catch", "cpue-value", "length", "composition"]}
+    session_cache.set(f"fingerprints-{session_id}", get_fingerprints(output_data))
 
     # Min/max dates to show on calendar
-    min_date = all_data["date"].min()
+    min_date = current.min_date
     max_date = end_date
 
-    map_div = start_map(output_data["map"], comm)
+    spatial_index = query_spatial_index()
+
+    map_div = start_map(output_data["map"], spatial_index)
     filter_div = start_filters(min_date, max_date, countries)
     plot_div = start_plot(plot_data)
     download_div = start_download_button()
@@ -190,11 +420,13 @@ app.layout = serve_layout
     Input("country-input", 'value'),
     State("session-id", "children")
 )
+@timed_callback('sync_country_select_all')
+@profiled('sync_country_select_all')
 def sync_country_select_all(all_selected, sel_country, session_id):
     """
     Sync country selections with 'select all' checkbox
     """
-    countries = query_geo_data(session_id)["country"]
+    countries = query_geo_data()["country"]
     ctx = callback_context
     triggered_id = ctx.triggered[0]['prop_id'].split('.')[0]
     all_countries = list(countries['country_name'])
@@ -211,6 +443,8 @@ def sync_country_select_all(all_selected, sel_country, session_id):
     State("snu-input", 'options'),
     State("session-id", "children")
 )
+@timed_callback('update_snu')
+@profiled('update_snu')
 def update_snu(snu_all_selected, sel_snu, sel_country_names, state_opt_snu_dict, session_id):
     """
     This callback will handle the following events:
@@ -223,8 +457,8 @@ def update_snu(snu_all_selected, sel_snu, sel_country_names, state_opt_snu_dict,
         (a) if 'Select all' checkbox changes, update SNU selections accordingly
         (b) if SNU selections change, update 'Select all' checkbox accordingly
     """
-    countries = query_geo_data(session_id)["country"]
-    snu = query_geo_data(session_id)["snu"]
+    countries = query_geo_data()["country"]
+    snu = query_geo_data()["snu"]
     ctx = callback_context
     triggered_id = ctx.triggered[0]['prop_id'].split('.')[0]
     sel_country = list(countries.query("country_name.isin(@sel_country_names)")['country_id'])
@@ -264,6 +498,8 @@ def update_snu(snu_all_selected, sel_snu, sel_country_names, state_opt_snu_dict,
     State("lgu-input", 'options'),
     State("session-id", "children")
 )
+@timed_callback('update_lgu')
+@profiled('update_lgu')
 def update_lgu(lgu_all_selected, sel_lgu, sel_snu, state_opt_lgu_dict, session_id):
     """
     This callback will handle the following events:
@@ -276,7 +512,7 @@ def update_lgu(lgu_all_selected, sel_lgu, sel_snu, state_opt_lgu_dict, session_i
         (a) if 'Select all' checkbox changes, update LGU selections accordingly
         (b) if LGU selections change, update 'Select all' checkbox accordingly
     """
-    lgu = query_geo_data(session_id)["lgu"]
+    lgu = query_geo_data()["lgu"]
     ctx = callback_context
     triggered_id = ctx.triggered[0]['prop_id'].split('.')[0]
     all_lgu = list(lgu.query("snu_id.isin(@sel_snu)")['lgu_id'])
@@ -309,8 +545,10 @@ def update_lgu(lgu_all_selected, sel_lgu, sel_snu, state_opt_lgu_dict, session_i
     State("maa-input", 'options'),
     State("session-id", "children")
 )
+@timed_callback('update_maa')
+@profiled('update_maa')
 def update_maa(maa_all_selected, sel_maa, sel_lgu, state_opt_maa_dict, session_id):
-    maa = query_geo_data(session_id)["maa"]
+    maa = query_geo_data()["maa"]
     ctx = callback_context
     triggered_id = ctx.triggered[0]['prop_id'].split('.')[0]
     all_maa = list(maa.query("lgu_id.isin(@sel_lgu)")['ma_id'])
@@ -337,86 +575,160 @@ def update_maa(maa_all_selected, sel_maa, sel_lgu, state_opt_maa_dict, session_i
     Output("length-plot", 'figure'),
     Output("composition-plot", 'figure'),
     Output("highlights-container", 'children'),
+    Output("plots-job", 'data'),
+    Output("plots-job-interval", 'disabled'),
+    Output("plots-status", 'children'),
     Input("update-button", 'n_clicks'),
+    Input("plots-job-interval", 'n_intervals'),
+    State("plots-job", 'data'),
     State("session-id", "children"),
     State("maa-input", "value"),
     State("date-range-input", "start_date"),
     State("date-range-input", "end_date"),
     prevent_initial_call = True
 )
-def update_plots(n_clicks, session_id, sel_maa, start_date, end_date):
+@timed_callback('update_plots')
+@profiled('update_plots')
+def update_plots(n_clicks, n_intervals, plots_job, session_id, sel_maa, start_date, end_date):
+    """
+    Redraw the plots and highlights for the selected filters.
+
+    Big selections that aren't cached yet are computed by a background job when job workers are
+    running: the button submits the job, then the interval polls it and draws the plots once the
+    job has cached the output.
+    """
+    ctx = callback_context
+    triggered_id = ctx.triggered[0]['prop_id'].split('.')[0]
+    no_outputs = [no_update] * 5
+
+    if triggered_id == "plots-job-interval":
+        job = jobs.get(plots_job['id'])
+        if job is None or job['status'] == 'failed':
+            return no_outputs + [None, True, "Sorry, something went wrong. Please try again."]
+        if job['status'] != 'done':
+            return no_outputs + [no_update, no_update, f"{job['message']} ({job['progress']:.0%})"]
+        # The job is done, so apply_filters below reads its output from cache. Filters
+        # changed since the job was submitted wait for the next click.
+        sel_maa = plots_job['params']['sel_maa']
+        start_date = plots_job['params']['start_date']
+        end_date = plots_job['params']['end_date']
+
     start_date = datetime.date.fromisoformat(start_date)
     end_date = datetime.date.fromisoformat(end_date)
 
+    if triggered_id == "update-button" and is_heavy_selection(start_date, end_date) and jobs.has_workers():
+        version = dataset.get().version
+        cache_key = apply_filters.make_cache_key(apply_filters.uncached, sel_maa, start_date, end_date, version)
+        if not cache.has(cache_key):
+            params = {
+                'sel_maa': sel_maa,
+                'start_date': start_date.isoformat(),
+                'end_date': end_date.isoformat(),
+                'version': version
+            }
+            plots_job = {'id': jobs.submit("apply-filters", params), 'params': params}
+            return no_outputs + [plots_job, False, "Queued"]
+
     # I THINK this callback runs first instead of update_map, so running apply_filters
     # here will calculate the new output data then cache it.
-    output_data = apply_filters(session_id, sel_maa, start_date, end_date)
+    output_data = apply_filters(sel_maa, start_date, end_date)
+    view_stats.record(sel_maa, start_date, end_date)
+
+    # Only rebuild and send the outputs that differ from what this session already shows,
+    # e.g. re-applying the same filters sends nothing back
+    fingerprints = get_fingerprints(output_data)
+    sent_fingerprints = session_cache.get(f"fingerprints-{session_id}") or {}
+    session_cache.set(f"fingerprints-{session_id}", fingerprints)
+    changed = {k: fingerprints[k] != sent_fingerprints.get(k) for k in fingerprints}
 
-    catch_fig = make_catch_fig(output_data["catch"])
-    cpue_value_fig = make_cpue_value_fig(output_data["cpue-value"])
-    length_fig = make_length_fig(output_data["length"])
-    composition_fig = make_composition_fig(output_data["composition"])
+    catch_fig = make_catch_fig(output_data["catch"]) if changed["catch"] else no_update
+    cpue_value_fig = make_cpue_value_fig(output_data["cpue-value"]) if changed["cpue-value"] else no_update
+    length_fig = make_length_fig(output_data["length"]) if changed["length"] else no_update
+    composition_fig = make_composition_fig(output_data["composition"]) if changed["composition"] else no_update
 
-    highlights_data = output_data["highlights"]
-    highlights_children = [
-        create_card(highlights_data.loc[0, 'weight'], "Total weight (mt)"),
-        create_card(highlights_data.loc[0, 'value'], "Total value (USD)"),
-        create_card(highlights_data.loc[0, 'trips'], "Total #trips"),
-        create_card(highlights_data.loc[0, 'fishers'], "Fishers recorded"),
-        create_card(highlights_data.loc[0, 'buyers'], "Total buyers"),
-        create_card(highlights_data.loc[0, 'female buyers'], "Total female buyers"),
-    ]
+    if changed["highlights"]:
+        highlights_data = output_data["highlights"]
+        highlights_children = [
+            create_card(highlights_data.loc[0, 'weight'], "Total weight (mt)"),
+            create_card(highlights_data.loc[0, 'value'], "Total value (USD)"),
+            create_card(highlights_data.loc[0, 'trips'], "Total #trips"),
+            create_card(highlights_data.loc[0, 'fishers'], "Fishers recorded"),
+            create_card(highlights_data.loc[0, 'buyers'], "Total buyers"),
+            create_card(highlights_data.loc[0, 'female buyers'], "Total female buyers"),
+        ]
+    else:
+        highlights_children = no_update
 
-    return catch_fig, cpue_value_fig, length_fig, composition_fig, highlights_children
+    return catch_fig, cpue_value_fig, length_fig, composition_fig, highlights_children, None, True, ""
 
 @app.callback(
     Output("fish-map", 'figure'),
+    Output("map-view", 'data'),
     Input("fish-map", 'clickData'),
     Input("update-button", 'n_clicks'),
+    Input("fish-map", 'relayoutData'),
+    State("map-view", 'data'),
     State("session-id", "children"),
     State("maa-input", 'value'),
     State("date-range-input", 'start_date'),
     State("date-range-input", 'end_date'),
     prevent_initial_call = True
 )
-def update_map(mapClickData, update_clicks, session_id, sel_maa, start_date, end_date):
+@timed_callback('update_map')
+@profiled('update_map')
+def update_map(mapClickData, update_clicks, relayout_data, map_view, session_id, sel_maa, start_date, end_date):
+    """
+    Redraw the map when filters are applied or the view changes. Only the per-community map data
+    is pulled (see query_map_data), so moving the map never touches the plot aggregates.
+
+    (1) Apply filters - fit the view to the filtered communities.
+    (2) Click - recenter on the clicked community/cluster and zoom in so clusters split apart.
+    (3) Pan/zoom - redraw only if the view left the communities already on the map or crossed
+        into a different cluster resolution.
+    """
     ctx = callback_context
-    triggered_id = ctx.triggered[0]['prop_id'].split('.')[0]
+    triggered_prop = ctx.triggered[0]['prop_id']
+    start_date = datetime.date.fromisoformat(start_date)
+    end_date = datetime.date.fromisoformat(end_date)
 
-    if triggered_id == "fish-map":
-        # TODO update this. There used to be a map dcc.Graph object imported from mod_map that
-        # would work with the code here.
-        # zoom in on the point that was clicked
-        sel_lat = mapClickData['points'][0]['lat']
-        sel_lon = mapClickData['points'][0]['lon']
-
-        fig = map.figure
-        fig.update_layout(
-            mapbox = {
-                'center': {
-                    'lat': sel_lat,
-                    'lon': sel_lon,
-                },
-                'zoom': 5
-            }
-        )
-    elif triggered_id == "update-button":
-        # Update points and fit the zoom to the filtered points
-        start_date = datetime.date.fromisoformat(start_date)
-        end_date = datetime.date.fromisoformat(end_date)
+    if triggered_prop == "update-button.n_clicks":
+        map_data = query_map_data(sel_maa, start_date, end_date)
+        center, zoom = get_map_view(map_data)
+        bounds = get_bounds(center, zoom)
+    elif triggered_prop == "fish-map.clickData":
+        map_data = query_map_data(sel_maa, start_date, end_date)
+        sel_point = mapClickData['points'][0]
+        center = {'lat': sel_point['lat'], 'lon': sel_point['lon']}
+        zoom = map_view['zoom']
+        if zoom < EXPAND_ZOOM:
+            zoom = min(zoom + 2, EXPAND_ZOOM)
+        bounds = get_bounds(center, zoom)
+    else:
+        viewport = get_viewport(relayout_data)
+        if viewport is None:
+            return no_update, no_update
+        center, zoom, bounds = viewport
 
-        # Pull map data from cache; I think the update_plots callback goes first so the output data
-        # has already been updated and cached.
-        map_data = apply_filters(session_id, sel_maa, start_date, end_date)["map"]
+        level = get_cluster_level(zoom)
+        if level == map_view['level'] and contains_bounds(map_view['bounds'], bounds):
+            # Everything in view is already drawn; just remember the zoom for the next click
+            return no_update, dict(map_view, zoom = zoom)
+        map_data = query_map_data(sel_maa, start_date, end_date)
 
-        fig = make_map(map_data, mapbox_url)
+    bounds = pad_bounds(bounds)
+    spatial_index = query_spatial_index()
+    cluster_data = get_cluster_data(map_data, spatial_index, zoom, bounds)
+    fig = make_map(cluster_data, mapbox_url, center, zoom)
+    map_view = {'zoom': zoom, 'level': get_cluster_level(zoom), 'bounds': bounds}
 
-    return fig
+    return fig, map_view
 
 @app.callback(
     Output('filter-inputs', 'style'),
     Input('filter-inputs-toggle', 'n_clicks')
 )
+@timed_callback('toggle_filter_display')
+@profiled('toggle_filter_display')
 def toggle_filter_display(n_clicks):
     if n_clicks is None or n_clicks % 2 == 0:
         style = {"display": "none"}
@@ -429,6 +741,8 @@ def toggle_filter_display(n_clicks):
     Output('plot-displays', 'style'),
     Input('plots-toggle', 'n_clicks')
 )
+@timed_callback('toggle_plot_display')
+@profiled('toggle_plot_display')
 def toggle_plot_display(n_clicks):
     if n_clicks is None or n_clicks % 2 == 0:
         style = {"display": "block"}
@@ -437,9 +751,31 @@ def toggle_plot_display(n_clicks):
 
     return style
 
+@profiled('write_export')
+def write_export(sel_country, sel_snu, sel_lgu, sel_maa, start_date, end_date, path, version = None):
+    """
+    Write the Excel export of the filtered data (of `version`, default: the current one) plus a
+    metadata sheet to `path`
+    """
+    # Pull the cached filtered data
+    output_data = apply_filters(sel_maa, start_date, end_date, version)
+
+    # Before finishing, we'll add metadata
+    geo = query_geo_data()
+    metadata = get_export_metadata(geo, sel_country, sel_snu, sel_lgu, sel_maa, start_date, end_date)
+
+    tmp_path = new_tmp_path(path)
+    write_workbook(tmp_path, output_data, metadata)
+    save_artifact(tmp_path, path)
+
 @app.callback(
-    Output('download-data', 'data'),
+    Output('download-location', 'href'),
+    Output('download-job', 'data'),
+    Output('download-job-interval', 'disabled'),
+    Output('download-status', 'children'),
     Input('btn-download', 'n_clicks'),
+    Input('download-job-interval', 'n_intervals'),
+    State('download-job', 'data'),
     State("session-id", "children"),
     State("country-input", 'value'),
     State("snu-input", 'value'),
@@ -449,58 +785,302 @@ def toggle_plot_display(n_clicks):
     State("date-range-input", 'end_date'),
     prevent_initial_call = True
 )
-def trigger_download(n_clicks, session_id, sel_country, sel_snu, sel_lgu, sel_maa, start_date, end_date):
-    output = io.BytesIO()
-    writer = pd.ExcelWriter(output, engine = 'xlsxwriter')
+@timed_callback('trigger_download')
+@profiled('trigger_download')
+def trigger_download(n_clicks, n_intervals, download_job, session_id, sel_country, sel_snu, sel_lgu, sel_maa, start_date, end_date):
+    """
+    Send the browser to the route that serves the Excel export of the filtered data
+    (serve_download). The export is only written if no one has downloaded the same view of the
+    same data before. When job workers are running it's written by a background job, which the
+    interval polls until the file is ready.
+    """
+    ctx = callback_context
+    triggered_id = ctx.triggered[0]['prop_id'].split('.')[0]
+
+    if triggered_id == 'download-job-interval':
+        job = jobs.get(download_job['id'])
+        if job is None or job['status'] == 'failed':
+            return no_update, None, True, "Sorry, the download failed. Please try again."
+        if job['status'] != 'done':
+            return no_update, no_update, no_update, f"{job['message']} ({job['progress']:.0%})"
+        # n_intervals makes the url change on every download, so the browser follows it again
+        return app.get_relative_path(f"/download/{job['result']['key']}?n={n_intervals}"), None, True, ""
 
     start_date = datetime.date.fromisoformat(start_date)
     end_date = datetime.date.fromisoformat(end_date)
 
-    # Pull the cached filtered data
-    output_data = apply_filters(session_id, sel_maa, start_date, end_date)
-
-    sheet_names = {
-        "highlights": "Totals",
-        "catch": "Catches",
-        "cpue-value": "CPUE-Value",
-        "length": "Length",
-        "composition": "Catch composition",
-        "map": "Communities"
+    version = dataset.get().version
+    key = get_export_key(
+        version, 'xlsx',
+        country = sel_country, snu = sel_snu, lgu = sel_lgu, maa = sel_maa,
+        start_date = start_date, end_date = end_date
+    )
+    path = get_export_path(key, 'xlsx')
+
+    if not os.path.exists(path):
+        if jobs.has_workers():
+            job_id = jobs.submit("export", {
+                'sel_country': sel_country,
+                'sel_snu': sel_snu,
+                'sel_lgu': sel_lgu,
+                'sel_maa': sel_maa,
+                'start_date': start_date.isoformat(),
+                'end_date': end_date.isoformat(),
+                'key': key,
+                'version': version
+            })
+            return no_update, {'id': job_id}, False, "Preparing download"
+
+        write_export(sel_country, sel_snu, sel_lgu, sel_maa, start_date, end_date, path, version)
+
+    # n_clicks makes the url change on every click, so the browser follows it again
+    return app.get_relative_path(f"/download/{key}?n={n_clicks}"), None, True, ""
+
+@app.callback(
+    Output('records-download-location', 'href'),
+    Input('btn-download-records', 'n_clicks'),
+    State("maa-input", 'value'),
+    State("date-range-input", 'start_date'),
+    State("date-range-input", 'end_date'),
+    State("records-format", 'value'),
+    prevent_initial_call = True
+)
+@timed_callback('trigger_records_download')
+@profiled('trigger_records_download')
+def trigger_records_download(n_clicks, sel_maa, start_date, end_date, records_format):
+    """
+    Send the browser to the route that streams the raw records (serve_records_download). The
+    selection is cached under a token rather than put in the url, which could get too long
+    for the server with many MAA's selected.
+    """
+    token = uuid.uuid4().hex
+    session_cache.set(f"records-{token}", {
+        'sel_maa': sel_maa,
+        'start_date': datetime.date.fromisoformat(start_date),
+        'end_date': datetime.date.fromisoformat(end_date),
+        'format': records_format
+    }, timeout = EXPORT_MAX_AGE)
+
+    return app.get_relative_path(f"/download/records/{token}")
+
+@server.route("/download/<key>")
+def serve_download(key):
+    """
+    Serve an Excel export saved by trigger_download
+    """
+    path = get_export_path(key, 'xlsx')
+    if path is None or not os.path.exists(path):
+        abort(404)
+
+    return send_artifact(path, key, 'fisheries-data.xlsx', XLSX_MIMETYPE)
+
+@server.route("/download/records/<token>")
+def serve_records_download(token):
+    """
+    Stream the OurFish records for a selection saved by trigger_records_download, as gzip'd CSV or
+    parquet. Records are read from the snapshot one batch at a time, so neither the filtered
+    records nor the file are ever held in memory whole. The file is saved as it's sent, and
+    later downloads of the same selection are served from disk.
+    """
+    selection = session_cache.get(f"records-{token}")
+    current = dataset.get()
+    if selection is None or get_snapshot_dataset(current.version) is None:
+        abort(404)
+
+    records_format = selection['format']
+    download_name, mimetype = RECORD_FORMATS[records_format]
+    key = get_export_key(
+        current.version, records_format,
+        maa = selection['sel_maa'], start_date = selection['start_date'], end_date = selection['end_date']
+    )
+    path = get_export_path(key, records_format)
+    if os.path.exists(path):
+        return send_artifact(path, key, download_name, mimetype)
+
+    batches = iter_snapshot_batches(
+        selection['sel_maa'], selection['start_date'], selection['end_date'],
+        columns = OURFISH_COLUMNS,
+        countries = get_maa_countries(current.geo["maa"], selection['sel_maa']),
+        version = current.version
+    )
+    if records_format == 'parquet':
+        content = stream_records_parquet(batches, get_snapshot_schema(OURFISH_COLUMNS, current.version))
+    else:
+        content = stream_records_csv(batches, OURFISH_COLUMNS)
+
+    response = Response(
+        tee_to_artifact(content, path),
+        mimetype = mimetype,
+        headers = {'Content-Disposition': f'attachment; filename="{download_name}"'}
+    )
+    response.set_etag(key)
+
+    return response
+
+def get_metrics_state():
+    return {
+        'dataset': dataset.current,
+        'caches': {
+            'memoize': cache.config['CACHE_DIR'],
+            'sessions': session_cache.config['CACHE_DIR'],
+            'exports': EXPORT_DIR
+        }
     }
-    
-    for d in output_data.items():
-        # d: ('df_name', df)
-        d[1].to_excel(writer, sheet_name = sheet_names[d[0]], index = False)
 
-    # Before finishing, we'll add metadata. And before that, we need names for geographic info,
-    # not just the id's
+@server.route("/metrics")
+def serve_metrics():
+    """
+    Callback latencies, per-stage timings, cache hits and misses, and the dataset's version and
+    age, in Prometheus text format (see utils_metrics.py). Set METRICS_TOKEN to scrape it from
+    another machine.
+    """
+    if not is_allowed(request.remote_addr, request.headers.get('Authorization')):
+        abort(403)
+    body, content_type = render_metrics(get_metrics_state)
 
-    geo = query_geo_data(session_id)
-    snu = geo["snu"]
-    lgu = geo["lgu"]
-    maa = geo["maa"]
-    snu_names = list(snu.query("snu_id.isin(@sel_snu)")['snu_name'])
-    lgu_names = list(lgu.query("lgu_id.isin(@sel_lgu)")['lgu_name'])
-    maa_names = list(maa.query("ma_id.isin(@sel_maa)")['ma_name'])
-
-    metadata = pd.DataFrame({
-        'FILTER': ['country', 'snu', 'lgu', 'maa', 'start date', 'end date'],
-        'VALUE': [
-            ', '.join(sel_country),
-            ', '.join(snu_names),
-            ', '.join(lgu_names),
-            ', '.join(maa_names),
-            start_date, end_date
-        ]
+    return Response(body, content_type = content_type)
+
+def report_memory():
+    """
+    Where this process's memory goes: each dataset still in memory, the cache tiers and the
+    in-process caches (see utils_memory.get_memory_report)
+    """
+    return get_memory_report(
+        live_datasets, dataset.current,
+        caches = {
+            'memoize': cache.config['CACHE_DIR'],
+            'sessions': session_cache.config['CACHE_DIR']
+        },
+        directories = {'exports': EXPORT_DIR, 'snapshots': SNAPSHOT_DIR, 'jobs': JOBS_DIR},
+        lru_caches = {
+            'open_snapshot': open_snapshot,
+            'get_fig_template': get_fig_template,
+            'get_map_layout': get_map_layout
+        }
+    )
+
+@server.route("/admin/memory")
+def serve_memory_report():
+    """
+    report_memory as JSON, for the worker that answers. Same access rule as /metrics.
+    """
+    if not is_allowed(request.remote_addr, request.headers.get('Authorization')):
+        abort(403)
+
+    return report_memory()
+
+def get_readiness():
+    """
+    Whether this process can answer quickly: the dataset is loaded, the spatial index and the
+    snapshot it reads from are there, and warming the cache is over (done, failed or turned
+    off). Returns (ready, checks), the checks being a dict of what was looked at.
+
+    Example output:
+    (False, {
+        'dataset': {'loaded': True, 'version': 'dacbdca0af2a4e77', 'loaded_at': 1792421007.3, 'age': 12.5, 'stale': False},
+        'spatial_index': {'built': True, 'communities': 2592},
+        'snapshot': {'available': True},
+        'warming': {'state': 'running', 'version': 'dacbdca0af2a4e77', 'started_at': 1792421007.4, ...}
     })
+    """
+    # Never dataset.get(): a probe mustn't be the one that waits for the data to load
+    current = dataset.current
+    if current is None:
+        return False, {'dataset': {'loaded': False}}
+
+    spatial_index = current.spatial_index
+    warming = dict(warmer.status)
+    checks = {
+        'dataset': {
+            'loaded': True,
+            'version': current.version,
+            'loaded_at': current.loaded_at,
+            'age': round(current.age(), 1),
+            'stale': current.age() > dataset.max_age
+        },
+        'spatial_index': {
+            'built': spatial_index is not None,
+            'communities': 0 if spatial_index is None else len(spatial_index)
+        },
+        'snapshot': {'available': get_snapshot_dataset(current.version) is not None},
+        'warming': warming
+    }
+    # Warming of an older version doesn't count: the cache is being warmed for this one next
+    warmed = warming['state'] in ('idle', 'done', 'failed') and warming['version'] in (None, current.version)
+    ready = checks['spatial_index']['built'] and checks['snapshot']['available'] and warmed
+    return ready, checks
 
-    metadata.to_excel(writer, sheet_name = 'metadata', index = False)
+@server.route("/healthz")
+def serve_liveness():
+    """
+    Liveness: the process is up and answering, whatever state the data is in
+    """
+    response = server.make_response({'status': 'ok', 'pid': os.getpid()})
+    response.cache_control.no_store = True
+    return response
+
+@server.route("/readyz")
+def serve_readiness():
+    """
+    Readiness for the load balancer: 200 once get_readiness says the worker that answers can
+    answer quickly, 503 until then, with the checks either way
+    """
+    ready, checks = get_readiness()
+    response = server.make_response(({'ready': ready, 'pid': os.getpid(), 'checks': checks}, 200 if ready else 503))
+    response.cache_control.no_store = True
+    return response
 
-    writer.save()
-    output_data = output.getvalue()
-    output.close()
+@server.route("/api/v1/<output>")
+def serve_api(output):
+    """
+    Read-only API for the aggregates behind the dashboard, e.g.
+
+        /api/v1/catch?country=6&start=2023-01-01&end=2023-06-30&format=arrow
+
+    `output` is one of API_OUTPUTS. The filters are described in utils_api.parse_filters, and
+    format is json (default) or arrow. The ETag is a hash of the dataset version and the request,
+    so clients and proxies can revalidate cheaply: a matching If-None-Match gets a 304 without
+    anything being computed.
+    """
+    if output not in API_OUTPUTS:
+        abort(404)
+    api_format = request.args.get('format', 'json')
+    if api_format not in API_FORMATS:
+        abort(400, f"format must be one of {', '.join(API_FORMATS)}")
+
+    current = dataset.get()
+    geo = current.geo
+    min_date, max_date = current.min_date, current.max_date
+    try:
+        sel_maa, start_date, end_date = parse_filters(request.args, geo, min_date, max_date)
+    except ApiError as e:
+        abort(400, str(e))
+
+    version = current.version
+    etag = get_export_key(
+        version, f'api-{output}-{api_format}',
+        maa = sel_maa, start_date = start_date, end_date = end_date
+    )
+
+    response = Response(mimetype = API_FORMATS[api_format])
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = API_MAX_AGE
+    # The data is public, so the portal can fetch it from the browser
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    if etag in request.if_none_match:
+        response.status_code = 304
+        return response
+
+    data = apply_filters(sel_maa, start_date, end_date, version)[output]
+    view_stats.record(sel_maa, start_date, end_date)
+    if api_format == 'arrow':
+        response.set_data(to_arrow_stream(data, output, version))
+    else:
+        filters = {'maa': sel_maa, 'start': start_date.isoformat(), 'end': end_date.isoformat()}
+        response.set_data(to_json(data, output, version, filters))
 
-    return dcc.send_bytes(output_data, 'fisheries-data.xlsx')
+    return response
 
 if __name__ == '__main__':
     app.run_server(debug=False)
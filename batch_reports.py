@@ -0,0 +1,163 @@
+"""
+Write the Excel export of every country and every MAA for a month (or any date range) in one go,
+instead of selecting each one in the dashboard and clicking download:
+
+    python batch_reports.py --month 2023-04 --output reports
+
+gives reports/2023-04/<country>/<country>.xlsx and reports/2023-04/<country>/<maa>-<ma_id>.xlsx
+(the id keeps apart MAA's with the same name), with the same sheets as the dashboard's download.
+Units with no records in the range are skipped.
+
+The data is pulled into the local snapshot (or, with --snapshot, the existing one is used),
+then the date range is read from it once and split by MAA once; each unit's outputs are
+computed from its share of that split (a country's is the union of its MAA's), and the units
+are spread over worker processes.
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import re
+import time
+import pandas as pd
+from mod_dataworld import get_ourfish_data, get_geo_data, GEO_COLUMNS
+from utils_download import get_export_metadata, write_workbook
+from utils_query import get_output_data, OUTPUT_COLUMNS
+from utils_snapshot import write_snapshot, read_snapshot, read_snapshot_distinct, get_snapshot_dataset
+
+# Set in each worker process by init_worker: the records of the date range split by MAA, and
+# the tables from get_geo_data
+maa_data = None
+geo = None
+
+def init_worker(shared_maa_data, shared_geo):
+    global maa_data, geo
+    maa_data = shared_maa_data
+    geo = shared_geo
+
+def get_month_range(month):
+    """
+    First and last day of a month given as YYYY-MM
+    """
+    start_date = datetime.date.fromisoformat(f'{month}-01')
+    next_month = (start_date + datetime.timedelta(days = 31)).replace(day = 1)
+    return start_date, next_month - datetime.timedelta(days = 1)
+
+def get_last_month():
+    first_of_month = datetime.date.today().replace(day = 1)
+    return (first_of_month - datetime.timedelta(days = 1)).strftime('%Y-%m')
+
+def slugify(name):
+    """
+    File-safe version of a place name
+    """
+    return re.sub(r'[^\w\-]+', '_', str(name)).strip('_')
+
+def get_units(geo, countries = None, level = 'all'):
+    """
+    Reports to write, one dict per country and per MAA: name, path (relative to the output
+    directory) and the country/snu/lgu/maa selection as the dashboard would make it.
+    """
+    units = []
+    for country in geo["country"].itertuples():
+        if countries and country.country_name not in countries:
+            continue
+
+        maa = geo["maa"].query("country_id == @country.country_id")
+        country_dir = slugify(country.country_name)
+        if level in ('all', 'country'):
+            units.append({
+                'name': country.country_name,
+                'path': os.path.join(country_dir, f'{country_dir}.xlsx'),
+                'country': [country.country_name],
+                'snu': list(geo["snu"].query("country_id == @country.country_id")['snu_id']),
+                'lgu': list(geo["lgu"].query("country_id == @country.country_id")['lgu_id']),
+                'maa': list(maa['ma_id'])
+            })
+        if level in ('all', 'maa'):
+            for row in maa.itertuples():
+                units.append({
+                    'name': f'{country.country_name} / {row.ma_name}',
+                    'path': os.path.join(country_dir, f'{slugify(row.ma_name)}-{row.ma_id}.xlsx'),
+                    'country': [country.country_name],
+                    'snu': [row.snu_id],
+                    'lgu': [row.lgu_id],
+                    'maa': [row.ma_id]
+                })
+    return units
+
+def write_unit_report(unit, start_date, end_date, output_dir):
+    """
+    Compute a unit's outputs from the shared split and write its export. Returns the unit's
+    name and the number of records in it.
+    """
+    frames = [maa_data[ma_id] for ma_id in unit['maa'] if ma_id in maa_data]
+    if not frames:
+        return unit['name'], 0
+
+    filtered_data = pd.concat(frames) if len(frames) > 1 else frames[0]
+    output_data = get_output_data(filtered_data, geo["comm"])
+    metadata = get_export_metadata(
+        geo, unit['country'], unit['snu'], unit['lgu'], unit['maa'], start_date, end_date
+    )
+
+    path = os.path.join(output_dir, unit['path'])
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    tmp_path = f'{path}.tmp'
+    write_workbook(tmp_path, output_data, metadata)
+    os.replace(tmp_path, path)
+    return unit['name'], len(filtered_data)
+
+def run(start_date, end_date, output_dir, countries = None, level = 'all', n_workers = None, from_snapshot = False):
+    started = time.time()
+    if not from_snapshot or get_snapshot_dataset() is None:
+        write_snapshot(get_ourfish_data())
+
+    # The hierarchy comes from all the records, but only its columns are read
+    all_geo = get_geo_data(read_snapshot_distinct(GEO_COLUMNS))
+    units = get_units(all_geo, countries, level)
+
+    # The shared intermediate: the range's records (only the months in it are read), split by
+    # MAA once for every unit
+    filtered_data = read_snapshot(start_date, end_date, columns = OUTPUT_COLUMNS)
+    shared_maa_data = dict(tuple(filtered_data.groupby('ma_id')))
+    del filtered_data
+
+    print(f"Writing {len(units)} reports for {start_date} to {end_date} to {output_dir}")
+    written = 0
+    with multiprocessing.Pool(n_workers or os.cpu_count(), init_worker, (shared_maa_data, all_geo)) as pool:
+        results = pool.starmap(write_unit_report, [(unit, start_date, end_date, output_dir) for unit in units])
+    for name, n_records in results:
+        if n_records:
+            written += 1
+        else:
+            print(f"  {name}: no records, skipped")
+
+    print(f"Wrote {written} reports in {time.time() - started:.1f}s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Write the dashboard export of every country and MAA")
+    parser.add_argument('--month', default = get_last_month(), help = "YYYY-MM, default: last month")
+    parser.add_argument('--start', help = "start date (YYYY-MM-DD), instead of --month")
+    parser.add_argument('--end', help = "end date (YYYY-MM-DD), instead of --month")
+    parser.add_argument('--output', default = 'reports', help = "output directory")
+    parser.add_argument('--country', action = 'append', help = "only this country (by name); can be repeated")
+    parser.add_argument('--level', choices = ['all', 'country', 'maa'], default = 'all', help = "which units to write")
+    parser.add_argument('--workers', type = int, help = "number of worker processes, default: one per core")
+    parser.add_argument('--snapshot', action = 'store_true', help = "read the local snapshot instead of data.world")
+    args = parser.parse_args()
+
+    if args.start or args.end:
+        if not (args.start and args.end):
+            parser.error("--start and --end go together")
+        start_date = datetime.date.fromisoformat(args.start)
+        end_date = datetime.date.fromisoformat(args.end)
+        label = f'{start_date}_{end_date}'
+    else:
+        start_date, end_date = get_month_range(args.month)
+        label = args.month
+
+    run(
+        start_date, end_date, os.path.join(args.output, label),
+        countries = args.country, level = args.level, n_workers = args.workers, from_snapshot = args.snapshot
+    )
@@ -0,0 +1,243 @@
+"""
+Benchmark the aggregation and figure pipeline on synthetic data (see synth_ourfish.py):
+
+    python bench_pipeline.py --rows 10000 100000 1000000 --output benchmarks/before.json
+    ... change something ...
+    python bench_pipeline.py --rows 10000 100000 1000000 --compare benchmarks/before.json
+
+Each stage -- the get_*_data aggregations, the make_*_fig builders, get_cluster_data and
+make_map, and the SQL backend's get_output_data_sql -- runs on a dataset of each size, for
+three selections: one MAA over 6 months, one country over a year, and everything. A stage is
+run --repeat times after one warm-up run, and its latency percentiles are reported, along with
+the peak memory it allocates in one more run (traced with tracemalloc, which sees pandas and
+numpy allocations but not arrow's).
+
+Results are saved as JSON, with the commit and library versions they were measured on.
+--compare matches the results to a saved baseline and flags the stages whose median latency or
+peak memory grew by more than --threshold, exiting with status 1 if any did.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from mod_dataworld import get_geo_data, process_ourfish_data
+from synth_ourfish import generate_ourfish_data
+from utils_plot import (
+    get_catch_data, make_catch_fig,
+    get_cpue_value_data, make_cpue_value_fig,
+    get_length_data, make_length_fig,
+    get_composition_data, make_composition_fig
+)
+from utils_map import get_map_data, build_spatial_index, get_cluster_data, get_map_view, make_map, mapbox_url
+from utils_highlights import get_highlights_data
+from utils_query import OUTPUT_COLUMNS
+from utils_sql import get_output_data_sql
+
+BENCH_DIR = 'benchmarks'
+
+# name, function of (filtered records, context); the context has the geography, spatial index,
+# the selection's records as arrow, and the aggregates the figure stages draw
+STAGES = [
+    ('get_catch_data', lambda data, ctx: get_catch_data(data)),
+    ('get_cpue_value_data', lambda data, ctx: get_cpue_value_data(data)),
+    ('get_length_data', lambda data, ctx: get_length_data(data)),
+    ('get_composition_data', lambda data, ctx: get_composition_data(data)),
+    ('get_map_data', lambda data, ctx: get_map_data(data, ctx['geo']["comm"])),
+    ('get_highlights_data', lambda data, ctx: get_highlights_data(data)),
+    ('make_catch_fig', lambda data, ctx: make_catch_fig(ctx['catch'])),
+    ('make_cpue_value_fig', lambda data, ctx: make_cpue_value_fig(ctx['cpue-value'])),
+    ('make_length_fig', lambda data, ctx: make_length_fig(ctx['length'])),
+    ('make_composition_fig', lambda data, ctx: make_composition_fig(ctx['composition'])),
+    ('get_cluster_data', lambda data, ctx: get_cluster_data(ctx['map'], ctx['spatial_index'], ctx['zoom'])),
+    ('make_map', lambda data, ctx: make_map(ctx['clusters'], mapbox_url, ctx['center'], ctx['zoom'])),
+    ('get_output_data_sql', lambda data, ctx: get_output_data_sql(ctx['records'], ctx['geo']["comm"]))
+]
+
+def make_dataset(n_rows, seed = 0):
+    """
+    Processed synthetic records (as get_ourfish_data returns them), in memory
+    """
+    return pd.concat(
+        [process_ourfish_data(chunk) for chunk in generate_ourfish_data(n_rows, seed = seed)],
+        ignore_index = True
+    )
+
+def get_selections(all_data):
+    """
+    (name, sel_maa, start_date, end_date): the busiest MAA over the last 6 months, the busiest
+    country over the last year, and everything
+    """
+    max_date = all_data['date'].max()
+    six_months_ago = max_date - datetime.timedelta(days = 182)
+    year_ago = max_date - datetime.timedelta(days = 365)
+    recent = all_data[all_data['date'] >= six_months_ago]
+    busiest_maa = recent['ma_id'].value_counts().index[0]
+    busiest_country = all_data[all_data['date'] >= year_ago]['country_id'].value_counts().index[0]
+    country_maa = sorted(all_data.loc[all_data['country_id'] == busiest_country, 'ma_id'].unique())
+    return [
+        ('maa-6-months', [busiest_maa], six_months_ago, max_date),
+        ('country-1-year', country_maa, year_ago, max_date),
+        ('all', sorted(all_data['ma_id'].unique()), all_data['date'].min(), max_date)
+    ]
+
+def filter_records(all_data, sel_maa, start_date, end_date):
+    # The same selection as apply_filters
+    return all_data[
+        all_data['ma_id'].isin(sel_maa) &
+        (all_data['date'] >= start_date) &
+        (all_data['date'] <= end_date)
+    ]
+
+def measure(fn, repeat):
+    """
+    Latencies (ms) of `repeat` runs of fn after a warm-up run, and the peak memory (MB) traced
+    during one more run
+    """
+    fn()
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        latencies.append(1e3 * (time.perf_counter() - started))
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return latencies, peak / 2**20
+
+def summarize(latencies):
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {
+        'p50_ms': round(p50, 3),
+        'p90_ms': round(p90, 3),
+        'p99_ms': round(p99, 3),
+        'mean_ms': round(float(np.mean(latencies)), 3),
+        'max_ms': round(max(latencies), 3)
+    }
+
+def run_benchmarks(sizes, repeat, stages = None, seed = 0):
+    results = []
+    for n_rows in sizes:
+        print(f"Generating {n_rows} records", flush = True)
+        all_data = make_dataset(n_rows, seed)
+        geo = get_geo_data(all_data)
+        spatial_index = build_spatial_index(geo["comm"])
+
+        for selection, sel_maa, start_date, end_date in get_selections(all_data):
+            data = filter_records(all_data, sel_maa, start_date, end_date)
+            ctx = {
+                'geo': geo,
+                'spatial_index': spatial_index,
+                'records': pa.Table.from_pandas(data[OUTPUT_COLUMNS], preserve_index = False),
+                'catch': get_catch_data(data),
+                'cpue-value': get_cpue_value_data(data),
+                'length': get_length_data(data),
+                'composition': get_composition_data(data),
+                'map': get_map_data(data, geo["comm"])
+            }
+            ctx['center'], ctx['zoom'] = get_map_view(ctx['map'])
+            ctx['clusters'] = get_cluster_data(ctx['map'], spatial_index, ctx['zoom'])
+
+            for stage, fn in STAGES:
+                if stages and stage not in stages:
+                    continue
+                latencies, peak_mb = measure(lambda: fn(data, ctx), repeat)
+                result = {
+                    'stage': stage,
+                    'rows': n_rows,
+                    'selection': selection,
+                    'records': len(data),
+                    **summarize(latencies),
+                    'peak_mb': round(peak_mb, 3)
+                }
+                results.append(result)
+                print(f"  {stage:22} {selection:15} {len(data):>9} records  "
+                      f"p50 {result['p50_ms']:9.2f} ms  p99 {result['p99_ms']:9.2f} ms  "
+                      f"peak {result['peak_mb']:8.1f} MB", flush = True)
+    return results
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output = True, text = True, check = True,
+            cwd = os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_meta(args):
+    return {
+        'commit': get_commit(),
+        'measured_at': datetime.datetime.now().isoformat(timespec = 'seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'pyarrow': pa.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'seed': args.seed
+    }
+
+def format_ratio(after, before):
+    return f"x{after / before:.2f}" if before > 0 else "x-"
+
+def compare(results, baseline, threshold):
+    """
+    Print how each result compares to the baseline's; returns the number of regressions
+    """
+    previous = {(r['stage'], r['rows'], r['selection']): r for r in baseline['results']}
+    n_regressions = 0
+    print(f"Compared to {baseline['meta'].get('commit')} ({baseline['meta'].get('measured_at')}):")
+    for result in results:
+        before = previous.get((result['stage'], result['rows'], result['selection']))
+        if before is None:
+            continue
+        # Sub-millisecond stages are all noise, and so are tiny allocations: a change only counts
+        # as a regression against at least 1 ms / 1 MB. The ratios printed are the real ones.
+        regressed = (
+            result['p50_ms'] / max(before['p50_ms'], 1) > threshold or
+            result['peak_mb'] / max(before['peak_mb'], 1) > threshold
+        )
+        n_regressions += regressed
+        print(f"  {'REGRESSED' if regressed else 'ok':9} {result['stage']:22} {result['rows']:>9} {result['selection']:15} "
+              f"p50 {before['p50_ms']:9.2f} -> {result['p50_ms']:9.2f} ms ({format_ratio(result['p50_ms'], before['p50_ms'])})  "
+              f"peak {before['peak_mb']:8.1f} -> {result['peak_mb']:8.1f} MB ({format_ratio(result['peak_mb'], before['peak_mb'])})")
+    return n_regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmark the aggregation and figure pipeline")
+    parser.add_argument('--rows', type = int, nargs = '+', default = [10000, 100000, 1000000], help = "dataset sizes")
+    parser.add_argument('--repeat', type = int, default = 20, help = "timed runs per stage")
+    parser.add_argument('--stage', action = 'append', help = "only this stage; can be repeated")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', help = f"where to save the results, default: {BENCH_DIR}/<commit>.json")
+    parser.add_argument('--compare', help = "baseline results to compare to")
+    parser.add_argument('--threshold', type = float, default = 1.25, help = "ratio to the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.rows, args.repeat, args.stage, args.seed)
+    meta = get_meta(args)
+    output = args.output or os.path.join(BENCH_DIR, f"{meta['commit'] or 'results'}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok = True)
+    with open(output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent = 2)
+    print(f"Saved {len(results)} results to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(results, baseline, args.threshold) else 0)
@@ -0,0 +1,88 @@
+"""
+Check that the duckdb backend (utils_sql.py) computes the same outputs as pandas, on the
+current snapshot:
+
+    python check_backends.py
+
+Runs both on a set of selections -- every MAA over the whole date range, each country over
+the whole range, each country's MAA's over the last 6 months, single MAA's and months -- and
+prints the outputs that differ. Exits with status 1 if any do, so it can run before switching
+QUERY_BACKEND.
+"""
+import argparse
+import datetime
+import random
+import sys
+import time
+from mod_dataworld import get_geo_data, GEO_COLUMNS
+from utils_query import compute_output_data, compare_output_data, get_maa_countries, OUTPUT_COLUMNS
+from utils_snapshot import read_snapshot_distinct, query_snapshot_table, get_snapshot_version, get_snapshot_date_range
+
+def get_selections(geo, min_date, max_date, n_random = 20, seed = 0):
+    """
+    (name, sel_maa, start_date, end_date) to compare the backends on
+    """
+    maa = geo["maa"]
+    all_maa = sorted(maa['ma_id'])
+    six_months_ago = max(min_date, max_date - datetime.timedelta(days = 182))
+    selections = [("all", all_maa, min_date, max_date)]
+    for country in geo["country"].itertuples():
+        country_maa = sorted(maa.query("country_id == @country.country_id")['ma_id'])
+        selections.append((f"{country.country_name}", country_maa, min_date, max_date))
+        selections.append((f"{country.country_name}, last 6 months", country_maa, six_months_ago, max_date))
+
+    # Small selections, where empty months and missing values matter most
+    rng = random.Random(seed)
+    n_days = (max_date - min_date).days
+    for _ in range(n_random):
+        sel_maa = sorted(rng.sample(all_maa, min(len(all_maa), rng.randint(1, 3))))
+        start_date = min_date + datetime.timedelta(days = rng.randint(0, n_days))
+        end_date = min(max_date, start_date + datetime.timedelta(days = rng.randint(0, 92)))
+        selections.append((f"MAA {sel_maa}, {start_date} to {end_date}", sel_maa, start_date, end_date))
+    return selections
+
+def check(selections, geo, version, rtol = 1e-9):
+    """
+    Compare the backends on each selection; returns the number of selections that differ
+    """
+    n_failed = 0
+    timings = {'pandas': 0, 'duckdb': 0}
+    for name, sel_maa, start_date, end_date in selections:
+        records = query_snapshot_table(
+            sel_maa, start_date, end_date,
+            columns = OUTPUT_COLUMNS,
+            countries = get_maa_countries(geo["maa"], sel_maa),
+            version = version
+        )
+        outputs = {}
+        for backend in timings:
+            started = time.perf_counter()
+            outputs[backend] = compute_output_data(records, geo["comm"], backend = backend)
+            timings[backend] += time.perf_counter() - started
+
+        differences = compare_output_data(outputs['pandas'], outputs['duckdb'], rtol)
+        if differences:
+            n_failed += 1
+            print(f"{name} ({records.num_rows} records): differs")
+            for output, message in differences:
+                print(f"  {output}: " + message.replace('\n', '\n    '))
+
+    print(f"{len(selections) - n_failed} of {len(selections)} selections match "
+          f"(pandas {timings['pandas']:.2f}s, duckdb {timings['duckdb']:.2f}s)")
+    return n_failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Compare the pandas and duckdb query backends on the snapshot")
+    parser.add_argument('--random', type = int, default = 20, help = "number of random small selections")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--rtol', type = float, default = 1e-9, help = "relative tolerance for values")
+    args = parser.parse_args()
+
+    version = get_snapshot_version()
+    if version is None:
+        sys.exit("No snapshot; run the dashboard or batch_reports.py first")
+
+    min_date, max_date = get_snapshot_date_range(version)
+    geo = get_geo_data(read_snapshot_distinct(GEO_COLUMNS, version))
+    selections = get_selections(geo, min_date, max_date, args.random, args.seed)
+    sys.exit(1 if check(selections, geo, version, args.rtol) else 0)
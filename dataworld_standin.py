@@ -0,0 +1,87 @@
+"""
+Local stand-in for the data.world CSV endpoint, for running the dashboard, benchmarks and load
+tests without the network. Serves one CSV file with an ETag and byte-range support:
+
+    python dataworld_standin.py ourfish.csv --port 8765
+    OURFISH_CSV_URL=http://localhost:8765/ourfish.csv python app.py
+
+--fail-after cuts off the first --failures responses after that many bytes, and --no-range
+makes it ignore Range requests, to exercise the resumable download in utils_fetch.py.
+--encoding gzip sends the file gzip'd whatever the client asked for, as some proxies do, with
+ranges over the compressed bytes; any other name is sent as the Content-Encoding of the
+uncompressed file.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import gzip
+import hashlib
+import os
+import re
+
+def make_handler(path, fail_after = None, failures = 0, ranges = True, encoding = None):
+    with open(path, 'rb') as f:
+        body = f.read()
+    etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+    if encoding == 'gzip':
+        body = gzip.compress(body)
+    size = len(body)
+    state = {'failures': failures}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = 0
+            match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            if_range = self.headers.get('If-Range')
+            if ranges and match and (if_range is None or if_range == etag):
+                start = int(match.group(1))
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(size - start))
+            self.send_header('ETag', etag)
+            self.send_header('Accept-Ranges', 'bytes' if ranges else 'none')
+            if encoding is not None:
+                self.send_header('Content-Encoding', encoding)
+            self.end_headers()
+
+            end = size
+            if fail_after is not None and state['failures'] > 0:
+                state['failures'] -= 1
+                end = min(size, start + fail_after)
+            for offset in range(start, end, 64 * 1024):
+                try:
+                    self.wfile.write(body[offset:min(end, offset + 64 * 1024)])
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client went away
+                    return
+            if end < size:
+                # Drop the connection mid-response
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def serve(path, port = 8765, fail_after = None, failures = 0, ranges = True, encoding = None):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(path, fail_after, failures, ranges, encoding))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Serve a CSV file in place of data.world")
+    parser.add_argument('path', help = "CSV file to serve")
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--fail-after', type = int, help = "bytes after which to drop failing responses")
+    parser.add_argument('--failures', type = int, default = 1, help = "number of responses to drop")
+    parser.add_argument('--no-range', action = 'store_true', help = "ignore Range requests")
+    parser.add_argument('--encoding', help = "Content-Encoding to send the file with (see above)")
+    args = parser.parse_args()
+
+    serve(args.path, args.port, args.fail_after, args.failures, not args.no_range, args.encoding)
@@ -1,2 +1,46 @@
+import multiprocessing
+import os
+import shutil
+import signal
+
 bind = "0.0.0.0:8080"
-workers = 2
+
+# Each worker keeps its metrics (see utils_metrics.py) in files here, so that /metrics on any of
+# them reports all of them. This has to be set before the app is imported. Files left by a
+# previous run would be added to this one's, so they're cleared -- but only on the first load of
+# this config, not when a HUP re-reads it under running workers.
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = 'metrics-directory'
+    shutil.rmtree('metrics-directory', ignore_errors = True)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok = True)
+
+# The workers warm the cache once forked (see post_fork), not the master as it loads the data
+os.environ['WARM_ON_LOAD'] = 'false'
+
+# The app, and with it the OurFish data, is loaded once in the master before the workers are
+# forked (see when_ready). The workers only read the data, so they share the master's copy of
+# the memory and each one costs little more than its own request handling: the number of
+# workers can follow the cores rather than the RAM.
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+
+# Callbacks spend most of their time waiting on the cache and the disk, so each worker serves
+# requests from a pool of threads rather than one at a time. The shared state they touch (the
+# dataset store, memoized aggregates, export artifacts) is safe to use from several threads.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+def when_ready(server):
+    # With preload_app the master has already imported the app, so this is the same module the
+    # workers will inherit
+    from app import dataset
+
+    # When the master reloads the data, a HUP replaces the workers with freshly forked ones
+    # sharing the new data
+    dataset.preload(on_refresh = lambda: os.kill(os.getpid(), signal.SIGHUP))
+
+def post_fork(server, worker):
+    # Each new worker warms the cache for the data it was forked with (see utils_warm.py). The
+    # workers take turns, so the first one computes the views and the rest find them cached.
+    from app import dataset, warmer
+    warmer.start(dataset.current)
@@ -0,0 +1,35 @@
+"""
+Host the background job workers (see utils_jobs.py). Run alongside the web app, on the same
+machine so the workers share its snapshot, cache and export directories:
+
+    python jobs_worker.py --workers 2
+"""
+import argparse
+import os
+import time
+from utils_snapshot import get_snapshot_version
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Run background job workers for the dashboard")
+    parser.add_argument('--workers', type = int, default = 2, help = "number of worker processes")
+    args = parser.parse_args()
+
+    # The web app pulls the data and writes the snapshot; job workers only read the snapshot it
+    # wrote, rather than each pulling and writing their own copy. Starting alongside the web
+    # app, there may not be one yet.
+    os.environ['OURFISH_SOURCE'] = 'snapshot'
+    while get_snapshot_version() is None:
+        print("Waiting for the web app to write a snapshot", flush = True)
+        time.sleep(10)
+
+    # The web app warms the cache; the job workers mustn't be warming in a thread as they fork
+    os.environ['WARM_ON_LOAD'] = 'false'
+
+    # Importing the app loads the data, here in the parent, so the worker processes are forked
+    # with it. They read the snapshot again once it's older than DATASET_MAX_AGE.
+    from app import jobs, dataset
+
+    # The web app cleans up and warms the cache after each load; job workers only load the data
+    # to run jobs
+    dataset.on_load = None
+    jobs.run_workers(args.workers)
@@ -0,0 +1,353 @@
+"""
+Load test the running dashboard with simulated users, each going through a session the way the
+browser would drive it, through the _dash-update-component endpoint:
+
+    python synth_ourfish.py --rows 1000000 --csv ourfish.csv
+    python dataworld_standin.py ourfish.csv &
+    OURFISH_CSV_URL=http://localhost:8765/ourfish.csv WEB_CONCURRENCY=2 gunicorn -c gunicorn_config.py app:server &
+    python loadtest.py http://localhost:8080 --users 20 --duration 120
+
+A session loads the page (the layout and every initial callback), picks countries (and the
+SNU/LGU/MAA dropdowns cascade from them), picks a date range, applies the filters (polling the
+background job if the plots are computed by one), pans, zooms and clicks the map, and sometimes
+downloads the Excel export or the raw records. Users wait --think seconds on average between
+steps, and start a new session when one ends.
+
+Like the browser, the client reads the layout and the callback definitions from the app, keeps
+every component's properties, sends the inputs and state each callback declares, applies the
+outputs, fires the callbacks those outputs feed into, and follows dcc.Location redirects and
+enabled dcc.Interval's.
+
+At the end it prints the throughput and, per callback and request, the count, error rate and
+p50/p95/p99 latency; --output saves the same as JSON.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import numpy as np
+import requests
+
+class Stats:
+    """
+    Latencies and errors of every request, by label, from all users
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.sessions = 0
+        self.started = time.time()
+
+    def record(self, label, seconds, ok = True):
+        with self.lock:
+            self.latencies.setdefault(label, []).append(seconds)
+            if not ok:
+                self.errors[label] = self.errors.get(label, 0) + 1
+
+    def session_done(self):
+        with self.lock:
+            self.sessions += 1
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        with self.lock:
+            labels = {}
+            for label, latencies in sorted(self.latencies.items()):
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1e3
+                labels[label] = {
+                    'requests': len(latencies),
+                    'errors': self.errors.get(label, 0),
+                    'error_rate': round(self.errors.get(label, 0) / len(latencies), 4),
+                    'p50_ms': round(p50, 1),
+                    'p95_ms': round(p95, 1),
+                    'p99_ms': round(p99, 1)
+                }
+            n_requests = sum(len(latencies) for latencies in self.latencies.values())
+            n_errors = sum(self.errors.values())
+            return {
+                'duration_s': round(elapsed, 1),
+                'sessions': self.sessions,
+                'requests': n_requests,
+                'errors': n_errors,
+                'error_rate': round(n_errors / n_requests, 4) if n_requests else 0,
+                'requests_per_s': round(n_requests / elapsed, 2),
+                'labels': labels
+            }
+
+def parse_outputs(output):
+    """
+    Dash's output string ("id.prop", or "..id1.prop1...id2.prop2.." for several) as (id, prop)'s
+    """
+    if output.startswith('..'):
+        parts = output[2:-2].split('...')
+    else:
+        parts = [output]
+    return [tuple(part.rsplit('.', 1)) for part in parts]
+
+def walk_layout(node, props, types):
+    """
+    Collect the properties of every component with an id in the layout
+    """
+    if isinstance(node, list):
+        for child in node:
+            walk_layout(child, props, types)
+    elif isinstance(node, dict) and 'props' in node:
+        component_id = node['props'].get('id')
+        if component_id is not None:
+            types[component_id] = node.get('type')
+            for prop, value in node['props'].items():
+                if prop != 'children' or not isinstance(value, (dict, list)):
+                    props[(component_id, prop)] = value
+        walk_layout(node['props'].get('children'), props, types)
+
+class DashSession:
+    """
+    One simulated browser tab
+    """
+    def __init__(self, base_url, stats, timeout = 60, think = 1.0, rng = None):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.timeout = timeout
+        self.think_time = think
+        self.rng = rng or random.Random()
+        self.http = requests.Session()
+        self.props = {}
+        self.types = {}
+        self.callbacks = []
+
+    def request(self, label, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, timeout = self.timeout, **kwargs)
+            # Read the whole body, as the browser would, so downloads are timed to the end
+            for _ in response.iter_content(64 * 1024):
+                pass
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response = None
+            ok = False
+        self.stats.record(label, time.perf_counter() - started, ok)
+        return response if ok else None
+
+    def think(self):
+        if self.think_time:
+            time.sleep(self.rng.expovariate(1 / self.think_time))
+
+    def load(self):
+        """
+        Load the page: the index, the layout and the callback definitions, then the initial
+        callbacks
+        """
+        self.request('GET /', 'GET', '/')
+        layout = self.request('GET /_dash-layout', 'GET', '/_dash-layout')
+        dependencies = self.request('GET /_dash-dependencies', 'GET', '/_dash-dependencies')
+        if layout is None or dependencies is None:
+            return False
+
+        self.props = {}
+        self.types = {}
+        walk_layout(layout.json(), self.props, self.types)
+        self.callbacks = dependencies.json()
+        for callback in self.callbacks:
+            callback['outputs'] = parse_outputs(callback['output'])
+        for callback in self.callbacks:
+            if not callback.get('prevent_initial_call'):
+                self.call(callback, [])
+        return True
+
+    def call(self, callback, changed):
+        """
+        Run a callback with the current properties; returns the properties it changed
+        """
+        outputs = [{'id': i, 'property': p} for i, p in callback['outputs']]
+        body = {
+            'output': callback['output'],
+            'outputs': outputs if len(outputs) > 1 else outputs[0],
+            'inputs': [dict(x, value = self.props.get((x['id'], x['property']))) for x in callback['inputs']],
+            'state': [dict(x, value = self.props.get((x['id'], x['property']))) for x in callback['state']],
+            'changedPropIds': [f'{i}.{p}' for i, p in changed]
+        }
+        label = f"callback {callback['outputs'][0][0]}"
+        response = self.request(label, 'POST', '/_dash-update-component', json = body)
+        if response is None or response.status_code == 204:
+            return []
+
+        updated = []
+        for component_id, values in response.json().get('response', {}).items():
+            for prop, value in values.items():
+                self.props[(component_id, prop)] = value
+                updated.append((component_id, prop))
+                if prop == 'href' and self.types.get(component_id) == 'Location' and value:
+                    # A refreshing dcc.Location: the browser goes to the url
+                    self.request(f"GET {value.split('?')[0].rsplit('/', 1)[0]}", 'GET', value)
+        return updated
+
+    def set(self, *changes):
+        """
+        Change component properties as the user would, and run the callbacks that follow from
+        it, then poll any enabled intervals until they're disabled again
+        """
+        for component_id, prop, value in changes:
+            self.props[(component_id, prop)] = value
+        self.fire([(component_id, prop) for component_id, prop, _ in changes])
+        self.poll_intervals()
+
+    def fire(self, changed, max_calls = 50):
+        """
+        Run the callbacks with changed inputs, and then those fed by their outputs. A callback
+        isn't re-run by its own outputs (e.g. the select-all checkboxes).
+        """
+        queue = [(prop, None) for prop in changed]
+        n_calls = 0
+        while queue and n_calls < max_calls:
+            prop, source = queue.pop(0)
+            for callback in self.callbacks:
+                if callback is source:
+                    continue
+                if any((x['id'], x['property']) == prop for x in callback['inputs']):
+                    n_calls += 1
+                    queue.extend((updated, callback) for updated in self.call(callback, [prop]))
+
+    def poll_intervals(self, max_polls = 300):
+        for _ in range(max_polls):
+            enabled = [
+                component_id for component_id, component_type in self.types.items()
+                if component_type == 'Interval' and self.props.get((component_id, 'disabled')) is False
+            ]
+            if not enabled:
+                return
+            time.sleep(max(self.props.get((enabled[0], 'interval'), 1000), 100) / 1000)
+            for component_id in enabled:
+                n_intervals = (self.props.get((component_id, 'n_intervals')) or 0) + 1
+                self.props[(component_id, 'n_intervals')] = n_intervals
+                self.fire([(component_id, 'n_intervals')])
+
+    def click(self, component_id):
+        self.set((component_id, 'n_clicks', (self.props.get((component_id, 'n_clicks')) or 0) + 1))
+
+    def pick_countries(self):
+        options = self.props.get(('country-input', 'options')) or []
+        values = [o['value'] if isinstance(o, dict) else o for o in options]
+        if values:
+            k = min(len(values), self.rng.choice([1, 1, 1, 2]))
+            self.set(('country-input', 'value', self.rng.sample(values, k)))
+
+    def pick_dates(self):
+        min_date = self.props.get(('date-range-input', 'min_date_allowed'))
+        max_date = self.props.get(('date-range-input', 'max_date_allowed'))
+        if not (min_date and max_date):
+            return
+        min_date, max_date = np.datetime64(str(min_date)[:10]), np.datetime64(str(max_date)[:10])
+        n_days = int((max_date - min_date).astype(int))
+        length = min(n_days, self.rng.choice([30, 90, 182, 365, n_days]))
+        start = max_date - np.timedelta64(length + self.rng.randint(0, max(0, n_days - length) // 4), 'D')
+        end = min(max_date, start + np.timedelta64(length, 'D'))
+        self.set(
+            ('date-range-input', 'start_date', str(max(start, min_date))),
+            ('date-range-input', 'end_date', str(end))
+        )
+
+    def move_map(self):
+        figure = self.props.get(('fish-map', 'figure')) or {}
+        mapbox = figure.get('layout', {}).get('mapbox', {})
+        center = mapbox.get('center')
+        zoom = mapbox.get('zoom')
+        if center is None or zoom is None:
+            return
+        zoom = max(1, min(14, zoom + self.rng.choice([-1, 0, 1, 2])))
+        spread = 40 / 2 ** zoom
+        center = {
+            'lat': center['lat'] + self.rng.uniform(-spread, spread),
+            'lon': center['lon'] + self.rng.uniform(-spread, spread)
+        }
+        self.set(('fish-map', 'relayoutData', {'mapbox.center': center, 'mapbox.zoom': zoom}))
+
+    def click_map(self):
+        figure = self.props.get(('fish-map', 'figure')) or {}
+        traces = [t for t in figure.get('data', []) if t.get('lat')]
+        if not traces:
+            return
+        i = self.rng.randrange(len(traces[-1]['lat']))
+        point = {'lat': traces[-1]['lat'][i], 'lon': traces[-1]['lon'][i], 'pointIndex': i}
+        self.set(('fish-map', 'clickData', {'points': [point]}))
+
+    def run(self, download_rate = 0.2):
+        """
+        One session, from page load to leaving
+        """
+        if not self.load():
+            # Like a user hitting reload, not a tight loop
+            time.sleep(max(self.think_time, 1))
+            return
+        self.think()
+        self.pick_countries()
+        self.think()
+        self.pick_dates()
+        self.think()
+        self.click('update-button')
+        for _ in range(self.rng.randint(1, 4)):
+            self.think()
+            self.move_map()
+        self.think()
+        self.click_map()
+        if self.rng.random() < download_rate:
+            self.think()
+            self.click('btn-download')
+        if self.rng.random() < download_rate / 2:
+            self.think()
+            self.set(('records-format', 'value', self.rng.choice(['csv', 'parquet'])))
+            self.click('btn-download-records')
+        self.stats.session_done()
+
+def run_user(base_url, stats, deadline, seed, **options):
+    rng = random.Random(seed)
+    download_rate = options.pop('download_rate')
+    while time.time() < deadline:
+        DashSession(base_url, stats, rng = rng, **options).run(download_rate)
+
+def run_load_test(base_url, users, duration, ramp_up = 10, **options):
+    stats = Stats()
+    deadline = time.time() + duration
+    threads = []
+    for i in range(users):
+        thread = threading.Thread(
+            target = run_user, args = (base_url, stats, deadline, i), kwargs = dict(options), daemon = True
+        )
+        thread.start()
+        threads.append(thread)
+        time.sleep(ramp_up / users)
+    for thread in threads:
+        # Sessions running at the deadline are left to finish their current step
+        thread.join(max(0, deadline - time.time()) + options.get('timeout', 60))
+    return stats.summary()
+
+def print_summary(summary):
+    print(f"{summary['sessions']} sessions, {summary['requests']} requests in {summary['duration_s']}s: "
+          f"{summary['requests_per_s']} requests/s, {summary['error_rate']:.2%} errors")
+    print(f"{'':40} {'requests':>9} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for label, row in summary['labels'].items():
+        print(f"{label:40} {row['requests']:>9} {row['error_rate']:>7.2%} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Load test the dashboard with simulated sessions")
+    parser.add_argument('url', nargs = '?', default = 'http://localhost:8080', help = "where the app is running")
+    parser.add_argument('--users', type = int, default = 10, help = "concurrent users")
+    parser.add_argument('--duration', type = float, default = 60, help = "seconds to run for")
+    parser.add_argument('--ramp-up', type = float, default = 10, help = "seconds over which users start")
+    parser.add_argument('--think', type = float, default = 1.0, help = "mean seconds between a user's steps")
+    parser.add_argument('--download-rate', type = float, default = 0.2, help = "share of sessions that download the export")
+    parser.add_argument('--timeout', type = float, default = 60, help = "request timeout in seconds")
+    parser.add_argument('--output', help = "save the results as JSON")
+    args = parser.parse_args()
+
+    summary = run_load_test(
+        args.url, args.users, args.duration, args.ramp_up,
+        think = args.think, download_rate = args.download_rate, timeout = args.timeout
+    )
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent = 2)
@@ -0,0 +1,47 @@
+"""
+Report where the dashboard's memory goes (see utils_memory.py): the deep size of each table of
+the resident datasets, arrow's memory pool, the on-disk cache tiers and their live session
+entries.
+
+Ask a running app, i.e. whichever worker answers its /admin/memory:
+
+    python memory_report.py --url http://localhost:8080
+
+or load the data in this process and measure it, from the current snapshot (--snapshot) or
+pulled from data.world:
+
+    python memory_report.py --snapshot
+"""
+import argparse
+import json
+import os
+import requests
+from utils_memory import format_memory_report
+
+def fetch_report(url, token = None, timeout = 30):
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+    response = requests.get(f"{url.rstrip('/')}/admin/memory", headers = headers, timeout = timeout)
+    response.raise_for_status()
+    return response.json()
+
+def measure_report(snapshot = False):
+    if snapshot:
+        os.environ['OURFISH_SOURCE'] = 'snapshot'
+    # Imported here: importing the app sets up the whole dashboard, which --url doesn't need
+    import app
+    app.dataset.get()
+    return app.report_memory()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Report the dashboard's memory use")
+    parser.add_argument('--url', help = "base URL of a running app to ask")
+    parser.add_argument('--token', default = os.environ.get('METRICS_TOKEN'), help = "the app's METRICS_TOKEN, if set")
+    parser.add_argument('--snapshot', action = 'store_true', help = "load the current snapshot instead of pulling the data")
+    parser.add_argument('--json', action = 'store_true', help = "print the report as JSON")
+    args = parser.parse_args()
+
+    if args.url:
+        report = fetch_report(args.url, args.token)
+    else:
+        report = measure_report(args.snapshot)
+    print(json.dumps(report, indent = 2) if args.json else format_memory_report(report))
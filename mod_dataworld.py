@@ -4,6 +4,26 @@ import pandas as pd
 import numpy as np
 import json
 import datetime
+from utils_fetch import fetch_ourfish_csv
+
+# Columns of the join_ourfish_footprint_fishbase table, as pulled from data.world
+OURFISH_COLUMNS = [
+    'id', 'date', 'country_id', 'snu_id', 'lgu_id', 'community_id',
+    'country', 'snu_name', 'lgu_name', 'community_name', 'ma_id', 'ma_name',
+    'ma_lat', 'ma_lon', 'population', 'community_lat', 'community_lon',
+    'est_buyers', 'est_fishers', 'buyer_id', 'buyer_name', 'buyer_gender',
+    'fisher_id', 'buying_unit', 'fishbase_id', 'weight_kg', 'weight_lbs',
+    'count', 'total_price_local', 'total_price_usd', 'family_scientific',
+    'family_local', 'species_scientific', 'species_local', 'is_focal', 'a',
+    'b', 'lmax', 'hide'
+]
+
+# Columns get_geo_data uses
+GEO_COLUMNS = [
+    'country_id', 'country', 'snu_id', 'snu_name', 'lgu_id', 'lgu_name',
+    'ma_id', 'ma_name', 'ma_lat', 'ma_lon',
+    'community_id', 'community_name', 'community_lat', 'community_lon', 'population'
+]
 
 def get_ourfish_data():
     """
@@ -11,7 +31,7 @@ def get_ourfish_data():
 
     Data source: join_ourfish_footprint_fishbase from https://data.world/rare/ourfish
     """
-    all_data = pd.read_csv('https://query.data.world/s/mlrbseaz6qipapni2wh7bp6m6eqkv2?dws=00000')
+    all_data = fetch_ourfish_csv() # streamed and parsed in chunks, see utils_fetch.py
     # >>> all_data.head()
     #                                          id        date  country_id  snu_id  ...         a         b   lmax hide
     # 0  8be7aa9a-58ef-4972-950d-dd33cff6cd1c  2020-03-17           6     143  ...  0.004262  3.325280    7.6  NaN
@@ -32,6 +52,13 @@ def get_ourfish_data():
     #   dtype='object')   
     # Takes approx 15s to get the query result
 
+    return process_ourfish_data(all_data)
+
+def process_ourfish_data(all_data):
+    """
+    Clean up the raw OurFish table (as pulled from data.world, or made by synth_ourfish.py): drop
+    records with no date or MAA, parse the dates and add yearmonth and weight_mt.
+    """
     # The next few lines trigger this warning
     #   A value is trying to be set on a copy of a slice from a DataFrame.
     #   Try using .loc[row_indexer,col_indexer] = value instead
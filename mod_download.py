@@ -7,13 +7,43 @@ def start_download_button():
         className = "btn btn-info",
         type = "button"
     )
-    download_component = dcc.Download(id = "download-data")
+    # The export is streamed from its own route (see serve_download in app.py); pointing this
+    # at that route makes the browser download it as a regular file
+    download_component = dcc.Location(id = "download-location", refresh = True)
+    # Exports that aren't cached are written by a background job; this polls it while it runs
+    download_job = dcc.Store(id = "download-job")
+    download_job_interval = dcc.Interval(id = "download-job-interval", interval = 1000, disabled = True)
+    download_status = html.Div(id = "download-status")
+
+    # Raw catch records for the selected MAA's and dates, streamed from the snapshot
+    records_format = dcc.RadioItems(
+        id = "records-format",
+        options = [
+            {'label': 'CSV', 'value': 'csv'},
+            {'label': 'Parquet', 'value': 'parquet'}
+        ],
+        value = 'csv',
+        inline = True
+    )
+    records_button = html.Button(
+        "Download records",
+        id = "btn-download-records",
+        className = "btn btn-info",
+        type = "button"
+    )
+    records_component = dcc.Location(id = "records-download-location", refresh = True)
 
     download_div = html.Div(
         id = "download-container",
         children = [
             download_button,
-            download_component
+            download_component,
+            download_job,
+            download_job_interval,
+            download_status,
+            records_button,
+            records_format,
+            records_component
     ])
 
     return download_div
@@ -124,9 +124,17 @@ def start_filters(min_date, max_date, countries):
         className = "btn btn-success"
     )
 
+    # Big selections are computed by a background job; this polls it while it runs
+    plots_job = dcc.Store(id = "plots-job")
+    plots_job_interval = dcc.Interval(id = "plots-job-interval", interval = 1000, disabled = True)
+    plots_status = html.Div(id = "plots-status")
+
     filter_div = html.Div([
             html.Div([filter_inputs_toggle_div, filter_inputs_div], id = "filters-container"),
-            update_button
+            update_button,
+            plots_job,
+            plots_job_interval,
+            plots_status
     ])
 
     return filter_div
@@ -1,10 +1,23 @@
 import plotly.graph_objects as go
 import plotly.express as px
 from dash import dcc, html
-from utils_map import make_map, mapbox_url
+from utils_map import (
+    make_map, get_map_view, get_cluster_data, get_cluster_level,
+    get_bounds, pad_bounds, mapbox_url
+)
 
-def start_map(map_data, comm):
-    fig = make_map(map_data, mapbox_url)
+def start_map(map_data, spatial_index):
+    center, zoom = get_map_view(map_data)
+    bounds = pad_bounds(get_bounds(center, zoom))
+    cluster_data = get_cluster_data(map_data, spatial_index, zoom, bounds)
+    fig = make_map(cluster_data, mapbox_url, center, zoom)
+
+    # The view the map was last drawn for, so panning and zooming only redraws the map
+    # when it leaves the communities already loaded or changes cluster resolution
+    map_view = dcc.Store(
+        id = 'map-view',
+        data = {'zoom': zoom, 'level': get_cluster_level(zoom), 'bounds': bounds}
+    )
 
     map = dcc.Graph(
         id = 'fish-map',
@@ -68,7 +81,7 @@ def start_map(map_data, comm):
     )
 
     map_div = html.Div(
-        [map, legend],
+        [map, map_view, legend],
         style = {
             "z-index": "1",
             "width": "100%",
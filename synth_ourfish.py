@@ -0,0 +1,298 @@
+"""
+Make a synthetic OurFish dataset, for testing and benchmarking at sizes (and offline) the live
+data.world table can't give:
+
+    python synth_ourfish.py --rows 10000000 --snapshot
+    OURFISH_SOURCE=snapshot python app.py
+
+writes it straight to the snapshot (see utils_snapshot.py) for the app, batch_reports.py
+--snapshot and check_backends.py to read, and
+
+    python synth_ourfish.py --rows 100000 --csv ourfish.csv
+    python dataworld_standin.py ourfish.csv
+
+writes the raw table as data.world serves it, for the full pull-and-process path.
+
+The records have the 39 columns of the data.world table (OURFISH_COLUMNS) and its quirks:
+countries split into SNU's, LGU's, MAA's and communities, which join the program at different
+times; fishers and buyers belonging to communities; species with families, local names that
+vary by country, and a/b/lmax (missing for some species). Activity is skewed -- a few
+communities, fishers and species account for most of the records -- and catch weights and
+prices are log-normal. Some records miss a fisher, buyer, weight, price or count, and a few miss
+a date or MAA (which get_ourfish_data drops).
+
+Records are made in date order, a chunk at a time, so any number of rows can be written with
+memory for one chunk. The same arguments always make the same data.
+"""
+import argparse
+import datetime
+import os
+import time
+import numpy as np
+import pandas as pd
+from mod_dataworld import process_ourfish_data, OURFISH_COLUMNS
+from utils_snapshot import write_snapshot_chunks
+
+CHUNK_ROWS = 250000
+
+# Fraction of records missing each value
+MISSING_RATES = {
+    'fisher_id': 0.03,
+    'buyer_id': 0.01,
+    'weight_kg': 0.005,
+    'total_price_local': 0.01,
+    'count': 0.05,
+    'date': 0.0005,
+    'ma_id': 0.001
+}
+
+SYLLABLES = [
+    'ba', 'bu', 'ca', 'da', 'ga', 'ki', 'la', 'lu', 'ma', 'na', 'ni', 'pa', 'ra', 'sa', 'si',
+    'ta', 'tu', 'xe', 'ya', 'za', 'ngo', 'lan', 'kun', 'bis', 'tal'
+]
+
+def make_word(rng, n_min = 2, n_max = 3):
+    return ''.join(rng.choice(SYLLABLES, rng.integers(n_min, n_max + 1))).capitalize()
+
+def skewed_weights(rng, n, exponent = 1.0):
+    """
+    Zipf-like activity weights for n items in random order: a few are very active, most aren't
+    """
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+def make_hierarchy(rng, n_countries, snu_per_country, lgu_per_snu, maa_per_lgu, communities_per_maa, start_date, end_date):
+    """
+    One row per community with its whole hierarchy (ids, names, locations), population,
+    estimated fishers and buyers, and the day it joins the program (days after start_date)
+    """
+    rows = []
+    n_days = (end_date - start_date).days
+    snu_id = lgu_id = ma_id = community_id = 0
+    for country_id in range(1, n_countries + 1):
+        country = make_word(rng, 2, 3)
+        country_lat, country_lon = rng.uniform(-20, 20), rng.uniform(-80, 130)
+        # Countries join over the first half of the range, and their sites over the rest
+        country_start = int(rng.integers(0, max(1, n_days // 2)))
+        for _ in range(snu_per_country):
+            snu_id += 1
+            snu_name = make_word(rng)
+            for _ in range(lgu_per_snu):
+                lgu_id += 1
+                lgu_name = make_word(rng)
+                for _ in range(maa_per_lgu):
+                    ma_id += 1
+                    ma_name = make_word(rng)
+                    ma_lat, ma_lon = country_lat + rng.normal(0, 2), country_lon + rng.normal(0, 2)
+                    ma_start = country_start + int(rng.integers(0, max(1, (n_days - country_start) // 2)))
+                    for _ in range(communities_per_maa):
+                        community_id += 1
+                        population = int(rng.lognormal(7.5, 1))
+                        rows.append({
+                            'country_id': country_id, 'country': country,
+                            'snu_id': snu_id, 'snu_name': snu_name,
+                            'lgu_id': lgu_id, 'lgu_name': lgu_name,
+                            'ma_id': ma_id, 'ma_name': ma_name, 'ma_lat': ma_lat, 'ma_lon': ma_lon,
+                            'community_id': community_id, 'community_name': make_word(rng),
+                            'community_lat': ma_lat + rng.normal(0, 0.05),
+                            'community_lon': ma_lon + rng.normal(0, 0.05),
+                            'population': population,
+                            'est_fishers': max(1, int(population * rng.uniform(0.02, 0.1))),
+                            'est_buyers': max(1, int(population * rng.uniform(0.002, 0.01))),
+                            'start_day': ma_start
+                        })
+
+    communities = pd.DataFrame(rows)
+    # Like the real table: some MAA's have no name or location, and some communities no location
+    no_location = rng.random(len(communities)) < 0.02
+    communities.loc[no_location, ['community_lat', 'community_lon']] = np.nan
+    unnamed_maa = rng.choice(communities['ma_id'].unique(), max(1, ma_id // 50), replace = False)
+    communities.loc[communities['ma_id'].isin(unnamed_maa), ['ma_name', 'ma_lat', 'ma_lon']] = np.nan
+    return communities
+
+def make_species(rng, n_species, n_countries):
+    """
+    One row per species: fishbase_id, names, family, whether it's a focal species, the
+    weight-length parameters a, b and lmax (missing for some), a typical catch weight and price
+    per kg. Local names are per country (species_local[country_id - 1]).
+    """
+    n_families = max(1, n_species // 8)
+    families = [(make_word(rng, 2, 3) + 'idae', make_word(rng)) for _ in range(n_families)]
+    family = rng.integers(0, n_families, n_species)
+    species = pd.DataFrame({
+        'fishbase_id': rng.choice(np.arange(1, 20 * n_species), n_species, replace = False),
+        'species_scientific': [f'{make_word(rng)} {make_word(rng).lower()}' for _ in range(n_species)],
+        'family_scientific': [families[f][0] for f in family],
+        'family_local': [families[f][1] for f in family],
+        'is_focal': (rng.random(n_species) < 0.2).astype(int),
+        'a': rng.lognormal(np.log(0.012), 0.5, n_species),
+        'b': rng.uniform(2.7, 3.3, n_species),
+        'lmax': rng.lognormal(np.log(50), 0.7, n_species),
+        'log_weight_kg': rng.normal(1.5, 1, n_species),
+        'price_usd_kg': rng.lognormal(np.log(2.5), 0.6, n_species)
+    })
+    no_length = rng.random(n_species) < 0.15
+    species.loc[no_length, ['a', 'b', 'lmax']] = np.nan
+    species['species_local'] = [
+        np.array([make_word(rng) for _ in range(n_countries)], dtype = object) for _ in range(n_species)
+    ]
+    return species
+
+def get_day_rows(rng, n_rows, n_days):
+    """
+    Number of records on each day: growing over time as the program does, fewer on weekends
+    """
+    days = np.arange(n_days)
+    weights = (1 + 3 * days / max(1, n_days)) * np.where(days % 7 >= 5, 0.4, 1.0)
+    return rng.multinomial(n_rows, weights / weights.sum())
+
+def generate_ourfish_data(n_rows, start_date = datetime.date(2019, 1, 1), end_date = datetime.date(2023, 6, 30),
+                          n_countries = 6, snu_per_country = 4, lgu_per_snu = 4, maa_per_lgu = 3,
+                          communities_per_maa = 3, fishers_per_community = 40, buyers_per_community = 6,
+                          n_species = 600, chunk_rows = CHUNK_ROWS, seed = 0):
+    """
+    Yield the raw synthetic table (as fetch_ourfish_csv would return it) in chunks of about
+    `chunk_rows` rows, in date order. See the module docstring for what's in it.
+    """
+    rng = np.random.default_rng(seed)
+    communities = make_hierarchy(
+        rng, n_countries, snu_per_country, lgu_per_snu, maa_per_lgu, communities_per_maa, start_date, end_date
+    )
+    species = make_species(rng, n_species, n_countries)
+    n_communities = len(communities)
+    community_weights = skewed_weights(rng, n_communities, 0.8)
+    species_weights = skewed_weights(rng, n_species, 1.1)
+
+    # Fishers and buyers are numbered per community; within one, a few do most of the trading
+    fisher_weights = skewed_weights(rng, fishers_per_community, 1.0)
+    buyer_weights = skewed_weights(rng, buyers_per_community, 0.7)
+    buyer_gender = rng.choice([1, 2], n_communities * buyers_per_community, p = [0.65, 0.35]).astype(float)
+    buyer_gender[rng.random(len(buyer_gender)) < 0.02] = np.nan
+    buyer_names = np.array([make_word(rng) for _ in range(256)], dtype = object)
+    fx_rate = rng.lognormal(3, 1.5, n_countries)
+
+    n_days = (end_date - start_date).days + 1
+    day_rows = get_day_rows(rng, n_rows, n_days)
+    row = 0
+    day = 0
+    while day < n_days:
+        # Whole days up to about chunk_rows records
+        first_day = day
+        n_chunk = 0
+        while day < n_days and (n_chunk == 0 or n_chunk + day_rows[day] <= chunk_rows):
+            n_chunk += day_rows[day]
+            day += 1
+        if n_chunk == 0:
+            continue
+        days = np.repeat(np.arange(first_day, day), day_rows[first_day:day])
+
+        # Only communities that have joined by the end of the chunk record anything, and
+        # none before they join
+        active = (communities['start_day'].to_numpy() <= day - 1)
+        if not active.any():
+            active[:] = True
+        weights = community_weights * active
+        community = rng.choice(n_communities, n_chunk, p = weights / weights.sum())
+        start_day = communities['start_day'].to_numpy()[community]
+        days = np.maximum(days, np.minimum(start_day, day - 1))
+        order = np.argsort(days, kind = 'stable')
+        days, community = days[order], community[order]
+
+        chunk = communities.iloc[community].drop(columns = 'start_day').reset_index(drop = True)
+        dates = np.datetime64(start_date) + days.astype('timedelta64[D]')
+        chunk.insert(0, 'date', np.datetime_as_string(dates, unit = 'D').astype(object))
+        chunk.insert(0, 'id', [f'{seed:08x}-{i:024x}' for i in range(row, row + n_chunk)])
+
+        fisher = rng.choice(fishers_per_community, n_chunk, p = fisher_weights)
+        chunk['fisher_id'] = (community * fishers_per_community + fisher + 1).astype(float)
+        buyer = community * buyers_per_community + rng.choice(buyers_per_community, n_chunk, p = buyer_weights)
+        chunk['buyer_id'] = (buyer + 1).astype(float)
+        chunk['buyer_name'] = buyer_names[buyer % len(buyer_names)]
+        chunk['buyer_gender'] = buyer_gender[buyer]
+        chunk['buying_unit'] = np.where(rng.random(n_chunk) < 0.9, 'kg', 'piece').astype(object)
+
+        sp = species.iloc[rng.choice(n_species, n_chunk, p = species_weights)].reset_index(drop = True)
+        country_index = chunk['country_id'].to_numpy() - 1
+        weight_kg = np.exp(sp['log_weight_kg'].to_numpy() + rng.normal(0, 1, n_chunk))
+        # Fish lengths between a quarter of lmax and lmax, and the count from the weight-length
+        # relation W = a*L^b (in g and cm); species with no a/b/lmax get a rough count
+        length_cm = sp['lmax'].to_numpy() * rng.uniform(0.25, 1, n_chunk)
+        fish_weight_g = sp['a'].to_numpy() * np.power(length_cm, sp['b'].to_numpy())
+        count = np.where(
+            np.isnan(fish_weight_g),
+            rng.integers(1, 50, n_chunk),
+            np.maximum(1, np.round(1e3 * weight_kg / np.where(np.isnan(fish_weight_g), 1, fish_weight_g)))
+        )
+        price_usd = weight_kg * sp['price_usd_kg'].to_numpy() * rng.lognormal(0, 0.3, n_chunk)
+
+        chunk['fishbase_id'] = sp['fishbase_id']
+        chunk['weight_kg'] = weight_kg
+        chunk['weight_lbs'] = weight_kg * 2.20462
+        chunk['count'] = np.minimum(count, 1e6)
+        chunk['total_price_local'] = price_usd * fx_rate[country_index]
+        chunk['total_price_usd'] = price_usd
+        for column in ['family_scientific', 'family_local', 'species_scientific']:
+            chunk[column] = sp[column]
+        chunk['species_local'] = [names[c] for names, c in zip(sp['species_local'], country_index)]
+        for column in ['is_focal', 'a', 'b', 'lmax']:
+            chunk[column] = sp[column]
+        chunk['hide'] = np.nan
+
+        for column, rate in MISSING_RATES.items():
+            chunk.loc[rng.random(n_chunk) < rate, column] = np.nan
+        # A missing price in local currency is missing in USD too
+        chunk.loc[chunk['total_price_local'].isna(), 'total_price_usd'] = np.nan
+        chunk.loc[chunk['weight_kg'].isna(), 'weight_lbs'] = np.nan
+
+        row += n_chunk
+        yield chunk[OURFISH_COLUMNS]
+
+def write_csv(chunks, path):
+    """
+    Write the raw chunks to one CSV file, like the one data.world serves. Returns the number of rows.
+    """
+    n_rows = 0
+    tmp_path = f'{path}.tmp'
+    for i, chunk in enumerate(chunks):
+        chunk.to_csv(tmp_path, mode = 'w' if i == 0 else 'a', header = i == 0, index = False)
+        n_rows += len(chunk)
+    os.replace(tmp_path, path)
+    return n_rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Make a synthetic OurFish dataset")
+    parser.add_argument('--rows', type = int, default = 100000, help = "number of records (10k to 100M)")
+    parser.add_argument('--csv', help = "write the raw table to this CSV file")
+    parser.add_argument('--snapshot', action = 'store_true', help = "write the processed records as the current snapshot")
+    parser.add_argument('--start', default = '2019-01-01', help = "first date (YYYY-MM-DD)")
+    parser.add_argument('--end', default = '2023-06-30', help = "last date (YYYY-MM-DD)")
+    parser.add_argument('--countries', type = int, default = 6)
+    parser.add_argument('--maa-per-lgu', type = int, default = 3, help = "with 4 SNU's per country and 4 LGU's per SNU")
+    parser.add_argument('--species', type = int, default = 600)
+    parser.add_argument('--chunk-rows', type = int, default = CHUNK_ROWS)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+    if not (args.csv or args.snapshot):
+        parser.error("give --csv and/or --snapshot")
+
+    def make_chunks():
+        return generate_ourfish_data(
+            args.rows,
+            start_date = datetime.date.fromisoformat(args.start),
+            end_date = datetime.date.fromisoformat(args.end),
+            n_countries = args.countries,
+            maa_per_lgu = args.maa_per_lgu,
+            n_species = args.species,
+            chunk_rows = args.chunk_rows,
+            seed = args.seed
+        )
+
+    started = time.time()
+    if args.csv:
+        n_rows = write_csv(make_chunks(), args.csv)
+        print(f"Wrote {n_rows} records to {args.csv} in {time.time() - started:.1f}s")
+    if args.snapshot:
+        started = time.time()
+        version = write_snapshot_chunks(process_ourfish_data(chunk) for chunk in make_chunks())
+        print(f"Wrote snapshot {version} in {time.time() - started:.1f}s")
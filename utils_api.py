@@ -0,0 +1,110 @@
+import pyarrow as pa
+import datetime
+import json
+import os
+from utils_snapshot import to_arrow
+
+# Read-only API serving the aggregates behind the dashboard (see the /api routes in app.py)
+
+# The aggregates the API serves; same names as the keys of get_output_data
+API_OUTPUTS = ["catch", "cpue-value", "length", "composition", "map", "highlights"]
+
+API_FORMATS = {
+    'json': 'application/json',
+    'arrow': 'application/vnd.apache.arrow.stream'
+}
+
+# Proxies and clients may reuse a response for this many seconds before revalidating its ETag.
+# The ETag changes with the dataset version, so a revalidation after a data refresh gets the new
+# numbers.
+API_MAX_AGE = int(os.environ.get('API_MAX_AGE', 5 * 60))
+
+class ApiError(ValueError):
+    """
+    A request the API can't answer, e.g. a malformed filter. Sent back as a 400.
+    """
+
+def parse_ids(args, name):
+    """
+    Ids given in a query parameter, either repeated (?maa=1&maa=2) or comma separated (?maa=1,2).
+    Returns None if the parameter isn't given.
+    """
+    values = [v for arg in args.getlist(name) for v in arg.split(',') if v != '']
+    if not values:
+        return None
+    try:
+        return [int(v) for v in values]
+    except ValueError:
+        raise ApiError(f"{name} must be a list of integer ids")
+
+def parse_date(args, name, default):
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise ApiError(f"{name} must be a date as YYYY-MM-DD")
+
+def parse_filters(args, geo, min_date, max_date):
+    """
+    Turn the query parameters of an API request into the filters of apply_filters.
+
+    Places are selected by id with any of country, snu, lgu and maa; the MAA's that match all of
+    the given ones are used, and all MAA's if none are given. Dates are start and end
+    (YYYY-MM-DD), defaulting to the full range of the data.
+
+    Returns sel_maa (sorted), start_date, end_date.
+    """
+    maa = geo["maa"]
+    for name, col in [('country', 'country_id'), ('snu', 'snu_id'), ('lgu', 'lgu_id'), ('maa', 'ma_id')]:
+        ids = parse_ids(args, name)
+        if ids is not None:
+            maa = maa[maa[col].isin(ids)]
+    sel_maa = sorted(int(x) for x in maa['ma_id'])
+
+    start_date = parse_date(args, 'start', min_date)
+    end_date = parse_date(args, 'end', max_date)
+    if start_date > end_date:
+        raise ApiError("start must not be after end")
+
+    return sel_maa, start_date, end_date
+
+def to_json(data, output, version, filters):
+    """
+    JSON body of an API response: the table in pandas' 'split' layout (columns, then rows as
+    lists) along with the dataset version and the filters used.
+
+    Example output:
+    {"output": "catch", "version": "3f9a1c0e8b7d2a64",
+     "filters": {"maa": [4, 7], "start": "2023-01-01", "end": "2023-06-30"},
+     "columns": ["yearmonth", "weight_mt"],
+     "data": [["2023-01-01", 0.1012], ["2023-02-01", 0.5821], ...]}
+    """
+    data = data.copy()
+    for col in data.columns:
+        # Months and dates are python dates, which to_json would send as timestamps
+        first = data[col].dropna().head(1).tolist()
+        if first and isinstance(first[0], datetime.date):
+            data[col] = data[col].map(lambda x: x.isoformat() if isinstance(x, datetime.date) else x)
+
+    table = json.loads(data.to_json(orient = 'split', index = False))
+    return json.dumps({
+        'output': output,
+        'version': version,
+        'filters': filters,
+        'columns': table['columns'],
+        'data': table['data']
+    })
+
+def to_arrow_stream(data, output, version):
+    """
+    The table as an Arrow IPC stream, with the output name and dataset version in the schema
+    metadata
+    """
+    table = to_arrow(data.reset_index(drop = True))
+    table = table.replace_schema_metadata({'output': output, 'version': str(version)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
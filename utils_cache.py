@@ -0,0 +1,127 @@
+import contextlib
+import fcntl
+import functools
+import os
+import threading
+
+class KeyedLocks:
+    """
+    One lock per key, created on demand and dropped once no thread is using it
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
+
+def single_flight(memoized):
+    """
+    Wrap a function memoized with flask-caching so that, within a process, threads asking for
+    the same uncached result wait for the first one to compute it instead of all computing it
+    at once. Different arguments still run in parallel.
+
+    The wrapper keeps the memoized function's attributes (make_cache_key, uncached, ...).
+    """
+    locks = KeyedLocks()
+
+    @functools.wraps(memoized)
+    def wrapper(*args, **kwargs):
+        key = memoized.make_cache_key(memoized.uncached, *args, **kwargs)
+        with locks.hold(key):
+            return memoized(*args, **kwargs)
+
+    return wrapper
+
+def normalized(normalize):
+    """
+    Decorator for a memoized function, passing the arguments through normalize(*args) first so
+    that equivalent calls (e.g. the same MAA's listed in another order) share one cache entry.
+    The wrapper's make_cache_key normalizes them too.
+    """
+    def decorate(memoized):
+        @functools.wraps(memoized)
+        def wrapper(*args):
+            return memoized(*normalize(*args))
+
+        wrapper.make_cache_key = lambda f, *args: memoized.make_cache_key(f, *normalize(*args))
+        return wrapper
+
+    return decorate
+
+class VersionKeys:
+    """
+    Which cache keys hold results computed from which version of the data, so a version's
+    results can be deleted once it's replaced without touching anything else in the cache.
+
+    The keys are kept in a file per version under `path`, shared by every process that writes
+    to the cache (web workers, job workers). Each process only adds a key the first time it
+    sees it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.seen = set()
+        self.seen_lock = threading.Lock()
+        os.makedirs(path, exist_ok = True)
+
+    @contextlib.contextmanager
+    def locked(self):
+        # Across processes, so no key is added to a file while it's being collected
+        with open(os.path.join(self.path, '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def add(self, version, key):
+        with self.seen_lock:
+            if (version, key) in self.seen:
+                return
+            self.seen.add((version, key))
+        with self.locked():
+            with open(os.path.join(self.path, version), 'a') as f:
+                f.write(f"{key}\n")
+
+    def versions(self):
+        return [name for name in os.listdir(self.path) if not name.startswith('.')]
+
+    def pop(self, version):
+        """
+        The keys recorded for `version`, forgetting them
+        """
+        path = os.path.join(self.path, version)
+        with self.locked():
+            try:
+                with open(path) as f:
+                    keys = set(f.read().split())
+            except FileNotFoundError:
+                return set()
+            os.remove(path)
+        with self.seen_lock:
+            self.seen = {entry for entry in self.seen if entry[0] != version}
+        return keys
+
+    def tracked(self, memoized):
+        """
+        Wrap a memoized function whose last argument is the data's version (see normalized), to
+        record the key of each result under that version. Goes above single_flight.
+        """
+        @functools.wraps(memoized)
+        def wrapper(*args):
+            result = memoized(*args)
+            self.add(str(args[-1]), memoized.make_cache_key(memoized.uncached, *args))
+            return result
+
+        return wrapper
@@ -0,0 +1,147 @@
+import gc
+import os
+import threading
+import time
+import traceback
+import weakref
+
+# The tables derived from the OurFish data are loaded once per process and shared by all
+# sessions, rather than pulled and cached per session. Under gunicorn they are loaded once in the
+# master before the workers are forked (see gunicorn_config.py), so the workers share the
+# master's copy of the memory instead of each holding their own.
+
+# Seconds after which the data is pulled again from data.world
+DATASET_MAX_AGE = int(os.environ.get('DATASET_MAX_AGE', 6 * 60 * 60))
+# Seconds to wait before trying again after a failed reload
+RETRY_INTERVAL = 60
+
+# Every Dataset still in memory, current or not. One outliving a refresh is being held on to by
+# something (see utils_memory.py).
+live_datasets = weakref.WeakSet()
+
+class Dataset:
+    """
+    One load of the data. Treat it as read-only: it's shared between sessions, threads and
+    (copy-on-write) worker processes. The records themselves stay on disk, in the snapshot of
+    `version` (see utils_snapshot.py); only the small tables every page needs are kept here.
+
+    geo: the tables from get_geo_data
+    spatial_index: the communities' grid cells (see build_spatial_index)
+    min_date, max_date: date range of the records
+    version: hash of the data (see write_snapshot)
+    loaded_at: time.time() of the load
+    """
+    def __init__(self, geo, spatial_index, min_date, max_date, version):
+        self.geo = geo
+        self.spatial_index = spatial_index
+        self.min_date = min_date
+        self.max_date = max_date
+        self.version = version
+        self.loaded_at = time.time()
+        live_datasets.add(self)
+
+    def age(self):
+        return time.time() - self.loaded_at
+
+class DatasetStore:
+    """
+    Holds the current Dataset. `load` is a function returning a new Dataset, and `on_load`, if
+    given, is called with each new Dataset once it's current.
+
+    By default the data is loaded on first use and again once it's older than DATASET_MAX_AGE.
+    After `preload` (gunicorn master), the process that preloaded is in charge of refreshing:
+    forked workers keep the data they were forked with and are replaced after a refresh.
+    """
+    def __init__(self, load, max_age = DATASET_MAX_AGE, on_load = None):
+        self.load = load
+        self.on_load = on_load
+        self.max_age = max_age
+        self.current = None
+        self.preloaded = False
+        self.retry_at = 0
+        self.lock = threading.Lock()
+        # A fork could happen while a thread holds the lock; the child gets a fresh one
+        os.register_at_fork(after_in_child = self.reset_lock)
+
+    def reset_lock(self):
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        The current Dataset, loading it first if needed. Safe to call from any thread: the first
+        load happens once, with other threads waiting for it, and once the data is stale one
+        thread reloads it in the background while the rest keep using the current data.
+        """
+        dataset = self.current
+        if dataset is None:
+            with self.lock:
+                # Another thread may have loaded it while this one waited
+                if self.current is None:
+                    self.refresh()
+            return self.current
+
+        if not self.preloaded and dataset.age() >= self.max_age and time.time() >= self.retry_at \
+                and self.lock.acquire(blocking = False):
+            threading.Thread(target = self.refresh_in_background, daemon = True).start()
+        return dataset
+
+    def refresh_in_background(self):
+        # Runs with the lock held by get
+        try:
+            self.refresh()
+        except Exception:
+            # e.g. data.world is down; keep serving the data we have and try again later
+            traceback.print_exc()
+            self.retry_at = time.time() + RETRY_INTERVAL
+        finally:
+            self.lock.release()
+
+    def refresh(self):
+        """
+        Load the data again and make it current. Sessions keep using the old data until the
+        new one is ready.
+        """
+        dataset = self.load()
+        self.current = dataset
+        if self.on_load is not None:
+            self.on_load(dataset)
+        return dataset
+
+    def preload(self, on_refresh = None):
+        """
+        Load the data now, before worker processes are forked, and keep it out of the way of
+        the garbage collector: the collector writes to every object it tracks, which would make
+        each worker copy the memory it's meant to share. Data already loaded (e.g. while
+        importing the app, which lays out the first page) is kept rather than loaded again.
+
+        If `on_refresh` is given, a background thread reloads the data every `max_age` seconds
+        and then calls on_refresh() so the workers can be replaced by ones sharing the new data.
+        """
+        if self.current is None:
+            self.refresh()
+        self.preloaded = True
+        gc.collect()
+        gc.freeze()
+
+        if on_refresh is not None:
+            def refresh_loop():
+                while True:
+                    time.sleep(self.max_age)
+                    # Hand the frozen objects back to the collector, or the data this reload
+                    # replaces could never be freed and each reload would add to the frozen set
+                    gc.unfreeze()
+                    gc.collect()
+                    try:
+                        with self.lock:
+                            self.refresh()
+                    except Exception:
+                        # e.g. data.world is down; keep serving the data we have
+                        traceback.print_exc()
+                        continue
+                    finally:
+                        # Frozen again before any worker is forked, whether or not the reload
+                        # worked: gunicorn also forks to replace workers that died
+                        gc.collect()
+                        gc.freeze()
+                    on_refresh()
+            threading.Thread(target = refresh_loop, daemon = True).start()
@@ -0,0 +1,298 @@
+from flask import send_file
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+import numpy as np
+import pandas as pd
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+import zlib
+from utils_jobs import step
+
+# Exports are saved here as artifacts named after the dataset version and a hash of the filters
+# (see get_export_key), so a repeat download of the same view is served straight from disk and
+# the exports of old versions can be told apart
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'export-directory')
+# Once the artifacts take up more than this, the least recently downloaded are removed
+EXPORT_CACHE_BYTES = int(os.environ.get('EXPORT_CACHE_BYTES', 2 * 1024**3))
+# Browsers and proxies may reuse a download for this many seconds before checking its ETag
+EXPORT_MAX_AGE = 60 * 60
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Formats for the raw record export: file name and mimetype
+RECORD_FORMATS = {
+    'csv': ('fisheries-records.csv.gz', 'application/gzip'),
+    'parquet': ('fisheries-records.parquet', 'application/vnd.apache.parquet')
+}
+
+# File extension of each kind of export
+EXPORT_EXTENSIONS = {
+    'xlsx': 'xlsx',
+    'csv': 'csv.gz',
+    'parquet': 'parquet'
+}
+
+SHEET_NAMES = {
+    "highlights": "Totals",
+    "catch": "Catches",
+    "cpue-value": "CPUE-Value",
+    "length": "Length",
+    "composition": "Catch composition",
+    "map": "Communities"
+}
+
+def get_export_key(version, kind, **filters):
+    """
+    Content address of an export: the dataset version, then a hash of the version, the kind of
+    export (see EXPORT_EXTENSIONS) and the filters. Filter values are put in a canonical form
+    (lists sorted, dates as ISO strings), so the same selection made in a different order gives
+    the same key.
+
+    Example output: 'dacbdca0af2a4e77-5e1b0c...' (the version, a dash and 64 hex digits)
+    """
+    canonical = {}
+    for name, value in filters.items():
+        if isinstance(value, (list, tuple)):
+            value = sorted(str(x) for x in value)
+        else:
+            value = str(value)
+        canonical[name] = value
+
+    payload = json.dumps([version, kind, canonical], sort_keys = True)
+    return f'{version}-{hashlib.sha256(payload.encode()).hexdigest()}'
+
+def get_export_path(key, kind):
+    """
+    Path of the artifact for an export key. Returns None for anything that isn't a key from
+    get_export_key, so a request can't reach outside EXPORT_DIR.
+    """
+    if kind not in EXPORT_EXTENSIONS or not re.fullmatch(r'[0-9a-f]+-[0-9a-f]{64}', key):
+        return None
+    return os.path.join(EXPORT_DIR, f'{key}.{EXPORT_EXTENSIONS[kind]}')
+
+def new_tmp_path(path):
+    """
+    Unique temp file next to `path`. Artifacts are written to one of these, then moved into place
+    by save_artifact, so a half-written export is never served.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    return f'{path}.{uuid.uuid4().hex}.tmp'
+
+def save_artifact(tmp_path, path):
+    """
+    Move a finished export into place and make room for it in the artifact cache
+    """
+    os.replace(tmp_path, path)
+    evict_artifacts()
+
+def touch_artifact(path):
+    """
+    Mark an artifact as just downloaded. Only the access time is changed: eviction goes by
+    access time, while the modification time is sent as Last-Modified.
+    """
+    os.utime(path, (time.time(), os.stat(path).st_mtime))
+
+def remove_artifact(path):
+    # Another thread or worker may be evicting the same file
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def evict_artifacts(max_bytes = EXPORT_CACHE_BYTES):
+    """
+    Delete the least recently downloaded artifacts until the rest fit in `max_bytes`. Temp files
+    of exports still being written are left alone, unless they were abandoned over a day ago.
+    """
+    if not os.path.isdir(EXPORT_DIR):
+        return
+
+    artifacts = []
+    for entry in os.scandir(EXPORT_DIR):
+        if not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name.endswith('.tmp'):
+            if stat.st_mtime < time.time() - 24 * 60 * 60:
+                remove_artifact(entry.path)
+            continue
+        artifacts.append((stat.st_atime, stat.st_size, entry.path))
+
+    total_bytes = sum(a[1] for a in artifacts)
+    for atime, size, path in sorted(artifacts):
+        if total_bytes <= max_bytes:
+            break
+        remove_artifact(path)
+        total_bytes -= size
+
+def remove_old_artifacts(version):
+    """
+    Delete the exports of every dataset version but `version`. Temp files are left to
+    evict_artifacts, as an export may still be writing one.
+    """
+    if not os.path.isdir(EXPORT_DIR):
+        return
+
+    for entry in os.scandir(EXPORT_DIR):
+        if entry.is_file() and not entry.name.endswith('.tmp') and not entry.name.startswith(f'{version}-'):
+            remove_artifact(entry.path)
+
+def send_artifact(path, key, download_name, mimetype):
+    """
+    Serve a saved export as a download. The export key is its ETag, and Flask answers
+    If-None-Match/If-Modified-Since requests with a 304 without reading the file.
+    """
+    touch_artifact(path)
+    # Flask resolves relative paths against the app's root, not the working directory
+    return send_file(
+        os.path.abspath(path),
+        mimetype = mimetype,
+        as_attachment = True,
+        download_name = download_name,
+        etag = key,
+        conditional = True,
+        max_age = EXPORT_MAX_AGE
+    )
+
+def write_sheet(workbook, sheet_name, data):
+    """
+    Write a dataframe to a new sheet, one row at a time.
+
+    pandas' to_excel writes a frame column by column, which xlsxwriter's constant_memory mode
+    can't handle (it only keeps the current row in memory), so rows are written here instead.
+    NaN's are left as empty cells, the same as to_excel.
+    """
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, list(data.columns))
+    for i, row in enumerate(data.itertuples(index = False, name = None), start = 1):
+        worksheet.write_row(i, 0, [None if isinstance(x, float) and np.isnan(x) else x for x in row])
+
+def get_export_metadata(geo, sel_country, sel_snu, sel_lgu, sel_maa, start_date, end_date):
+    """
+    Metadata sheet of an export: the filters it was made with. The geographic filters are
+    listed by name, not id, using the tables from get_geo_data.
+
+    Example output:
+           FILTER                    VALUE
+    0     country              Philippines
+    1         snu                    Bohol
+    2         lgu        Getafe, Inabanga
+    3         maa   Getafe MAA, Inabanga MAA
+    4  start date               2023-04-01
+    5    end date               2023-04-30
+    """
+    snu = geo["snu"]
+    lgu = geo["lgu"]
+    maa = geo["maa"]
+    snu_names = list(snu.query("snu_id.isin(@sel_snu)")['snu_name'])
+    lgu_names = list(lgu.query("lgu_id.isin(@sel_lgu)")['lgu_name'])
+    maa_names = list(maa.query("ma_id.isin(@sel_maa)")['ma_name'])
+
+    return pd.DataFrame({
+        'FILTER': ['country', 'snu', 'lgu', 'maa', 'start date', 'end date'],
+        'VALUE': [
+            ', '.join(sel_country),
+            ', '.join(snu_names),
+            ', '.join(lgu_names),
+            ', '.join(maa_names),
+            start_date, end_date
+        ]
+    })
+
+def write_workbook(path, output_data, metadata):
+    """
+    Write the output of apply_filters plus a metadata sheet to an Excel file at `path`.
+
+    The workbook uses xlsxwriter's constant_memory mode: each row is flushed to a temp file as
+    soon as the next one starts, so memory use doesn't grow with the size of the selection.
+    """
+    workbook = xlsxwriter.Workbook(path, {
+        'constant_memory': True,
+        'default_date_format': 'yyyy-mm-dd'
+    })
+    for name, data in output_data.items():
+        write_sheet(workbook, SHEET_NAMES[name], data)
+        step(f"Wrote the {SHEET_NAMES[name]} sheet")
+    write_sheet(workbook, 'metadata', metadata)
+    workbook.close()
+
+def tee_to_artifact(chunks, path):
+    """
+    Pass streamed chunks through while also writing them to the artifact at `path`. The artifact
+    is only saved if the whole stream was sent; an interrupted download leaves nothing behind.
+    """
+    tmp_path = new_tmp_path(path)
+    completed = False
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        completed = True
+    finally:
+        if completed:
+            save_artifact(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+
+def stream_records_csv(batches, columns):
+    """
+    gzip'd CSV of arrow record batches (see iter_snapshot_batches). Each batch is converted and
+    compressed as it arrives, so only one batch is ever held in memory.
+    """
+    # wbits = 31 writes a gzip header, so the output is a regular .gz file
+    compressor = zlib.compressobj(wbits = 31)
+    yield compressor.compress((','.join(columns) + '\n').encode())
+    for batch in batches:
+        text = batch.to_pandas().to_csv(index = False, header = False)
+        yield compressor.compress(text.encode())
+    yield compressor.flush()
+
+class ChunkSink:
+    """
+    Write-only file object that keeps what is written until it's drained. Lets a ParquetWriter
+    write into a streamed response one row group at a time.
+    """
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_records_parquet(batches, schema):
+    """
+    Parquet file of arrow record batches, written and sent one row group per batch
+    """
+    sink = ChunkSink()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode = 'w'), schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
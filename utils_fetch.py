@@ -0,0 +1,335 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import urllib3
+import requests
+import pandas as pd
+import contextlib
+import fcntl
+import io
+import json
+import os
+import time
+
+# Download of the OurFish CSV from data.world. The response is parsed in chunks as it arrives,
+# and every byte received is also written to a partial download on disk, so a dropped connection
+# picks up where it stopped (or, if the server can't resume, skips what was already parsed)
+# instead of starting over. The URL can point at a local stand-in (see dataworld_standin.py).
+OURFISH_CSV_URL = os.environ.get(
+    'OURFISH_CSV_URL', 'https://query.data.world/s/mlrbseaz6qipapni2wh7bp6m6eqkv2?dws=00000'
+)
+DOWNLOAD_DIR = os.environ.get('DOWNLOAD_DIR', 'download-directory')
+# The last complete download; used if data.world can't be reached at all
+DOWNLOAD_PATH = os.path.join(DOWNLOAD_DIR, 'ourfish.csv')
+
+# Seconds to wait for the connection, and for each read once connected
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# Attempts at (re)connecting before giving up, with exponential backoff between them
+FETCH_RETRIES = int(os.environ.get('FETCH_RETRIES', 5))
+BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 30
+# Rows per parsed chunk
+CHUNK_ROWS = 100 * 1000
+READ_SIZE = 1024 * 1024
+
+# Free-text and id columns are always read as strings, so a chunk where e.g. every buyer name
+# happens to be a number gets the same type as the others
+TEXT_DTYPES = {
+    col: str for col in [
+        'id', 'date', 'country', 'snu_name', 'lgu_name', 'community_name', 'ma_name',
+        'buyer_name', 'buying_unit', 'family_scientific', 'family_local',
+        'species_scientific', 'species_local'
+    ]
+}
+
+# Errors worth reconnecting after: dropped connections, timeouts, truncated responses, and
+# server errors the session already retried
+RETRYABLE_ERRORS = (
+    requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.RetryError, urllib3.exceptions.HTTPError
+)
+
+session = None
+
+def get_session():
+    """
+    Shared HTTP session: keeps connections open between fetches and retries failed connections
+    and 429/5xx responses with backoff
+    """
+    global session
+    if session is None:
+        retry = Retry(
+            total = FETCH_RETRIES,
+            backoff_factor = BACKOFF_SECONDS,
+            status_forcelist = [429, 500, 502, 503, 504],
+            allowed_methods = ['GET']
+        )
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(max_retries = retry))
+        session.mount('https://', HTTPAdapter(max_retries = retry))
+    return session
+
+class DataChanged(Exception):
+    """
+    The data on the server changed during a download, so the part already parsed is useless
+    """
+
+class UnsupportedEncoding(Exception):
+    """
+    The server compressed the download in a way urllib3 can't decode
+    """
+
+def get_content_encoding(response):
+    """
+    The Content-Encoding of a response, lowercased; None when it isn't encoded
+    """
+    encoding = response.headers.get('Content-Encoding', '').strip().lower()
+    return None if encoding in ('', 'identity') else encoding
+
+class ResumableDownload(io.RawIOBase):
+    """
+    Read-only file object over an HTTP download.
+
+    Everything read from the network is appended to `path`.part. When the connection drops, it
+    reconnects with a Range request for the rest; if the server sends the whole file instead,
+    the bytes already read are skipped. A .part left by an earlier, interrupted download is
+    replayed first, as long as the server confirms (If-Range) that the file hasn't changed.
+
+    The file is asked for uncompressed. A server that compresses it anyway is read decoded,
+    without ranges: ranges would count the compressed bytes, while the .part file has the
+    decoded ones, so on reconnecting the whole file is fetched again and the part already read
+    is skipped.
+    """
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.part_path = f'{path}.part'
+        self.meta_path = f'{path}.part.json'
+        self.response = None
+        self.validator = None
+        self.length = None
+        self.received = 0  # bytes in the .part file
+        self.position = 0  # bytes handed to the reader
+        self.replay = None
+        self.attempts = 0
+        # Set once the server sends the file compressed (see get_content_encoding)
+        self.decode = False
+
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        meta = self.read_meta()
+        if meta.get('url') == url and meta.get('validator') and os.path.exists(self.part_path):
+            self.validator = meta['validator']
+            self.length = meta.get('length')
+            self.received = os.path.getsize(self.part_path)
+
+        self.connect()
+        if self.received:
+            self.replay = open(self.part_path, 'rb')
+        self.out = open(self.part_path, 'ab' if self.received else 'wb')
+
+    def read_meta(self):
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_meta(self):
+        with open(self.meta_path, 'w') as f:
+            json.dump({'url': self.url, 'validator': self.validator, 'length': self.length}, f)
+
+    def connect(self):
+        """
+        (Re)open the response at byte `received`, backing off between failed attempts
+        """
+        while True:
+            if self.response is not None:
+                self.response.close()
+                self.response = None
+            try:
+                self.open_response()
+                return
+            except DataChanged:
+                raise
+            except RETRYABLE_ERRORS:
+                self.attempts += 1
+                if self.attempts > FETCH_RETRIES:
+                    raise
+                time.sleep(min(BACKOFF_SECONDS * 2**(self.attempts - 1), MAX_BACKOFF_SECONDS))
+
+    def open_response(self):
+        # Ranges count bytes as sent, so ask for the file uncompressed
+        headers = {'Accept-Encoding': 'identity'}
+        if self.received and not self.decode:
+            headers['Range'] = f'bytes={self.received}-'
+            if self.validator:
+                headers['If-Range'] = self.validator
+
+        response = get_session().get(
+            self.url, headers = headers, stream = True, timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        )
+        if response.status_code == 416 and self.position == 0:
+            # The .part file is already complete (or longer than the file now); start over
+            response.close()
+            self.received = 0
+            return self.open_response()
+        response.raise_for_status()
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+        encoding = get_content_encoding(response)
+        if encoding is not None:
+            if encoding not in response.raw.CONTENT_DECODERS:
+                response.close()
+                raise UnsupportedEncoding(
+                    f"{self.url} was sent with Content-Encoding: {encoding}, which can't be decoded"
+                )
+            # From here on, whole responses only (see above)
+            self.decode = True
+            if response.status_code == 206:
+                response.close()
+                return self.open_response()
+
+        if response.status_code == 206:
+            self.response = response
+            return
+
+        # The whole file: either a first request, or the server can't (or won't) resume.
+        # Content-Length counts the compressed bytes of an encoded response, so it isn't kept.
+        length = response.headers.get('Content-Length')
+        length = int(length) if length is not None and encoding is None else None
+        if self.position and (
+            (self.validator and validator != self.validator) or
+            (self.length and length and length != self.length)
+        ):
+            response.close()
+            raise DataChanged()
+
+        if self.position == 0:
+            # Nothing handed out yet, so start over from this response
+            self.received = 0
+            if self.replay is not None:
+                self.replay.close()
+                self.replay = None
+            if hasattr(self, 'out'):
+                self.out.seek(0)
+                self.out.truncate()
+        else:
+            # Skip what the .part file already has
+            to_skip = self.received
+            while to_skip:
+                skipped = response.raw.read(min(to_skip, READ_SIZE), decode_content = self.decode)
+                if not skipped:
+                    raise urllib3.exceptions.ProtocolError("response ended early")
+                to_skip -= len(skipped)
+
+        self.validator = validator
+        self.length = length
+        self.write_meta()
+        self.response = response
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.read_some(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read_some(self, size):
+        if self.replay is not None:
+            data = self.replay.read(min(size, self.received - self.position))
+            if data:
+                self.position += len(data)
+                return data
+            self.replay.close()
+            self.replay = None
+
+        while True:
+            try:
+                data = self.response.raw.read(size, decode_content = self.decode)
+            except RETRYABLE_ERRORS:
+                self.connect()
+                continue
+
+            if not data and self.length is not None and self.received < self.length:
+                # The connection closed before the end
+                self.connect()
+                continue
+
+            self.out.write(data)
+            self.received += len(data)
+            self.position += len(data)
+            self.attempts = 0
+            return data
+
+    def finish(self):
+        """
+        Keep the completed download as `path`
+        """
+        self.out.close()
+        os.replace(self.part_path, self.path)
+        os.remove(self.meta_path)
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+        if self.replay is not None:
+            self.replay.close()
+        if hasattr(self, 'out') and not self.out.closed:
+            self.out.close()
+        super().close()
+
+def parse_csv(stream):
+    """
+    Parse the OurFish CSV from a file object in chunks of CHUNK_ROWS rows, so parsing keeps pace
+    with the download rather than waiting for the whole file
+    """
+    chunks = pd.read_csv(stream, chunksize = CHUNK_ROWS, dtype = TEXT_DTYPES)
+    return pd.concat(chunks, ignore_index = True)
+
+@contextlib.contextmanager
+def download_lock(path):
+    """
+    Hold an exclusive lock on the download to `path` across processes: the web app and the job
+    workers start at the same time and would otherwise write the same partial file
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    with open(f'{path}.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def fetch_ourfish_csv(url = OURFISH_CSV_URL, path = DOWNLOAD_PATH):
+    """
+    Download and parse the OurFish CSV. If the data changes on the server mid-download, the
+    download starts over once. If the server can't be reached at all, the last complete
+    download is used, when there is one. One process downloads at a time.
+    """
+    with download_lock(path):
+        return download_ourfish_csv(url, path)
+
+def download_ourfish_csv(url, path):
+    for attempt in range(2):
+        try:
+            download = ResumableDownload(url, path)
+        except RETRYABLE_ERRORS:
+            if os.path.exists(path):
+                return parse_csv(path)
+            raise
+
+        try:
+            with download:
+                all_data = parse_csv(io.BufferedReader(download, buffer_size = READ_SIZE))
+                download.finish()
+            return all_data
+        except DataChanged:
+            os.remove(download.part_path)
+            if attempt == 1:
+                raise
+        except RETRYABLE_ERRORS:
+            # The .part file stays, so the next fetch resumes from it
+            if os.path.exists(path):
+                return parse_csv(path)
+            raise
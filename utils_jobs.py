@@ -0,0 +1,273 @@
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+# Long tasks (exports, big recomputations) are put on a queue in this sqlite database and run by
+# worker processes (see jobs_worker.py), so they don't tie up the web workers. The queue
+# survives restarts; jobs left running by a worker that died are picked up again.
+JOBS_DIR = os.environ.get('JOBS_DIR', 'jobs-directory')
+JOBS_PATH = os.path.join(JOBS_DIR, 'jobs.sqlite')
+# Seconds between worker heartbeats, and after which a silent worker is considered dead
+HEARTBEAT_INTERVAL = 5
+WORKER_TIMEOUT = 30
+# Seconds an idle worker waits before checking the queue again
+POLL_INTERVAL = 0.5
+# Finished jobs are deleted after this many seconds
+JOB_MAX_AGE = 24 * 60 * 60
+# A job is started this many times at most: one whose workers keep dying (e.g. an export killed
+# for running out of memory) is failed rather than requeued to kill the next worker
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+
+local = threading.local()
+logger = logging.getLogger(__name__)
+
+@contextlib.contextmanager
+def progress_steps(progress, n_steps):
+    """
+    Within the `with` block, each call of `step` in this thread moves `progress` (a task's
+    progress function) on by 1 / `n_steps`. Lets the code a task calls report how far along it
+    is without being passed the job.
+    """
+    local.steps = {'progress': progress, 'done': 0, 'n': n_steps}
+    try:
+        yield
+    finally:
+        local.steps = None
+
+def step(message):
+    """
+    Report that a step of the running job is done; does nothing outside of progress_steps
+    (e.g. when the work is done inline by a callback)
+    """
+    steps = getattr(local, 'steps', None)
+    if steps is None:
+        return
+    steps['done'] += 1
+    steps['progress'](min(steps['done'] / steps['n'], 0.99), message)
+
+class JobQueue:
+    """
+    Persistent job queue. Tasks are registered with the `task` decorator, submitted by name with
+    JSON-serializable params, and run by `work`/`run_workers`. A task is called as
+    task(params, progress) where progress(fraction, message) reports how far along it is, and
+    returns a JSON-serializable result.
+
+    Job states: queued -> running -> done | failed
+    """
+    def __init__(self, path = JOBS_PATH):
+        self.path = path
+        self.tasks = {}
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT,
+                    params TEXT,
+                    status TEXT,
+                    progress REAL,
+                    message TEXT,
+                    result TEXT,
+                    error TEXT,
+                    worker TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    created REAL,
+                    updated REAL
+                )
+            """)
+            # Queues made before jobs counted their attempts
+            columns = [row['name'] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if 'attempts' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER DEFAULT 0")
+            conn.execute("CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, heartbeat REAL)")
+
+    @contextlib.contextmanager
+    def connect(self):
+        # Autocommit; claim() opens its own transaction
+        conn = sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def task(self, kind):
+        """
+        Decorator registering a function as the task for jobs of `kind`
+        """
+        def register(f):
+            self.tasks[kind] = f
+            return f
+        return register
+
+    def submit(self, kind, params):
+        """
+        Queue a job and return its id. If the same job is already queued or running, its id is
+        returned instead, so repeated clicks don't pile up duplicate work.
+        """
+        params = json.dumps(params, sort_keys = True, default = str)
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (now - JOB_MAX_AGE,))
+            existing = conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND params = ? AND status IN ('queued', 'running')",
+                (kind, params)
+            ).fetchone()
+            if existing is not None:
+                return existing['id']
+
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, kind, params, status, progress, message, created, updated) \
+                VALUES (?, ?, ?, 'queued', 0, 'Queued', ?, ?)",
+                (job_id, kind, params, now, now)
+            )
+        return job_id
+
+    def get(self, job_id):
+        """
+        Status of a job as a dict (status, progress, message, result, error), or None if there
+        is no such job
+        """
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT status, progress, message, result, error FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def has_workers(self):
+        """
+        Whether any worker has checked in recently. Callers run the work inline when there are
+        none, rather than queueing jobs no one will pick up.
+        """
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) AS n FROM workers WHERE heartbeat > ?", (time.time() - WORKER_TIMEOUT,)
+            ).fetchone()
+        return row['n'] > 0
+
+    def set_progress(self, job_id, progress, message = ''):
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ?, message = ?, updated = ? WHERE id = ?",
+                (progress, message, time.time(), job_id)
+            )
+
+    def claim(self, worker_id):
+        """
+        Take the oldest queued job for `worker_id`. Returns (job_id, kind, params) or None.
+        """
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id, kind, params FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', message = 'Starting', worker = ?, attempts = attempts + 1, \
+                    updated = ? WHERE id = ?",
+                    (worker_id, time.time(), row['id'])
+                )
+            conn.execute("COMMIT")
+
+        if row is None:
+            return None
+        return row['id'], row['kind'], json.loads(row['params'])
+
+    def heartbeat(self, worker_id):
+        """
+        Record that a worker is alive, and put the jobs of workers that stopped checking in
+        back on the queue, or fail them if they were already tried JOB_MAX_ATTEMPTS times
+        """
+        now = time.time()
+        dead_workers = "worker NOT IN (SELECT id FROM workers WHERE heartbeat > ?)"
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (id, heartbeat) VALUES (?, ?)", (worker_id, now))
+            conn.execute(
+                f"UPDATE jobs SET status = 'failed', message = 'Failed', \
+                error = 'The worker running it died ' || attempts || ' times', updated = ? \
+                WHERE status = 'running' AND attempts >= ? AND {dead_workers}",
+                (now, JOB_MAX_ATTEMPTS, now - WORKER_TIMEOUT)
+            )
+            conn.execute(
+                f"UPDATE jobs SET status = 'queued', message = 'Requeued', worker = NULL, updated = ? \
+                WHERE status = 'running' AND {dead_workers}",
+                (now, now - WORKER_TIMEOUT)
+            )
+            conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - JOB_MAX_AGE,))
+
+    def run_job(self, job_id, kind, params):
+        try:
+            result = self.tasks[kind](params, lambda progress, message = '': self.set_progress(job_id, progress, message))
+        except Exception:
+            with self.connect() as conn:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', message = 'Failed', error = ?, updated = ? WHERE id = ?",
+                    (traceback.format_exc(), time.time(), job_id)
+                )
+            return
+
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', progress = 1, message = 'Done', result = ?, updated = ? WHERE id = ?",
+                (json.dumps(result, default = str), time.time(), job_id)
+            )
+
+    def work(self, stop = None):
+        """
+        Run queued jobs one at a time until `stop` (a threading/multiprocessing Event) is set.
+        A background thread keeps the worker's heartbeat going while long jobs run.
+        """
+        worker_id = f'{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}'
+        stop = stop or threading.Event()
+
+        def beat():
+            while not stop.is_set():
+                self.heartbeat(worker_id)
+                stop.wait(HEARTBEAT_INTERVAL)
+
+        threading.Thread(target = beat, daemon = True).start()
+        while not stop.is_set():
+            job = self.claim(worker_id)
+            if job is None:
+                stop.wait(POLL_INTERVAL)
+            else:
+                self.run_job(*job)
+
+    def run_workers(self, n_workers):
+        """
+        Run `n_workers` worker processes until interrupted. A worker that dies (killed for
+        running out of memory, say) is replaced; its job is requeued by the others' heartbeats.
+        """
+        stop = multiprocessing.Event()
+
+        def start_worker():
+            w = multiprocessing.Process(target = self.work, args = (stop,))
+            w.start()
+            return w
+
+        workers = [start_worker() for _ in range(n_workers)]
+        try:
+            while not stop.wait(HEARTBEAT_INTERVAL):
+                for i, w in enumerate(workers):
+                    if not w.is_alive():
+                        logger.warning("Job worker %d exited with code %s, starting another", w.pid, w.exitcode)
+                        workers[i] = start_worker()
+        except KeyboardInterrupt:
+            stop.set()
+            for w in workers:
+                w.join()
@@ -1,5 +1,6 @@
 import plotly.graph_objects as go
 import numpy as np
+import functools
 import os
 
 ### Dumb issue... we need the mapbox url which is saved as an environment variable
@@ -65,6 +66,121 @@ def format_number(x):
     return out
 
 
+# Zoom levels at which community coordinates are pre-bucketed into grid cells. A map at mapbox
+# zoom z is 512 * 2^z pixels wide, so a cell of CLUSTER_PX pixels spans 360 * CLUSTER_PX / (512 * 2^z)
+# degrees. Anything zoomed in past EXPAND_ZOOM shows the individual communities.
+CLUSTER_ZOOMS = [0, 2, 4, 6, 8]
+CLUSTER_PX = 64
+EXPAND_ZOOM = 9
+
+# Rough size of the map on screen, used to guess the bounds of a view we set ourselves (plotly
+# only reports bounds after the user moves the map)
+MAP_WIDTH_PX = 1440
+MAP_HEIGHT_PX = 900
+
+def cell_size(zoom):
+    """
+    Width (in degrees) of a grid cell at one of the CLUSTER_ZOOMS
+    """
+    return 360 * CLUSTER_PX / (512 * 2**zoom)
+
+def get_cluster_level(zoom):
+    """
+    The CLUSTER_ZOOMS resolution used at `zoom`, or None once communities are shown individually
+    """
+    if zoom >= EXPAND_ZOOM:
+        return None
+    return max(z for z in CLUSTER_ZOOMS if z <= max(zoom, 0))
+
+def build_spatial_index(comm):
+    """
+    Bucket each community into a grid cell at every resolution in CLUSTER_ZOOMS. Cells are
+    numbered row-major from the south-west corner of the globe, so communities sharing a cell
+    id at a given zoom are drawn as one cluster.
+
+    Example output:
+       community_id  community_lat  community_lon  cell_0  cell_2  cell_4  cell_6   cell_8
+    0           169        10.1631       124.8128      22     283    4588   73137  1167046
+    1           172        10.1415       124.7956      22     283    4588   73137  1167045
+    """
+    index = (comm
+        .loc[:, ['community_id', 'community_lat', 'community_lon']]
+        .drop_duplicates('community_id')
+        .reset_index(drop = True))
+
+    for z in CLUSTER_ZOOMS:
+        size = cell_size(z)
+        n_cols = int(np.ceil(360 / size))
+        row = np.floor((index['community_lat'] + 90) / size).astype(int)
+        col = np.floor((index['community_lon'] + 180) / size).astype(int)
+        index[f'cell_{z}'] = row * n_cols + col
+
+    return index
+
+def get_viewport(relayout_data):
+    """
+    Pull the map center, zoom and visible bounds out of a mapbox relayoutData event. Returns None
+    if the event did not move the map (e.g. the initial autosize event).
+
+    Bounds are returned as (south, west, north, east). Plotly only reports the corners of the
+    view in 'mapbox._derived'; if those are missing the bounds are estimated with get_bounds.
+    """
+    if not relayout_data or 'mapbox.zoom' not in relayout_data:
+        return None
+
+    center = relayout_data['mapbox.center']
+    zoom = relayout_data['mapbox.zoom']
+    corners = relayout_data.get('mapbox._derived', {}).get('coordinates')
+    if corners:
+        lons = [c[0] for c in corners]
+        lats = [c[1] for c in corners]
+        bounds = (min(lats), min(lons), max(lats), max(lons))
+    else:
+        bounds = get_bounds(center, zoom)
+
+    return center, zoom, bounds
+
+def get_bounds(center, zoom):
+    """
+    Estimate the (south, west, north, east) bounds of a MAP_WIDTH_PX x MAP_HEIGHT_PX map
+    centered on `center` at `zoom`
+    """
+    deg_per_px = 360 / (512 * 2**zoom)
+    half_lon = deg_per_px * MAP_WIDTH_PX / 2
+    # Mercator squashes latitude away from the equator
+    half_lat = deg_per_px * MAP_HEIGHT_PX / 2 * np.cos(np.radians(center['lat']))
+
+    return (
+        max(center['lat'] - half_lat, -90),
+        max(center['lon'] - half_lon, -180),
+        min(center['lat'] + half_lat, 90),
+        min(center['lon'] + half_lon, 180)
+    )
+
+def pad_bounds(bounds):
+    """
+    Grow bounds by half a view on every side, so small pans don't leave the edge of the map empty
+    """
+    south, west, north, east = bounds
+    pad_lat = (north - south) / 2
+    pad_lon = (east - west) / 2
+
+    return (
+        max(south - pad_lat, -90),
+        max(west - pad_lon, -180),
+        min(north + pad_lat, 90),
+        min(east + pad_lon, 180)
+    )
+
+def contains_bounds(outer, inner):
+    """
+    Whether the `inner` bounds lie entirely within the `outer` bounds
+    """
+    return (
+        outer[0] <= inner[0] and outer[1] <= inner[1] and
+        inner[2] <= outer[2] and inner[3] <= outer[3]
+    )
+
 def get_map_data(data, comm):
     return (
         data.loc[:, [
@@ -80,46 +196,78 @@ def get_map_data(data, comm):
         .reset_index(drop = True)
     )
 
-def make_map(map_data, mapbox_url):
-    map_data[['population', 'est_fishers', 'est_buyers', 'weight_mt', 'total_price_usd']] = map_data[['population', 'est_fishers', 'est_buyers', 'weight_mt', 'total_price_usd']].applymap(format_number)
-    hovertext_list = [
-        "Community: {}<br>\
-Population: {}<br>\
-Estimated fishers: {}<br>\
-Estimated buyers: {}<br>\
-Total catch weight (mt): {}<br>\
-Total catch value (USD): {}<br>\
-        ".format(comm_name, pop, n_fisher, n_buyer, catch_weight, catch_value) \
-        for comm_name, pop, n_fisher, n_buyer, catch_weight, catch_value \
-        in map_data[['community_name', 'population', 'est_fishers', 'est_buyers', 'weight_mt', 'total_price_usd']].apply(tuple, axis = 1)
-    ]
+def get_cluster_data(map_data, index, zoom, bounds = None):
+    """
+    Aggregate the per-community output of get_map_data into grid clusters suited to `zoom`,
+    keeping only the communities the spatial index places inside `bounds` (south, west, north, east).
+
+    Past EXPAND_ZOOM the communities are returned as they are. Clusters sum the catch weight,
+    value, population and estimated fishers/buyers of their communities and sit at the mean
+    location of those communities.
+
+    Example output:
+        community_name  n_communities  community_lat  community_lon  population  est_fishers  ...
+    0   13 communities             13       9.843692     124.231538     45215.0       5630.0  ...
+    1      Talisay                  1      10.733200     122.970600      1893.0        412.0  ...
+    """
+    if bounds is not None:
+        south, west, north, east = bounds
+        in_view = index.query(
+            "@south <= community_lat <= @north & \
+            @west <= community_lon <= @east"
+        )['community_id']
+        map_data = map_data[map_data['community_id'].isin(in_view)]
+
+    level = get_cluster_level(zoom)
+    if level is None:
+        return map_data.assign(n_communities = 1).reset_index(drop = True)
+
+    clusters = (map_data
+        .merge(index[['community_id', f'cell_{level}']], on = 'community_id', how = 'left')
+        .groupby(f'cell_{level}')
+        .agg(
+            community_name = ('community_name', 'first'),
+            n_communities = ('community_id', 'nunique'),
+            community_lat = ('community_lat', 'mean'),
+            community_lon = ('community_lon', 'mean'),
+            population = ('population', 'sum'),
+            est_fishers = ('est_fishers', 'sum'),
+            est_buyers = ('est_buyers', 'sum'),
+            weight_mt = ('weight_mt', 'sum'),
+            total_price_usd = ('total_price_usd', 'sum')
+        ).reset_index(drop = True))
+
+    is_cluster = clusters['n_communities'] > 1
+    clusters.loc[is_cluster, 'community_name'] = clusters.loc[is_cluster, 'n_communities'].astype(str) + ' communities'
+
+    return clusters
 
+def get_map_view(map_data):
+    """
+    Choose a center and zoom level that fit every point in `map_data`
+    """
     ########## # TODO
     # Tweak the parameters here... like the 1, 5, and 15
     # Where did this equation come from? I made it up. It works OK as it is rn tbh, but could be better
-    zoom_level = max(1, round(5 - map_data['community_lat'].std() * map_data['community_lon'].std() / 15))
-
-    fig = go.Figure()
-    fig.add_trace(go.Scattermapbox(
-        lat = map_data['community_lat'], lon = map_data['community_lon'],
-        mode = 'markers',
-        marker = go.scattermapbox.Marker(
-            size = 15,
-            color = '#6fbcc3'
-        ),
-        hoverinfo = 'none'
-    ))
-    fig.add_trace(go.Scattermapbox(
-        lat = map_data['community_lat'], lon = map_data['community_lon'],
-        mode = 'markers',
-        marker = go.scattermapbox.Marker(
-            size = 10,
-            color = '#99f2e8'
-        ),
-        hoverinfo = 'text',
-        hovertext = hovertext_list,
-    ))
-    fig.update_layout(
+    if map_data['community_lat'].count() == 0:
+        # Nothing to fit, e.g. no records in the selection
+        return {'lat': 0.0, 'lon': 0.0}, 1
+    # With a single community there's no spread (std is NaN), so it gets the closest zoom
+    spread = np.nan_to_num(map_data['community_lat'].std() * map_data['community_lon'].std())
+    zoom_level = max(1, round(5 - spread / 15))
+    center = {
+        'lat': float(map_data['community_lat'].mean()),
+        'lon': float(map_data['community_lon'].mean())
+    }
+
+    return center, zoom_level
+
+@functools.lru_cache()
+def get_map_layout(mapbox_url):
+    """
+    Validated base layout for the map, built once. make_map only fills in the center and zoom.
+    """
+    return go.Layout(
         mapbox_style = 'white-bg',
         mapbox_layers = [
             {
@@ -129,13 +277,6 @@ Total catch value (USD): {}<br>\
                 'source': [mapbox_url]
             }
         ],
-        mapbox = {
-            'center': {
-                'lat': map_data['community_lat'].mean(),
-                'lon': map_data['community_lon'].mean()
-            },
-            'zoom': zoom_level
-        },
         showlegend = False,
         margin = {
             't': 0,
@@ -143,6 +284,64 @@ Total catch value (USD): {}<br>\
             'b': 0,
             'l': 0
         }
-    )
+    ).to_plotly_json()
+
+def make_map(map_data, mapbox_url, center = None, zoom = None):
+    """
+    Draw the communities (or clusters of communities, see get_cluster_data) in `map_data`.
+    If no center/zoom is given, the view is fit to the points.
+
+    The figure is returned as a plain dict rather than a go.Figure; the map is redrawn on every
+    pan and zoom, and skipping plotly's validation keeps that cheap.
+    """
+    if center is None or zoom is None:
+        center, zoom = get_map_view(map_data)
+
+    map_data = map_data.copy()
+    if 'n_communities' not in map_data:
+        map_data['n_communities'] = 1
+    map_data[['population', 'est_fishers', 'est_buyers', 'weight_mt', 'total_price_usd']] = map_data[['population', 'est_fishers', 'est_buyers', 'weight_mt', 'total_price_usd']].applymap(format_number)
+    hovertext_list = [
+        "Community: {}<br>\
+Population: {}<br>\
+Estimated fishers: {}<br>\
+Estimated buyers: {}<br>\
+Total catch weight (mt): {}<br>\
+Total catch value (USD): {}<br>\
+        ".format(comm_name, pop, n_fisher, n_buyer, catch_weight, catch_value) \
+        for comm_name, pop, n_fisher, n_buyer, catch_weight, catch_value \
+        in map_data[['community_name', 'population', 'est_fishers', 'est_buyers', 'weight_mt', 'total_price_usd']].apply(tuple, axis = 1)
+    ]
+
+    lat = map_data['community_lat'].tolist()
+    lon = map_data['community_lon'].tolist()
+    # Clusters grow with the log of how many communities they hold
+    marker_size = 10 + 4 * np.log2(map_data['n_communities'])
+
+    outline_trace = {
+        'type': 'scattermapbox',
+        'lat': lat, 'lon': lon,
+        'mode': 'markers',
+        'marker': {
+            'size': (marker_size + 5).tolist(),
+            'color': '#6fbcc3'
+        },
+        'hoverinfo': 'none'
+    }
+    point_trace = {
+        'type': 'scattermapbox',
+        'lat': lat, 'lon': lon,
+        'mode': 'markers+text',
+        'marker': {
+            'size': marker_size.tolist(),
+            'color': '#99f2e8'
+        },
+        'text': [str(n) if n > 1 else '' for n in map_data['n_communities']],
+        'hoverinfo': 'text',
+        'hovertext': hovertext_list
+    }
+
+    layout = dict(get_map_layout(mapbox_url))
+    layout['mapbox'] = dict(layout['mapbox'], center = center, zoom = zoom)
 
-    return fig
+    return {'data': [outline_trace, point_trace], 'layout': layout}
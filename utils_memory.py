@@ -0,0 +1,181 @@
+import os
+import struct
+import sys
+import time
+import pandas as pd
+import psutil
+import pyarrow as pa
+
+# Where a worker's memory goes, for capacity planning and for telling what a bloated worker is
+# holding: the tables of each resident dataset, the in-process caches, arrow's memory pool, and
+# the on-disk cache tiers (entries, live and expired, and bytes). Served by /admin/memory and
+# printed by memory_report.py.
+#
+# Example output (abridged):
+# {
+#     "pid": 812,
+#     "process": {"rss": 412418048, "uss": 96251904, "arrow_allocated": 0, "arrow_peak": 183500800},
+#     "datasets": [{
+#         "version": "dacbdca0af2a4e77", "current": true, "age": 3600.4,
+#         "tables": {"geo.country": 1044, "geo.snu": 3518, ..., "spatial_index": 40360},
+#         "total": 162318
+#     }],
+#     "caches": {
+#         "memoize": {"entries": 53, "live": 53, "expired": 0, "bytes": 124030},
+#         "sessions": {"entries": 31, "live": 29, "expired": 2, "bytes": 5120},
+#         ...
+#     },
+#     "lru_caches": {"open_snapshot": 1, ...}
+# }
+
+# Kept by flask-caching's filesystem backend next to the entries
+FS_COUNT_FILE = '__wz_cache_count'
+
+def get_deep_size(obj):
+    """
+    Bytes held by a table, or by a dict/list of them, counting the python objects in object
+    columns (strings, dates)
+    """
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(obj.memory_usage(deep = True).sum())
+    if isinstance(obj, (pa.Table, pa.RecordBatch)):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(get_deep_size(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(get_deep_size(value) for value in obj)
+    return sys.getsizeof(obj)
+
+def get_dataset_memory(dataset, current = None):
+    """
+    Deep size of each table of a Dataset (see utils_dataset.py)
+    """
+    tables = {f"geo.{name}": get_deep_size(table) for name, table in dataset.geo.items()}
+    tables["spatial_index"] = get_deep_size(dataset.spatial_index)
+    return {
+        'version': dataset.version,
+        'current': dataset is current,
+        'age': round(dataset.age(), 1),
+        'tables': tables,
+        'total': sum(tables.values())
+    }
+
+def get_cache_tier_usage(path):
+    """
+    Entries and bytes of a flask-caching filesystem cache. Each entry starts with its expiry
+    time (0: never), so live and expired entries are told apart without unpickling them.
+    """
+    usage = {'entries': 0, 'live': 0, 'expired': 0, 'bytes': 0}
+    now = time.time()
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return usage
+    for name in names:
+        if name == FS_COUNT_FILE:
+            continue
+        try:
+            with open(os.path.join(path, name), 'rb') as f:
+                expires = struct.unpack('I', f.read(4))[0]
+                size = os.fstat(f.fileno()).st_size
+        except (OSError, struct.error):
+            # Evicted while we were looking, or still being written
+            continue
+        usage['entries'] += 1
+        usage['live' if expires == 0 or expires >= now else 'expired'] += 1
+        usage['bytes'] += size
+    return usage
+
+def get_directory_usage(path):
+    """
+    Files and bytes under `path`
+    """
+    usage = {'files': 0, 'bytes': 0}
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                usage['bytes'] += os.stat(os.path.join(root, name)).st_size
+                usage['files'] += 1
+            except FileNotFoundError:
+                pass
+    return usage
+
+def get_process_memory():
+    """
+    The process's memory. `uss` is what only this process holds: under gunicorn, a worker's
+    growth since it was forked, not counting the data it shares with the master.
+    """
+    process = psutil.Process()
+    try:
+        info = process.memory_full_info()
+        uss = info.uss
+    except psutil.AccessDenied:
+        info = process.memory_info()
+        uss = None
+    pool = pa.default_memory_pool()
+    return {
+        'rss': info.rss,
+        'uss': uss,
+        'shared': getattr(info, 'shared', None),
+        'arrow_allocated': pool.bytes_allocated(),
+        'arrow_peak': pool.max_memory(),
+        'arrow_backend': pool.backend_name
+    }
+
+def get_memory_report(datasets, current, caches, directories, lru_caches):
+    """
+    Memory of the process, as in the example above.
+
+    datasets: the Dataset's still in memory; current: the one being served
+    caches: {name: directory} of flask-caching filesystem caches
+    directories: {name: directory} of other files kept on disk (exports, snapshots)
+    lru_caches: {name: function} of functools.lru_cache'd functions
+    """
+    return {
+        'pid': os.getpid(),
+        'process': get_process_memory(),
+        'datasets': [get_dataset_memory(d, current) for d in sorted(datasets, key = lambda d: d.loaded_at)],
+        'caches': {name: get_cache_tier_usage(path) for name, path in caches.items()},
+        'directories': {name: get_directory_usage(path) for name, path in directories.items()},
+        'lru_caches': {name: fn.cache_info().currsize for name, fn in lru_caches.items()}
+    }
+
+def format_bytes(n):
+    if n is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024 or unit == 'GB':
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
+
+def format_memory_report(report):
+    """
+    get_memory_report as text
+    """
+    process = report['process']
+    lines = [
+        f"Process {report['pid']}",
+        f"  rss {format_bytes(process['rss'])}, uss {format_bytes(process['uss'])}, "
+        f"shared {format_bytes(process['shared'])}",
+        f"  arrow ({process['arrow_backend']}): {format_bytes(process['arrow_allocated'])} allocated, "
+        f"{format_bytes(process['arrow_peak'])} at peak",
+        "",
+        "Datasets"
+    ]
+    for d in report['datasets']:
+        lines.append(f"  {d['version']}{' (current)' if d['current'] else ''}, loaded {d['age']:.0f} s ago: "
+                     f"{format_bytes(d['total'])}")
+        for name, size in d['tables'].items():
+            lines.append(f"    {name:20} {format_bytes(size):>10}")
+
+    lines += ["", "Cache tiers"]
+    for name, usage in report['caches'].items():
+        lines.append(f"  {name:20} {usage['entries']:7} entries ({usage['live']} live, {usage['expired']} expired) "
+                     f"{format_bytes(usage['bytes']):>10}")
+    for name, usage in report['directories'].items():
+        lines.append(f"  {name:20} {usage['files']:7} files {format_bytes(usage['bytes']):>33}")
+
+    lines += ["", "In-process caches"]
+    for name, entries in report['lru_caches'].items():
+        lines.append(f"  {name:20} {entries:7} entries")
+    return '\n'.join(lines)
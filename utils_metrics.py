@@ -0,0 +1,186 @@
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+from dash.exceptions import PreventUpdate
+import contextlib
+import functools
+import hmac
+import ipaddress
+import os
+import threading
+import time
+
+# Timings and counters of the app, served in Prometheus text format by the /metrics route.
+#
+# Under gunicorn each worker keeps its own values in files under PROMETHEUS_MULTIPROC_DIR (set in
+# gunicorn_config.py before the app is imported), and a scrape of any worker adds up all of them.
+# Gauges that describe the current state (dataset age, cache size) are computed at scrape time
+# instead of stored.
+
+# Requests to /metrics need this bearer token; without one, only requests from this machine get
+# an answer
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Seconds; callbacks range from a few ms (dropdowns) to a minute (a big uncached export)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CALLBACK_SECONDS = Histogram(
+    'ourfish_callback_seconds', "Time spent in Dash callbacks", ['callback'], buckets = BUCKETS
+)
+CALLBACK_ERRORS = Counter(
+    'ourfish_callback_errors_total', "Dash callbacks that raised an exception", ['callback']
+)
+STAGE_SECONDS = Histogram(
+    'ourfish_stage_seconds', "Time spent in each step of computing the outputs", ['stage'], buckets = BUCKETS
+)
+CACHE_CALLS = Counter(
+    'ourfish_cache_calls_total', "Calls to memoized functions, by whether the cache had the result",
+    ['function', 'result']
+)
+CACHED_CALL_SECONDS = Histogram(
+    'ourfish_cached_call_seconds', "Time spent in memoized functions, cached or not",
+    ['function', 'result'], buckets = BUCKETS
+)
+
+def timed_callback(name):
+    """
+    Decorator recording the time a Dash callback takes, and whether it raised. Goes under
+    @app.callback.
+    """
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            except PreventUpdate:
+                raise
+            except Exception:
+                CALLBACK_ERRORS.labels(name).inc()
+                raise
+            finally:
+                CALLBACK_SECONDS.labels(name).observe(time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    """
+    Record the time the `with` block takes under `stage`
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+class CacheTracker:
+    """
+    Counts hits and misses of a function memoized with flask-caching. `calls` goes above the
+    memoize decorator and `misses` right on the function, below it; a call in which the function
+    itself ran was a miss:
+
+        tracker = CacheTracker('apply_filters')
+
+        @tracker.calls
+        @cache.memoize()
+        @tracker.misses
+        def apply_filters(...)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.local = threading.local()
+
+    def calls(self, memoized):
+        @functools.wraps(memoized)
+        def wrapper(*args, **kwargs):
+            missed = getattr(self.local, 'missed', False)
+            self.local.missed = False
+            started = time.perf_counter()
+            try:
+                return memoized(*args, **kwargs)
+            finally:
+                result = 'miss' if self.local.missed else 'hit'
+                self.local.missed = missed
+                CACHE_CALLS.labels(self.name, result).inc()
+                CACHED_CALL_SECONDS.labels(self.name, result).observe(time.perf_counter() - started)
+        return wrapper
+
+    def misses(self, f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            self.local.missed = True
+            return f(*args, **kwargs)
+        return wrapper
+
+def get_directory_size(path):
+    """
+    Number of files and their total bytes under `path`
+    """
+    n_files = n_bytes = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                n_bytes += os.stat(os.path.join(root, name)).st_size
+                n_files += 1
+            except FileNotFoundError:
+                # Evicted while we were looking
+                pass
+    return n_files, n_bytes
+
+class StateCollector:
+    """
+    Gauges computed when scraped. `get_state` returns a dict with:
+
+    dataset: the current Dataset, or None if none is loaded yet
+    caches: {name: directory} of the caches to report the size of
+    """
+    def __init__(self, get_state):
+        self.get_state = get_state
+
+    def collect(self):
+        state = self.get_state()
+        dataset = state.get('dataset')
+        if dataset is not None:
+            info = GaugeMetricFamily('ourfish_dataset_info', "Version of the loaded dataset", labels = ['version'])
+            info.add_metric([dataset.version], 1)
+            yield info
+            yield GaugeMetricFamily(
+                'ourfish_dataset_loaded_timestamp_seconds', "When the dataset was loaded", value = dataset.loaded_at
+            )
+            yield GaugeMetricFamily(
+                'ourfish_dataset_age_seconds', "Seconds since the dataset was loaded", value = dataset.age()
+            )
+
+        entries = GaugeMetricFamily('ourfish_cache_entries', "Files in each cache", labels = ['cache'])
+        size = GaugeMetricFamily('ourfish_cache_bytes', "Bytes in each cache", labels = ['cache'])
+        for name, path in state.get('caches', {}).items():
+            n_files, n_bytes = get_directory_size(path)
+            entries.add_metric([name], n_files)
+            size.add_metric([name], n_bytes)
+        yield entries
+        yield size
+
+def is_allowed(remote_addr, authorization):
+    """
+    Whether a request may read the metrics (see METRICS_TOKEN)
+    """
+    if METRICS_TOKEN:
+        return hmac.compare_digest(authorization or '', f'Bearer {METRICS_TOKEN}')
+    try:
+        return ipaddress.ip_address(remote_addr or '').is_loopback
+    except ValueError:
+        return False
+
+def render_metrics(get_state):
+    """
+    The metrics in Prometheus text format, and its content type
+    """
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    state = CollectorRegistry()
+    state.register(StateCollector(get_state))
+    return generate_latest(registry) + generate_latest(state), CONTENT_TYPE_LATEST
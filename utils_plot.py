@@ -2,6 +2,8 @@ import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import numpy as np
+import functools
+import os
 
 COLORS = {
     'rare-blue': '#005BBB',
@@ -25,6 +27,39 @@ pretty_template = {
     }
 }
 
+# How the chart data is encoded for the browser. 'compact' rounds the plotted measures to
+# DISPLAY_SIGFIGS significant figures and sends months as 'YYYY-MM'; 'full' sends them as they are.
+# Many field users are on slow connections, so compact is the default.
+FIGURE_ENCODING = os.environ.get('FIGURE_ENCODING', 'compact')
+DISPLAY_SIGFIGS = 4
+
+def encode_months(yearmonth):
+    """
+    x values for a monthly series. Compact encoding formats the months as 'YYYY-MM' strings,
+    which plotly reads as dates. A figure's traces are given the same list, which only saves
+    formatting it twice: the figure's JSON still has a copy of it in every trace.
+    """
+    if FIGURE_ENCODING != 'compact':
+        return yearmonth
+    return [d.strftime('%Y-%m') for d in yearmonth]
+
+def encode_measure(values):
+    """
+    y values for a chart. Compact encoding rounds them to DISPLAY_SIGFIGS significant figures,
+    which is more than the axes or hover labels show, and sends whole numbers without the '.0'
+    """
+    if FIGURE_ENCODING != 'compact':
+        return values
+
+    encoded = []
+    for x in values:
+        if np.isnan(x):
+            encoded.append(None)
+        else:
+            x = float(f'{x:.{DISPLAY_SIGFIGS}g}')
+            encoded.append(int(x) if x.is_integer() else x)
+    return encoded
+
 def get_catch_data(data):
     """
     Monthly catch weight
@@ -178,162 +213,211 @@ def get_composition_data(data):
         "species_local": lambda x: "/".join(np.unique(x)),
         "weight_mt": "sum"
     }).reset_index()
+    # Ties broken by name, and a stable sort, as in utils_sql.COMPOSITION_SQL, so both backends
+    # pick the same top 10
     .sort_values(
-        by = 'weight_mt',
+        by = ['weight_mt', 'species_scientific'],
         axis = 0,
-        ascending = False
+        ascending = [False, True],
+        kind = 'stable'
     ).iloc[:10,])
 
-def make_catch_fig(catch_data):
+@functools.lru_cache()
+def get_fig_template(chart):
     """
-    Put catch data on a bar plot
-    """
-    fig = go.Figure()
-    fig.add_trace(go.Bar(
-        x = catch_data['yearmonth'],
-        y = catch_data['weight_mt'],
-        marker_color = COLORS['rare-blue']
-    ))
+    Build `chart` once with empty data and keep the validated figure as plain dicts.
 
-    fig.update_layout(
-        title = "Total Catch per Month (metric tons)",
-        xaxis_title = "",
-        height = 400
-    )
-
-    fig.update_xaxes(fixedrange = True)
-    fig.update_yaxes(fixedrange = True)
+    Constructing a go.Figure validates every trace and layout property, which is most of the
+    cost of making a figure. The make_*_fig functions instead copy a template and drop the
+    data arrays into its traces (see fill_fig_template).
+    """
+    if chart == 'catch':
+        fig = go.Figure()
+        fig.add_trace(go.Bar(
+            x = [],
+            y = [],
+            marker_color = COLORS['rare-blue']
+        ))
 
-    return fig
+        fig.update_layout(
+            title = "Total Catch per Month (metric tons)",
+            xaxis_title = "",
+            height = 400
+        )
 
-def make_cpue_value_fig(cpue_value_data):
-    """
-    Put CPUE/value data on a line plot
-    """
-    fig = make_subplots(specs = [[{'secondary_y': True}]])
-    fig.add_trace(
-        go.Scatter(
-            x = cpue_value_data['yearmonth'],
-            y = cpue_value_data['cpue_kg_boat'],
-            name = 'CPUE (kg/boat)',
-            marker_color = COLORS['rare-blue'],
-            yaxis = 'y'
-        ), secondary_y = False
-    )
-    fig.add_trace(
-        go.Scatter(
-            x = cpue_value_data['yearmonth'],
-            y = cpue_value_data['avg_catch_value_usd'],
-            name = 'Catch Value (USD/boat)',
-            marker_color = COLORS['secondary-red'],
-            yaxis = 'y2'
-        ), secondary_y = True
-    )
-    fig.update_layout(
-        title = 'CPUE and Catch Value per Boat',
-        xaxis_title = '',
-        yaxis = {
-            'titlefont': {
-                'color': COLORS['rare-blue']
+        fig.update_xaxes(fixedrange = True)
+        fig.update_yaxes(fixedrange = True)
+    elif chart == 'cpue-value':
+        fig = make_subplots(specs = [[{'secondary_y': True}]])
+        fig.add_trace(
+            go.Scatter(
+                x = [],
+                y = [],
+                name = 'CPUE (kg/boat)',
+                marker_color = COLORS['rare-blue'],
+                yaxis = 'y'
+            ), secondary_y = False
+        )
+        fig.add_trace(
+            go.Scatter(
+                x = [],
+                y = [],
+                name = 'Catch Value (USD/boat)',
+                marker_color = COLORS['secondary-red'],
+                yaxis = 'y2'
+            ), secondary_y = True
+        )
+        fig.update_layout(
+            title = 'CPUE and Catch Value per Boat',
+            xaxis_title = '',
+            yaxis = {
+                'titlefont': {
+                    'color': COLORS['rare-blue']
+                },
+                'tickfont': {
+                    'color': COLORS['rare-blue']
+                },
+                'nticks': 4
             },
-            'tickfont': {
-                'color': COLORS['rare-blue']
+            yaxis2 = {
+                'titlefont': {
+                    'color': COLORS['secondary-red']
+                },
+                'tickfont': {
+                    'color': COLORS['secondary-red']
+                },
+                'nticks': 4
             },
-            'nticks': 4
-        },
-        yaxis2 = {
-            'titlefont': {
-                'color': COLORS['secondary-red']
+            legend = {
+                'orientation': 'h'
             },
-            'tickfont': {
-                'color': COLORS['secondary-red']
+            height = 400
+        )
+
+        fig.update_xaxes(fixedrange = True)
+        fig.update_yaxes(fixedrange = True)
+    elif chart == 'length':
+        fig = make_subplots(specs = [[{'secondary_y': True}]])
+        fig.add_trace(
+            go.Scatter(
+                x = [],
+                y = [],
+                name = 'Average length (cm)',
+                marker_color = COLORS['rare-blue']
+            ), secondary_y = False
+        )
+        fig.add_trace(
+            go.Scatter(
+                x = [],
+                y = [],
+                name = '% Mature',
+                marker_color = COLORS['secondary-red']
+            ), secondary_y = True
+        )
+        fig.update_layout(
+            title = 'Average Length and % Mature',
+            xaxis_title = '',
+            xaxis = {
+                'zerolinecolor': '#ffffff'
             },
-            'nticks': 4
-        },
-        legend = {
-            'orientation': 'h'
-        },
-        height = 400
-    )
+            yaxis = {
+                'titlefont': {
+                    'color': COLORS['rare-blue']
+                },
+                'tickfont': {
+                    'color': COLORS['rare-blue']
+                }
+            },
+            yaxis2 = {
+                'titlefont': {
+                    'color': COLORS['secondary-red']
+                },
+                'tickfont': {
+                    'color': COLORS['secondary-red']
+                },
+            },
+            legend = {'orientation': 'h'},
+            height = 400
+        )
 
-    fig.update_xaxes(fixedrange = True)
-    fig.update_yaxes(fixedrange = True)
+        fig.update_xaxes(fixedrange = True)
+        fig.update_yaxes(fixedrange = True)
+    elif chart == 'composition':
+        fig = go.Figure(data = [go.Pie(
+            labels = [],
+            values = [],
+            hole = 0.5,
+        )])
+
+        fig.update_traces(
+            hoverinfo = 'label+value',
+            textinfo = 'percent',
+            marker = dict(
+                line = dict(
+                    color = '#e5f7fa',
+                    width = 2
+                )
+            )
+        )
 
-    return fig
+        fig.update_layout(title = "Catch Composition (Top 10, metric tons)")
+    else:
+        raise ValueError(f"No figure template for chart '{chart}'")
 
-def make_length_fig(length_data):
+    return fig.to_plotly_json()
+
+def fill_fig_template(chart, *trace_data):
     """
-    Put length data on a line plot
+    Copy the template for `chart`, setting the data of each of its traces. `trace_data` holds
+    one dict of data properties (e.g. {'x': ..., 'y': ...}) per trace, in the template's trace order.
+    The layout is shared with the template, so the returned figure must not be modified.
     """
-    fig = make_subplots(specs = [[{'secondary_y': True}]])
-    fig.add_trace(
-        go.Scatter(
-            x = length_data['yearmonth'],
-            y = length_data['avg_length'],
-            name = 'Average length (cm)',
-            marker_color = COLORS['rare-blue']
-        ), secondary_y = False
-    )
-    fig.add_trace(
-        go.Scatter(
-            x = length_data['yearmonth'],
-            y = length_data['Pmat'],
-            name = '% Mature',
-            marker_color = COLORS['secondary-red']
-        ), secondary_y = True
-    )
-    fig.update_layout(
-        title = 'Average Length and % Mature',
-        xaxis_title = '',
-        xaxis = {
-            'zerolinecolor': '#ffffff'
-        },
-        yaxis = {
-            'titlefont': {
-                'color': COLORS['rare-blue']
-            },
-            'tickfont': {
-                'color': COLORS['rare-blue']
-            }
-        },
-        yaxis2 = {
-            'titlefont': {
-                'color': COLORS['secondary-red']
-            },
-            'tickfont': {
-                'color': COLORS['secondary-red']
-            },
-        },
-        legend = {'orientation': 'h'},
-        height = 400
-    )
+    template = get_fig_template(chart)
+    return {
+        'data': [dict(trace, **data) for trace, data in zip(template['data'], trace_data)],
+        'layout': template['layout']
+    }
+
+def make_catch_fig(catch_data):
+    """
+    Put catch data on a bar plot
+    """
+    return fill_fig_template('catch', {
+        'x': encode_months(catch_data['yearmonth']),
+        'y': encode_measure(catch_data['weight_mt'])
+    })
 
-    fig.update_xaxes(fixedrange = True)
-    fig.update_yaxes(fixedrange = True)
+def make_cpue_value_fig(cpue_value_data):
+    """
+    Put CPUE/value data on a line plot
+    """
+    months = encode_months(cpue_value_data['yearmonth'])
+    return fill_fig_template('cpue-value', {
+        'x': months,
+        'y': encode_measure(cpue_value_data['cpue_kg_boat'])
+    }, {
+        'x': months,
+        'y': encode_measure(cpue_value_data['avg_catch_value_usd'])
+    })
 
-    return fig
+def make_length_fig(length_data):
+    """
+    Put length data on a line plot
+    """
+    months = encode_months(length_data['yearmonth'])
+    return fill_fig_template('length', {
+        'x': months,
+        'y': encode_measure(length_data['avg_length'])
+    }, {
+        'x': months,
+        'y': encode_measure(length_data['Pmat'])
+    })
 
 def make_composition_fig(comp_data):
     """
     Put composition data on a pie chart
     """
-    fig = go.Figure(data = [go.Pie(
-        labels = comp_data['species_scientific'],
-        values = comp_data['weight_mt'],
-        hole = 0.5,
-    )])
-
-    fig.update_traces(
-        hoverinfo = 'label+value',
-        textinfo = 'percent',
-        marker = dict(
-            line = dict(
-                color = '#e5f7fa',
-                width = 2
-            )
-        )
-    )
-
-    fig.update_layout(title = "Catch Composition (Top 10, metric tons)")
-
-    return fig
+    return fill_fig_template('composition', {
+        'labels': comp_data['species_scientific'],
+        'values': encode_measure(comp_data['weight_mt'])
+    })
@@ -0,0 +1,214 @@
+import collections
+import contextlib
+import datetime
+import functools
+import hmac
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import psutil
+from flask import has_request_context, request
+
+# Fil gives the most complete picture of peak memory (arrow's allocations included), but only
+# works when the app runs under `fil-profile python ...`; anywhere else the import fails and
+# tracemalloc is used instead
+try:
+    from filprofiler.api import profile as fil_profile
+except Exception:
+    fil_profile = None
+
+# Opt-in profiling of single callback executions, for when a real-world selection is slow and
+# can't be reproduced locally. A profiled call writes a report to PROFILE_DIR with:
+#
+# - CPU samples of the thread running it (the stack every PROFILE_INTERVAL seconds), as the
+#   functions most often on the stack and as collapsed stacks, which flamegraph.pl and
+#   speedscope.app can draw
+# - the peak of python memory allocated during the call and where it was allocated
+#   (tracemalloc, or a Fil report directory when running under fil-profile), and the process's
+#   peak RSS, which also counts arrow's memory
+#
+# Calls are profiled when PROFILE_CALLBACKS is set, or when the request has an
+# "X-Profile: <PROFILE_TOKEN>" header. Only one call per process is profiled at a time, since the
+# allocation tracing is process-wide; calls made meanwhile run as usual.
+PROFILE_CALLBACKS = os.environ.get('PROFILE_CALLBACKS', '').lower() in ('1', 'true', 'yes')
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profile-directory')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+# Reports of calls faster than this (seconds) are thrown away, so profiling everything in
+# production only keeps the slow ones
+PROFILE_MIN_SECONDS = float(os.environ.get('PROFILE_MIN_SECONDS', 0))
+PROFILE_HEADER = 'X-Profile'
+
+# How many functions and allocation sites the report lists
+TOP_N = 30
+
+profiling = threading.Lock()
+local = threading.local()
+
+def is_requested():
+    """
+    Whether the current call should be profiled
+    """
+    if PROFILE_CALLBACKS:
+        return True
+    if PROFILE_TOKEN and has_request_context():
+        return hmac.compare_digest(request.headers.get(PROFILE_HEADER, ''), PROFILE_TOKEN)
+    return False
+
+def format_frame(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+class Sampler(threading.Thread):
+    """
+    Samples the stack of thread `target`, and the process's RSS, every `interval` seconds until
+    stopped
+    """
+    def __init__(self, target, interval):
+        super().__init__(daemon = True)
+        self.target = target
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.n_samples = 0
+        self.process = psutil.Process()
+        self.peak_rss = self.start_rss = self.process.memory_info().rss
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            # Only the profiled call's part of the stack; what's above it is the same in every sample
+            while frame is not None and frame.f_code is not run_profiled.__code__:
+                stack.append(format_frame(frame))
+                frame = frame.f_back
+            # Outermost first, as the collapsed stack format has it
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.n_samples += 1
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def top_functions(self):
+        """
+        (function, samples with it anywhere on the stack, samples with it on top), most
+        often on the stack first
+        """
+        total = collections.Counter()
+        own = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            for frame in set(frames):
+                total[frame] += count
+            own[frames[-1]] += count
+        return [(frame, count, own[frame]) for frame, count in total.most_common(TOP_N)]
+
+def get_report_path(name):
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    return os.path.join(PROFILE_DIR, f"{name}-{stamp}-{uuid.uuid4().hex[:8]}")
+
+def format_arg(arg):
+    # Series and arrays as plain lists, on one line
+    return repr(arg.tolist() if hasattr(arg, 'tolist') else arg)
+
+def describe_call(args, kwargs):
+    # Selections can list hundreds of MAA's
+    description = ', '.join([format_arg(arg) for arg in args] + [f"{k}={format_arg(v)}" for k, v in kwargs.items()])
+    return description if len(description) <= 2000 else description[:2000] + '...'
+
+def write_report(path, name, call, seconds, sampler, peak_python, allocations, fil_path):
+    mb = 2**20
+    lines = [
+        f"{name}({call})",
+        f"pid {os.getpid()}, {datetime.datetime.now().isoformat(timespec = 'seconds')}",
+        "",
+        f"wall time       {seconds:.3f} s",
+        f"CPU samples     {sampler.n_samples} every {1e3 * sampler.interval:g} ms",
+        f"RSS             {sampler.start_rss / mb:.1f} MB at start, {sampler.peak_rss / mb:.1f} MB at peak "
+        f"(+{(sampler.peak_rss - sampler.start_rss) / mb:.1f} MB)",
+    ]
+    if fil_path:
+        lines.append(f"peak allocations  see the Fil report in {fil_path}")
+    else:
+        lines.append(f"peak python     {peak_python / mb:.1f} MB allocated during the call (tracemalloc)")
+
+    lines += ["", "Functions most often on the stack (samples on the stack, on top):"]
+    for frame, count, own in sampler.top_functions():
+        lines.append(f"  {count:7} {own:7}  {frame}")
+
+    if allocations:
+        lines += ["", "Largest allocations still held at the end of the call:"]
+        for stat in allocations:
+            frame = stat.traceback[0]
+            lines.append(f"  {stat.size / mb:9.2f} MB {stat.count:9} blocks  {frame.filename}:{frame.lineno}")
+
+    with open(f"{path}.txt", 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(f"{path}.folded", 'w') as f:
+        for stack, count in sampler.stacks.items():
+            f.write(f"{stack} {count}\n")
+
+@contextlib.contextmanager
+def tracing_allocations():
+    """
+    Trace python allocations in the `with` block; yields a dict that gets the peak and the
+    largest sites
+    """
+    result = {}
+    tracemalloc.start()
+    try:
+        yield result
+        result['peak'] = tracemalloc.get_traced_memory()[1]
+        result['allocations'] = tracemalloc.take_snapshot().statistics('lineno')[:TOP_N]
+    finally:
+        tracemalloc.stop()
+
+def run_profiled(name, f, args, kwargs):
+    path = get_report_path(name)
+    os.makedirs(PROFILE_DIR, exist_ok = True)
+    sampler = Sampler(threading.get_ident(), PROFILE_INTERVAL)
+    sampler.start()
+    started = time.perf_counter()
+    traced = {}
+    fil_path = None
+    try:
+        if fil_profile is not None:
+            fil_path = f"{path}.fil"
+            return fil_profile(lambda: f(*args, **kwargs), fil_path)
+        with tracing_allocations() as traced:
+            return f(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - started
+        sampler.stop()
+        if seconds >= PROFILE_MIN_SECONDS:
+            write_report(
+                path, name, describe_call(args, kwargs), seconds, sampler,
+                traced.get('peak', 0), traced.get('allocations'), fil_path
+            )
+
+def profiled(name):
+    """
+    Decorator profiling calls of a callback, or of any function, when profiling is on (see
+    PROFILE_CALLBACKS). Goes under @app.callback. A call made from within another profiled
+    call is part of that one's report.
+    """
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if getattr(local, 'active', False) or not is_requested():
+                return f(*args, **kwargs)
+            if not profiling.acquire(blocking = False):
+                return f(*args, **kwargs)
+            local.active = True
+            try:
+                return run_profiled(name, f, args, kwargs)
+            finally:
+                local.active = False
+                profiling.release()
+        return wrapper
+    return decorate
@@ -0,0 +1,100 @@
+from utils_plot import get_catch_data, get_cpue_value_data, get_length_data, get_composition_data
+from utils_map import get_map_data
+from utils_highlights import get_highlights_data
+from utils_sql import get_output_data_sql, get_map_data_sql
+from utils_metrics import timed_stage
+from utils_jobs import step
+import os
+import pandas as pd
+
+# The computations behind the dashboard's outputs, kept apart from the app so the batch reports
+# (batch_reports.py) and background jobs produce exactly what the dashboard shows.
+
+# What computes the outputs from the snapshot records: 'pandas' (get_output_data) or 'duckdb'
+# (the same aggregates as SQL, see utils_sql.py). Both give the same tables; check_backends.py
+# compares them.
+QUERY_BACKEND = os.environ.get('QUERY_BACKEND', 'pandas')
+QUERY_BACKENDS = ('pandas', 'duckdb')
+
+# Columns get_output_data uses; queries on the snapshot read only these
+OUTPUT_COLUMNS = [
+    'date', 'yearmonth', 'ma_id', 'community_id', 'est_fishers', 'est_buyers',
+    'fisher_id', 'buyer_id', 'buyer_gender', 'fishbase_id', 'weight_mt', 'count',
+    'total_price_usd', 'species_scientific', 'species_local', 'is_focal', 'a', 'b', 'lmax'
+]
+
+def get_maa_countries(maa, sel_maa):
+    """
+    Countries of the selected MAA's, from the maa table of get_geo_data. Lets snapshot queries
+    skip the other countries' files.
+    """
+    return sorted(set(maa.loc[maa['ma_id'].isin(list(sel_maa)), 'country_id']))
+
+def get_output_data(filtered_data, comm):
+    """
+    Compute the data for the plots, highlights and map from the filtered records: a dict of
+    tables keyed by output (see SHEET_NAMES in utils_download).
+    """
+    output_data = {}
+    with timed_stage("map"):
+        output_data["map"] = get_map_data(filtered_data, comm)
+    step("Computed map")
+    with timed_stage("catch"):
+        output_data["catch"] = get_catch_data(filtered_data)
+    step("Computed catch")
+    with timed_stage("cpue-value"):
+        output_data["cpue-value"] = get_cpue_value_data(filtered_data)
+    step("Computed cpue-value")
+    with timed_stage("length"):
+        output_data["length"] = get_length_data(filtered_data)
+    step("Computed length")
+    with timed_stage("composition"):
+        output_data["composition"] = get_composition_data(filtered_data)
+    step("Computed composition")
+    with timed_stage("highlights"):
+        output_data["highlights"] = get_highlights_data(filtered_data)
+    step("Computed highlights")
+
+    return output_data
+
+def compute_output_data(records, comm, backend = None):
+    """
+    get_output_data from an arrow table of records (see query_snapshot_table), with `backend`
+    (default: QUERY_BACKEND). The duckdb backend aggregates the arrow data directly, without
+    converting it to a dataframe first.
+    """
+    backend = backend or QUERY_BACKEND
+    if backend == 'duckdb':
+        return get_output_data_sql(records, comm)
+    with timed_stage("to-pandas"):
+        filtered_data = records.to_pandas()
+    return get_output_data(filtered_data, comm)
+
+def compute_map_data(records, comm, backend = None):
+    """
+    Same as compute_output_data, for the map's table only
+    """
+    backend = backend or QUERY_BACKEND
+    if backend == 'duckdb':
+        return get_map_data_sql(records, comm)
+    return get_map_data(records.to_pandas(), comm)
+
+def compare_output_data(expected, actual, rtol = 1e-9):
+    """
+    Differences between two results of get_output_data, as a list of (output, message); empty if
+    they match. Values are compared up to `rtol`, since the backends sum in different orders, and
+    column types are ignored (e.g. a count may come back as int64 from one and float from the other).
+    """
+    differences = []
+    for output in expected:
+        try:
+            pd.testing.assert_frame_equal(
+                expected[output].reset_index(drop = True),
+                actual[output].reset_index(drop = True),
+                check_dtype = False,
+                check_exact = False,
+                rtol = rtol
+            )
+        except AssertionError as e:
+            differences.append((output, str(e)))
+    return differences
@@ -0,0 +1,281 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import functools
+import hashlib
+import os
+import shutil
+import time
+import uuid
+import pandas as pd
+
+# Local columnar copy of the OurFish data, written after each pull from data.world and read by
+# apply_filters, the exports and the batch reports instead of holding the full table in memory.
+#
+# The records are split into parquet files by country and month:
+#
+#     snapshot-directory/ourfish-<version>/country_id=6/yearmonth=2023-04-01/part-0.parquet
+#
+# so a query only opens the files of the selected countries and months, and only reads the
+# columns and row groups it needs. What one query costs depends on the size of its selection,
+# not of the whole dataset.
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'snapshot-directory')
+# Holds the version of the current snapshot; each version is in its own directory
+VERSION_PATH = os.path.join(SNAPSHOT_DIR, 'ourfish.version')
+# Rows per parquet row group, the unit that filters can skip
+ROW_GROUP_SIZE = 64 * 1024
+# Earlier versions kept around for queries still reading them
+KEEP_VERSIONS = 1
+
+PARTITIONING = ds.partitioning(
+    pa.schema([('country_id', pa.int64()), ('yearmonth', pa.date32())]),
+    flavor = 'hive'
+)
+
+def to_arrow(all_data):
+    """
+    Convert the processed OurFish data to an arrow table. Free-text columns occasionally mix
+    numbers and strings (e.g. buyer names), which arrow can't store in one column, so those are
+    converted to strings.
+    """
+    columns = {}
+    for col in all_data.columns:
+        try:
+            columns[col] = pa.array(all_data[col], from_pandas = True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            values = all_data[col]
+            columns[col] = pa.array(values.where(values.isna(), values.astype(str)), from_pandas = True)
+
+    return pa.table(columns)
+
+def get_snapshot_dir(version):
+    return os.path.join(SNAPSHOT_DIR, f'ourfish-{version}')
+
+def hash_directory(path, chunk_size = 1024 * 1024):
+    """
+    sha256 of the files in a directory: their paths (relative to it) and contents, in path order
+    """
+    sha = hashlib.sha256()
+    files = sorted(
+        os.path.relpath(os.path.join(root, name), path)
+        for root, _, names in os.walk(path) for name in names
+    )
+    for name in files:
+        sha.update(name.encode())
+        with open(os.path.join(path, name), 'rb') as f:
+            chunk = f.read(chunk_size)
+            while chunk:
+                sha.update(chunk)
+                chunk = f.read(chunk_size)
+    return sha.hexdigest()
+
+def write_snapshot(all_data):
+    """
+    Write the processed OurFish data (see get_ourfish_data) to a new snapshot and make it the
+    current one. Rows are sorted by date, so each row group within a partition covers a narrow
+    date range.
+
+    The same data always produces the same files, so their hash is the dataset version; it only
+    changes when the data does. The snapshot is written to a temp directory, moved to its
+    version's directory, and only then made current, so readers never see a partial one.
+    """
+    return write_snapshot_chunks([all_data.sort_values('date', kind = 'stable')])
+
+def prepare_table(chunk):
+    table = to_arrow(chunk)
+    return table.set_column(
+        table.schema.get_field_index('country_id'), 'country_id', table['country_id'].cast(pa.int64())
+    )
+
+def write_snapshot_chunks(chunks):
+    """
+    Same as write_snapshot, for processed data too big to hold at once: `chunks` yields
+    dataframes, already in date order, which are written as they come. Every chunk's columns are
+    converted to the types of the first one.
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok = True)
+    tables = (prepare_table(chunk) for chunk in chunks)
+    first = next(tables)
+
+    def batches():
+        yield from first.to_batches()
+        for table in tables:
+            yield from table.select(first.schema.names).cast(first.schema).to_batches()
+
+    tmp_dir = os.path.join(SNAPSHOT_DIR, f'tmp-{uuid.uuid4().hex}')
+    ds.write_dataset(
+        batches(), tmp_dir,
+        schema = first.schema,
+        format = 'parquet',
+        partitioning = PARTITIONING,
+        basename_template = 'part-{i}.parquet',
+        max_rows_per_group = ROW_GROUP_SIZE,
+        # Threads would write rows in a different order each time, and change the hash
+        use_threads = False
+    )
+    version = hash_directory(tmp_dir)[:16]
+
+    snapshot_dir = get_snapshot_dir(version)
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(tmp_dir)
+    else:
+        try:
+            os.replace(tmp_dir, snapshot_dir)
+        except OSError:
+            # Another process loading the same data got there first; a version's directory
+            # never changes once it's in place, so theirs is as good as ours
+            if not os.path.isdir(snapshot_dir):
+                raise
+            shutil.rmtree(tmp_dir)
+
+    tmp_version_path = f'{VERSION_PATH}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_version_path, 'w') as f:
+        f.write(version)
+    os.replace(tmp_version_path, VERSION_PATH)
+
+    remove_old_snapshots(version)
+    return version
+
+def remove_old_snapshots(version):
+    """
+    Delete all but the current and the KEEP_VERSIONS most recent other versions, and temp
+    directories abandoned by a write that didn't finish
+    """
+    snapshots = []
+    for entry in os.scandir(SNAPSHOT_DIR):
+        if not entry.is_dir():
+            continue
+        if entry.name.startswith('tmp-'):
+            if entry.stat().st_mtime < time.time() - 24 * 60 * 60:
+                shutil.rmtree(entry.path, ignore_errors = True)
+        elif entry.name.startswith('ourfish-') and entry.name != f'ourfish-{version}':
+            snapshots.append((entry.stat().st_mtime, entry.path))
+
+    for _, path in sorted(snapshots, reverse = True)[KEEP_VERSIONS:]:
+        shutil.rmtree(path, ignore_errors = True)
+
+def get_snapshot_version():
+    """
+    Version of the current snapshot (see write_snapshot), or None if there is no snapshot yet
+    """
+    try:
+        with open(VERSION_PATH) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+@functools.lru_cache(maxsize = 4)
+def open_snapshot(version):
+    # Listing the partition files takes a moment, so it's done once per version
+    return ds.dataset(get_snapshot_dir(version), format = 'parquet', partitioning = PARTITIONING)
+
+def get_snapshot_dataset(version = None):
+    """
+    The snapshot as an arrow dataset (default: the current version), or None if there's no
+    snapshot
+    """
+    version = version or get_snapshot_version()
+    if version is None or not os.path.isdir(get_snapshot_dir(version)):
+        return None
+    return open_snapshot(version)
+
+def get_snapshot_filter(sel_maa, start_date, end_date, countries = None):
+    """
+    Arrow filter expression matching apply_filters: records in the selected MAA's and dates.
+
+    The yearmonth (and, if the MAA's countries are given, country_id) conditions only touch
+    partition columns, so the files of other months and countries are skipped without being
+    opened.
+    """
+    start_month = start_date.replace(day = 1)
+    end_month = end_date.replace(day = 1)
+    expression = (
+        (ds.field('yearmonth') >= start_month) &
+        (ds.field('yearmonth') <= end_month) &
+        ds.field('ma_id').isin(list(sel_maa)) &
+        (ds.field('date') >= start_date) &
+        (ds.field('date') <= end_date)
+    )
+    if countries is not None:
+        expression = ds.field('country_id').isin(list(countries)) & expression
+    return expression
+
+def query_snapshot_table(sel_maa, start_date, end_date, columns = None, countries = None, version = None):
+    """
+    Records in the selected MAA's and dates as an arrow table, with only `columns` (default: all).
+    See get_snapshot_filter for `countries`.
+    """
+    dataset = get_snapshot_dataset(version)
+    return dataset.to_table(
+        columns = columns,
+        filter = get_snapshot_filter(sel_maa, start_date, end_date, countries)
+    )
+
+def query_snapshot(sel_maa, start_date, end_date, columns = None, countries = None, version = None):
+    """
+    Same as query_snapshot_table, as a dataframe
+    """
+    return query_snapshot_table(sel_maa, start_date, end_date, columns, countries, version).to_pandas()
+
+def read_snapshot(start_date = None, end_date = None, columns = None, version = None):
+    """
+    All records, or all records between two dates, as a dataframe
+    """
+    dataset = get_snapshot_dataset(version)
+    expression = None
+    if start_date is not None:
+        expression = (
+            (ds.field('yearmonth') >= start_date.replace(day = 1)) &
+            (ds.field('yearmonth') <= end_date.replace(day = 1)) &
+            (ds.field('date') >= start_date) &
+            (ds.field('date') <= end_date)
+        )
+    return dataset.to_table(columns = columns, filter = expression).to_pandas()
+
+def read_snapshot_distinct(columns, version = None):
+    """
+    Distinct rows of `columns` over all records, as a dataframe. Read a batch at a time, so it
+    works on snapshots too big to read whole, as long as the distinct rows are few (e.g. the
+    GEO_COLUMNS that get_geo_data uses).
+    """
+    dataset = get_snapshot_dataset(version)
+    frames = [
+        batch.to_pandas().drop_duplicates()
+        for batch in dataset.to_batches(columns = columns, batch_size = 1024 * 1024)
+    ]
+    return pd.concat(frames).drop_duplicates().reset_index(drop = True)
+
+def get_snapshot_date_range(version = None):
+    """
+    First and last record dates in the snapshot
+    """
+    dataset = get_snapshot_dataset(version)
+    min_date = max_date = None
+    for batch in dataset.to_batches(columns = ['date']):
+        extremes = pc.min_max(batch.column('date')).as_py()
+        if extremes['min'] is not None:
+            min_date = extremes['min'] if min_date is None else min(min_date, extremes['min'])
+            max_date = extremes['max'] if max_date is None else max(max_date, extremes['max'])
+    return min_date, max_date
+
+def iter_snapshot_batches(sel_maa, start_date, end_date, columns = None, batch_size = ROW_GROUP_SIZE, countries = None, version = None):
+    """
+    Yield the snapshot records in the selected MAA's and dates as arrow record batches of at most
+    `batch_size` rows. Only `columns` (default: all) are read, and partitions and row groups
+    outside the selection are skipped without being read.
+    """
+    dataset = get_snapshot_dataset(version)
+    return dataset.to_batches(
+        columns = columns,
+        filter = get_snapshot_filter(sel_maa, start_date, end_date, countries),
+        batch_size = batch_size
+    )
+
+def get_snapshot_schema(columns = None, version = None):
+    """
+    Arrow schema of the snapshot, limited to `columns` if given
+    """
+    schema = get_snapshot_dataset(version).schema
+    if columns is not None:
+        schema = pa.schema([schema.field(c) for c in columns])
+    return schema
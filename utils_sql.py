@@ -0,0 +1,201 @@
+import duckdb
+import os
+import pyarrow as pa
+import threading
+from utils_metrics import timed_stage
+from utils_jobs import step
+
+# The dashboard's aggregates (see utils_query.get_output_data) as SQL, run by DuckDB straight on
+# the arrow records read from the snapshot. DuckDB runs each query vectorized over several
+# threads, without first converting the records to a dataframe of python objects.
+#
+# Each query reproduces its pandas counterpart in utils_plot/utils_map/utils_highlights,
+# including how it treats missing values: pandas skips NaN's in sums (an all-NaN sum is 0, hence
+# the COALESCE's), drops NaN group keys except where noted, and excludes NaN from nunique.
+
+# Threads per query; by default DuckDB uses one per core
+SQL_THREADS = int(os.environ.get('SQL_THREADS', 0))
+
+CATCH_SQL = """
+    SELECT yearmonth, COALESCE(SUM(weight_mt), 0) AS weight_mt
+    FROM records
+    WHERE yearmonth IS NOT NULL
+    GROUP BY yearmonth
+    ORDER BY yearmonth
+"""
+
+# Boats with no fisher_id count as one boat per month (groupby dropna = False)
+CPUE_VALUE_SQL = """
+    WITH boats AS (
+        SELECT
+            yearmonth,
+            COALESCE(SUM(1e3 * weight_mt), 0) AS weight_kg,
+            COALESCE(SUM(total_price_usd), 0) AS total_price_usd
+        FROM records
+        WHERE yearmonth IS NOT NULL
+        GROUP BY yearmonth, fisher_id
+    )
+    SELECT
+        yearmonth,
+        AVG(weight_kg) AS cpue_kg_boat,
+        STDDEV_SAMP(weight_kg) / SQRT(COUNT(weight_kg)) AS ste_cpue_kg_boat,
+        AVG(total_price_usd) AS avg_catch_value_usd,
+        STDDEV_SAMP(total_price_usd) / SQRT(COUNT(total_price_usd)) AS ste_catch_value_usd
+    FROM boats
+    GROUP BY yearmonth
+    ORDER BY yearmonth
+"""
+
+LENGTH_SQL = """
+    WITH lengths AS (
+        SELECT
+            yearmonth,
+            "count",
+            lmax,
+            POWER(1e6 * weight_mt / "count" / a, 1 / b) AS length_cm
+        FROM records
+        WHERE "count" > 0 AND a > 0 AND b > 0 AND weight_mt > 0 AND yearmonth IS NOT NULL
+    ),
+    avg_length AS (
+        SELECT yearmonth, SUM(length_cm * "count") / SUM("count") AS avg_length
+        FROM lengths
+        GROUP BY yearmonth
+    ),
+    mature AS (
+        SELECT
+            *,
+            POWER(10, 0.8979 * LOG10(POWER(10, 0.044 + 0.9841 * LOG10(lmax))) - 0.0782) AS lmat
+        FROM lengths
+        WHERE lmax > 0
+    ),
+    prop_mature AS (
+        SELECT
+            yearmonth,
+            100 * SUM(CASE WHEN length_cm > lmat THEN "count" ELSE 0 END) / SUM("count") AS Pmat
+        FROM mature
+        GROUP BY yearmonth
+    )
+    SELECT COALESCE(a.yearmonth, p.yearmonth) AS yearmonth, a.avg_length, p.Pmat
+    FROM avg_length a FULL OUTER JOIN prop_mature p ON a.yearmonth = p.yearmonth
+    ORDER BY 1
+"""
+
+# Ties in weight are broken by name, where pandas' sort leaves them in no particular order
+COMPOSITION_SQL = """
+    SELECT
+        species_scientific,
+        MAX(is_focal) AS is_focal,
+        ARRAY_TO_STRING(LIST_SORT(LIST_DISTINCT(LIST(species_local))), '/') AS species_local,
+        COALESCE(SUM(weight_mt), 0) AS weight_mt
+    FROM records
+    WHERE species_scientific IS NOT NULL
+    GROUP BY species_scientific
+    ORDER BY weight_mt DESC, species_scientific
+    LIMIT 10
+"""
+
+MAP_SQL = """
+    SELECT
+        community_id,
+        COALESCE(SUM(est_fishers), 0) AS est_fishers,
+        COALESCE(SUM(est_buyers), 0) AS est_buyers,
+        COALESCE(SUM(weight_mt), 0) AS weight_mt,
+        COALESCE(SUM(total_price_usd), 0) AS total_price_usd
+    FROM records
+    WHERE community_id IS NOT NULL
+    GROUP BY community_id
+    ORDER BY community_id
+"""
+
+HIGHLIGHTS_SQL = """
+    SELECT
+        COALESCE(SUM(weight_mt), 0) AS weight,
+        COALESCE(SUM(total_price_usd), 0) AS value,
+        (
+            SELECT COALESCE(SUM(fishers), 0)
+            FROM (SELECT COUNT(DISTINCT fisher_id) AS fishers FROM records GROUP BY date)
+        ) AS trips,
+        COUNT(DISTINCT fisher_id) AS fishers,
+        COUNT(DISTINCT CASE WHEN buyer_gender = 2 THEN buyer_id END) AS "female buyers",
+        COUNT(DISTINCT buyer_id) AS buyers
+    FROM records
+"""
+
+connection = None
+connection_lock = threading.Lock()
+
+def get_cursor():
+    """
+    A cursor of the shared in-memory DuckDB database. Each call gets its own, so threads can run
+    queries at the same time.
+    """
+    global connection
+    with connection_lock:
+        if connection is None:
+            connection = duckdb.connect()
+            if SQL_THREADS:
+                connection.execute(f"SET threads = {SQL_THREADS}")
+        return connection.cursor()
+
+def run_sql(cursor, sql):
+    """
+    Run a query and return the result as a dataframe with the column types pandas would give:
+    it goes through arrow, so dates come back as python dates, and sums and counts of integers
+    (128-bit in DuckDB, decimals in arrow) become int64.
+    """
+    table = cursor.execute(sql).fetch_arrow_table()
+    for i, field in enumerate(table.schema):
+        if pa.types.is_decimal(field.type) and field.type.scale == 0:
+            table = table.set_column(i, field.name, table[field.name].cast(pa.int64()))
+    return table.to_pandas()
+
+def add_community_details(map_data, comm):
+    # A small lookup, done the same way as utils_map.get_map_data
+    return (map_data
+        .join(comm[['community_id', 'community_name', 'community_lat', 'community_lon', 'population']].set_index('community_id'), on = 'community_id')
+        .reset_index(drop = True))
+
+def get_map_data_sql(records, comm):
+    """
+    Same as utils_map.get_map_data, from an arrow table of records (see query_snapshot_table)
+    """
+    cursor = get_cursor()
+    try:
+        cursor.register('records', records)
+        return add_community_details(run_sql(cursor, MAP_SQL), comm)
+    finally:
+        cursor.close()
+
+def get_output_data_sql(records, comm):
+    """
+    Same as utils_query.get_output_data, from an arrow table of records (see query_snapshot_table)
+    """
+    cursor = get_cursor()
+    try:
+        cursor.register('records', records)
+
+        # Stages are timed apart from the pandas ones (see utils_query.get_output_data), so the
+        # two backends can be compared
+        output_data = {}
+        with timed_stage("sql-map"):
+            output_data["map"] = add_community_details(run_sql(cursor, MAP_SQL), comm)
+        step("Computed map")
+        with timed_stage("sql-catch"):
+            output_data["catch"] = run_sql(cursor, CATCH_SQL)
+        step("Computed catch")
+        with timed_stage("sql-cpue-value"):
+            output_data["cpue-value"] = run_sql(cursor, CPUE_VALUE_SQL)
+        step("Computed cpue-value")
+        with timed_stage("sql-length"):
+            output_data["length"] = run_sql(cursor, LENGTH_SQL)
+        step("Computed length")
+        with timed_stage("sql-composition"):
+            output_data["composition"] = run_sql(cursor, COMPOSITION_SQL)
+        step("Computed composition")
+        with timed_stage("sql-highlights"):
+            output_data["highlights"] = run_sql(cursor, HIGHLIGHTS_SQL)
+        step("Computed highlights")
+    finally:
+        cursor.close()
+
+    return output_data
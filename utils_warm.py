@@ -0,0 +1,192 @@
+import atexit
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Precomputing the standard views into the shared cache after the data loads, so the first users
+# after a deploy or a refresh don't wait for them. Views are warmed in priority order -- the
+# default view, each country's view, then the views users asked for most recently -- until the
+# time budget runs out. Views already cached are skipped, so warming again is cheap.
+WARM_DIR = os.environ.get('WARM_DIR', 'warm-directory')
+VIEWS_PATH = os.path.join(WARM_DIR, 'views.sqlite')
+# Seconds after which no more views are started; 0 turns warming off
+WARM_BUDGET = float(os.environ.get('WARM_BUDGET', 120))
+# How many of the most requested views to warm, among those asked for in the last WARM_RECENT_DAYS
+WARM_TOP_VIEWS = int(os.environ.get('WARM_TOP_VIEWS', 20))
+WARM_RECENT_DAYS = int(os.environ.get('WARM_RECENT_DAYS', 7))
+# Whether to warm as soon as a process loads the data. gunicorn_config.py turns this off: the
+# master must not be computing in a background thread while it forks, so workers warm from
+# post_fork instead.
+WARM_ON_LOAD = os.environ.get('WARM_ON_LOAD', 'true').lower() in ('1', 'true', 'yes')
+# Seconds between writes of the view counts to VIEWS_PATH
+VIEWS_FLUSH_INTERVAL = float(os.environ.get('VIEWS_FLUSH_INTERVAL', 30))
+
+logger = logging.getLogger(__name__)
+
+class ViewStats:
+    """
+    How often each view (sel_maa, start_date, end_date) was asked for, in a sqlite database
+    shared by every process.
+
+    `record` is called on every request, so it only counts in memory; a background thread
+    adds the counts to the database every `flush_interval` seconds. Requests never wait on the
+    database, which every worker writes to.
+    """
+    def __init__(self, path = VIEWS_PATH, flush_interval = VIEWS_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.reset()
+        # A forked worker starts with no counts of its own, and starts its own flushing thread
+        os.register_at_fork(after_in_child = self.reset)
+        atexit.register(self.flush)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS views (
+                    view TEXT PRIMARY KEY,
+                    requests INTEGER,
+                    last_requested REAL
+                )
+            """)
+
+    @contextlib.contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.pending = collections.Counter()
+        self.last_requested = {}
+        self.flusher = None
+
+    def record(self, sel_maa, start_date, end_date):
+        if len(sel_maa) == 0:
+            return
+        view = json.dumps([sorted(int(m) for m in sel_maa), start_date.isoformat(), end_date.isoformat()])
+        with self.lock:
+            self.pending[view] += 1
+            self.last_requested[view] = time.time()
+            if self.flusher is None:
+                self.flusher = threading.Thread(target = self.flush_loop, daemon = True)
+                self.flusher.start()
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Add the counts recorded since the last flush to the database
+        """
+        with self.lock:
+            pending, last_requested = self.pending, self.last_requested
+            self.pending, self.last_requested = collections.Counter(), {}
+        if not pending:
+            return
+        try:
+            with self.connect() as conn:
+                conn.executemany(
+                    "INSERT INTO views (view, requests, last_requested) VALUES (?, ?, ?) \
+                    ON CONFLICT (view) DO UPDATE SET requests = requests + excluded.requests, \
+                    last_requested = MAX(last_requested, excluded.last_requested)",
+                    [(view, n, last_requested[view]) for view, n in pending.items()]
+                )
+        except sqlite3.Error:
+            # Keep the counts for the next flush
+            logger.exception("Couldn't save the view counts")
+            with self.lock:
+                self.pending.update(pending)
+                for view, t in last_requested.items():
+                    self.last_requested[view] = max(t, self.last_requested.get(view, 0))
+
+    def top(self, n = WARM_TOP_VIEWS, days = WARM_RECENT_DAYS):
+        """
+        The `n` most requested views of the last `days` days, as (sel_maa, start_date, end_date)
+        with ISO dates. Counts other processes haven't flushed yet aren't included.
+        """
+        self.flush()
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT view FROM views WHERE last_requested > ? ORDER BY requests DESC LIMIT ?",
+                (time.time() - days * 24 * 60 * 60, n)
+            ).fetchall()
+        return [tuple(json.loads(row[0])) for row in rows]
+
+@contextlib.contextmanager
+def warm_lock(path):
+    """
+    Hold an exclusive lock on `path` across processes: under gunicorn every worker starts
+    warming, and the others wait for the first rather than computing the same views alongside it
+    """
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class CacheWarmer:
+    """
+    Warms the cache in a background thread. `get_views(dataset)` returns the views to warm as
+    (name, sel_maa, start_date, end_date), highest priority first, and `warm(view)` computes and
+    caches one, returning whether it had to (False if it was already cached).
+
+    `status` tells how the last run for this process went: state is idle, waiting (for another
+    process's run), running, done or failed.
+    """
+    def __init__(self, get_views, warm, budget = WARM_BUDGET):
+        self.get_views = get_views
+        self.warm = warm
+        self.budget = budget
+        self.status = {'state': 'idle', 'version': None}
+
+    def start(self, dataset):
+        if self.budget <= 0:
+            return
+        self.status = {'state': 'waiting', 'version': dataset.version}
+        threading.Thread(target = self.run, args = (dataset,), daemon = True).start()
+
+    def run(self, dataset):
+        try:
+            with warm_lock(os.path.join(WARM_DIR, 'warm.lock')):
+                self.warm_views(dataset)
+        except Exception:
+            # A failed warm-up only means colder caches; the app serves as usual
+            logger.exception("Cache warming failed")
+            self.status = {**self.status, 'state': 'failed'}
+
+    def warm_views(self, dataset):
+        started = time.time()
+        status = {
+            'state': 'running', 'version': dataset.version, 'started_at': started,
+            'warmed': 0, 'cached': 0, 'skipped': 0
+        }
+        self.status = status
+        views = self.get_views(dataset)
+        for i, view in enumerate(views):
+            if time.time() - started > self.budget:
+                status['skipped'] = len(views) - i
+                break
+            if self.warm(view):
+                status['warmed'] += 1
+            else:
+                status['cached'] += 1
+        status['state'] = 'done'
+        status['seconds'] = round(time.time() - started, 1)
+        logger.info(
+            "Cache warming for %s: %d views computed, %d already cached, %d skipped in %.1f s",
+            dataset.version, status['warmed'], status['cached'], status['skipped'], status['seconds']
+        )